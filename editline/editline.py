@@ -5,7 +5,65 @@ Editline:
 
 import sys
 import os
+import re
+import time
+import shlex
+import datetime
+import threading
+import asyncio
+import struct
+import weakref
+import fcntl
+import termios
+import contextlib
 from editline import _editline
+from editline._editline import HistoryStore
+from editline.history import (CompressedHistory, SharedHistory,
+                              SQLiteHistory, open_history, compressed_codec,
+                              write_compressed, append_compressed,
+                              write_index)
+
+def _open_pty(columns: int, lines: int) -> tuple:
+    """Open a pseudo-terminal sized columns x lines for an instance.
+
+    Returns:
+        The master descriptor and the (in, out, err) streams on the slave,
+        which the instance takes over and closes.
+
+    """
+    master, slave = os.openpty()
+    try:
+        fcntl.ioctl(slave, termios.TIOCSWINSZ,
+                    struct.pack('HHHH', lines, columns, 0, 0))
+
+        # the instance fdopen()s the descriptors and fcloses them in its
+        # cleanup, so these stream objects must not close them as well
+        streams = [os.fdopen(os.dup(slave), mode, closefd=False)
+                   for mode in ('r', 'w', 'w')]
+    except BaseException:
+        os.close(master)
+        raise
+    finally:
+        os.close(slave)
+    return master, streams
+
+
+class _HeadlessOutput:
+    """out_stream of a headless instance: writes join libedit's output."""
+
+    def __init__(self, editline):
+        self._editline = weakref.ref(editline)
+
+    def write(self, text: str) -> int:
+        editline = self._editline()
+        # once the instance has gone there is nowhere for it to go
+        if editline is not None:
+            editline._write_output(text)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
 
 class EditLine(_editline.EditLineBase):
     """Editline High Level Support
@@ -49,6 +107,35 @@ class EditLine(_editline.EditLineBase):
         self.commands = {}
         self.add_command('history', self.show_history)
 
+        # Python functions which keys can be bound to
+        self._key_functions = []
+
+        # history file shared with other processes
+        self._shared_history = None
+
+        # history database and the last command's (id, start time)
+        self._history_db = None
+        self._history_record = None
+
+        # older part of the history file which has not been loaded yet
+        self._history_backlog = None
+
+        # commands the history kept since a compressed file was read, to
+        # be appended to it, and the line libedit is about to enter
+        self._history_appending = False
+        self._history_pending = []
+        self._history_entering = None
+
+        # keep a sidecar index next to plain history files
+        self._history_indexed = False
+
+        # background history load and the entries it produced
+        self._history_loader = None
+        self._history_loaded = None
+
+        # keystrokes of a headless instance
+        self._keys = None
+
         # tools
         self.keymap = {
             'tab': ['^I'],
@@ -94,6 +181,504 @@ class EditLine(_editline.EditLineBase):
         self.commands[tag] = fcn
 
 
+    def add_function(self, name: str, fcn: callable,
+                     help_text: str = None) -> None:
+        """Add an editor function for keys to be bound to.
+
+        Args:
+            name: the function's name, for bind()
+            fcn: called as fcn(editline, key) when a key bound to it is
+                 typed, returns a CC_ value (None for CC_NORM)
+            help_text: (optional) description of the function
+
+        Returns:
+            Nothing
+
+        Its edits are drawn once it returns, as if made in a batch():
+
+            >>> el.add_function('ed-upper', upper)
+            >>> el.bind('^[u', 'ed-upper')
+
+        """
+        if fcn is None or not callable(fcn):
+            raise ValueError("Callback is invalid.")
+
+        self._add_function(name, help_text or name, len(self._key_functions))
+        self._key_functions.append(fcn)
+
+
+    def _key_function(self, slot: int, key: str) -> (int, None):
+        """Run the function bound to a key, called from the C code."""
+        return self._key_functions[slot](self, key)
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Make several edits and redisplay the line once.
+
+        insert_text(), delete_text() and redisplay() within the batch only
+        change the line, which is drawn once when the batch ends:
+
+            >>> with el.batch():
+            ...     el.delete_text(3)
+            ...     el.insert_text('.')
+
+        In the completer and in key functions the edits are drawn by the
+        refresh which follows them anyway.  As outside a batch, the edits
+        raise BufferError while a line_view() is held.
+
+        """
+        self._batch_begin()
+        try:
+            yield self
+        finally:
+            self._batch_end()
+
+
+    @classmethod
+    def headless(cls, name: str = 'headless', keys=b'', columns: int = 80,
+                 lines: int = 24, term: str = 'vt100') -> 'EditLine':
+        """Create an instance run from memory rather than a terminal.
+
+        Args:
+            name: a name for the instance to identify it
+            keys: keystrokes as bytes, or an iterable of bytes which is
+                  drawn on as readline() needs more (feed() adds more too)
+            columns: width of the screen it edits on
+            lines: height of the screen it edits on
+            term: terminal type the output is meant for
+
+        Returns:
+            EditLine class instance.
+
+        readline() reads the keystrokes, running them through the same
+        editing, history and completion as typing would, and returns ''
+        once they are used up.  What would have gone to the screen
+        collects in memory, see take_output().
+
+        libedit only edits on a terminal, so a pseudo-terminal is opened
+        for it to take its settings and the screen size from, but no
+        input or output goes through it.
+
+        """
+        master, streams = _open_pty(columns, lines)
+        try:
+            editline = cls(name, *streams)
+        except BaseException:
+            os.close(master)
+            raise
+        weakref.finalize(editline, os.close, master)
+
+        editline._headless(term)
+        editline.out_stream = _HeadlessOutput(editline)
+        editline._keys = iter([keys] if isinstance(keys, bytes) else keys)
+        return editline
+
+
+    def readline(self) -> str:
+        """Collect a line from the user.
+
+        Returns:
+            The line entered, '' at the end of input.
+
+        A headless instance edits with its keystrokes instead.
+
+        """
+        if self._keys is None:
+            return super().readline()
+
+        self._line_started()
+        self._feed_start()
+        try:
+            line = self._feed_line()
+            while line is None:
+                self.feed(next(self._keys, b''))
+                line = self._feed_line()
+            return line
+        finally:
+            self._feed_stop()
+
+
+    async def readline_async(self) -> str:
+        """Collect a line without tying up a thread.
+
+        Returns:
+            The line as readline() returns it, '' at the end of input.
+
+        The input stream's descriptor is watched by the running event
+        loop and whatever arrives is fed to libedit as it comes, so an
+        idle session costs neither a thread nor any CPU.  Input which
+        arrives after the end of a line is kept for the next one.
+
+        """
+        loop = asyncio.get_running_loop()
+        fd = self.in_stream.fileno()
+        done = loop.create_future()
+
+        def readable():
+            try:
+                data = os.read(fd, 4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            self.feed(data)
+            try:
+                line = self._feed_line()
+            except Exception as err:
+                if not done.done():
+                    done.set_exception(err)
+                return
+            if line is not None and not done.done():
+                done.set_result(line)
+
+        self._line_started()
+        self._feed_start()
+        try:
+            # what was typed ahead may finish the line already
+            line = self._feed_line()
+            if line is not None:
+                return line
+
+            loop.add_reader(fd, readable)
+            try:
+                return await done
+            finally:
+                loop.remove_reader(fd)
+        finally:
+            self._feed_stop()
+
+
+    def read_history_file(self, filename: str = None, shared: bool = False,
+                          pull_interval: float = None,
+                          max_entries: int = None,
+                          deferred: bool = False,
+                          sqlite: bool = False,
+                          index: bool = False) -> int:
+        """Load a history file.
+
+        Args:
+            filename: name of the history file
+            shared: keep the file in sync with other processes
+            pull_interval: (optional) seconds between pulls of entries
+                           other processes added (shared mode only)
+            max_entries: (optional) number of entries the file is trimmed
+                         to on write (shared mode only)
+            deferred: read the file in a background thread
+            sqlite: the file is an SQLite history database
+            index: keep a sidecar index of the (plain) file's entries
+
+        Returns:
+            Count of entries loaded or a negative value on failure.
+
+        The file is memory mapped and only the newest `history_size`
+        entries are loaded. Older ones stay in the file until
+        load_history_backlog() asks for them.  A compressed file (see
+        write_history_file()) is recognised by its header and read a block
+        at a time from the newest.
+
+        The sidecar index (the filename plus '.idx') records where each
+        entry of a plain file starts, so loading the newest entries (or
+        any others) is a single slice of the file.  It is made on the
+        first read, extended when the file was appended to and rewritten
+        along with the file.
+
+        In shared mode each accepted command is appended to the file as
+        soon as it is entered, instead of the whole history being written
+        out when the interpreter exits.
+
+        A deferred load returns 0 straight away.  The entries are merged in
+        ahead of any commands typed in the meantime once the thread is
+        done.  Shared files are always read immediately.
+
+        An SQLite database records every command as it is entered, along
+        with when, where and for how long it ran.  It is always read
+        immediately, needs its filename given and cannot be combined with
+        shared mode.
+
+        """
+        if sqlite:
+            if shared:
+                raise ValueError("An SQLite history cannot be in shared mode.")
+            if filename is None:
+                raise ValueError("An SQLite history needs a filename.")
+            if self._history_db is not None:
+                self._history_db.close()
+            self._history_db = SQLiteHistory(filename)
+            self._history_record = None
+            return self.add_history_entries(
+                self._history_db.newest(self.history_size))
+
+        self._history_pending = []
+        self._history_entering = None
+        self._history_appending = (not shared and
+                                   compressed_codec(filename) is not None)
+        self._history_indexed = index
+
+        if deferred and not shared:
+            self._merge_deferred_history(wait=True)
+            self._history_loader = threading.Thread(
+                target=self._deferred_history_load, args=(filename,),
+                name='editline-history', daemon=True)
+            self._history_loader.start()
+            return 0
+
+        if shared:
+            if self._shared_history is not None:
+                self._shared_history.close()
+            self._shared_history = SharedHistory(filename, pull_interval,
+                                                 max_entries)
+            entries = self._shared_history.load()
+            return self.add_history_entries(entries[-self.history_size:])
+
+        try:
+            backlog = open_history(filename, index)
+        except (OSError, ValueError, RuntimeError):
+            return -1
+
+        if self._history_backlog is not None:
+            self._history_backlog.close()
+        self._history_backlog = backlog
+
+        return self.add_history_entries(backlog.older(self.history_size))
+
+
+    def add_history_entry(self, cmd: str) -> int:
+        """Add a history entry directly.
+
+        Args:
+            cmd: the command
+
+        Returns:
+            Result of the libedit H_ENTER.
+
+        The entry is recorded in the SQLite history as well, if there is one.
+
+        """
+        if self._history_db is not None:
+            self._history_db.add(cmd, cwd=os.getcwd())
+        rv = super().add_history_entry(cmd)
+        if rv > 0:
+            self._history_kept(cmd)
+        return rv
+
+
+    def _history_kept(self, entry: str) -> None:
+        """Note an entry the history took, for the compressed file."""
+        if not self._history_appending:
+            return
+        pending = self._history_pending
+        if self.history_dedupe and entry in pending:
+            pending.remove(entry)
+        pending.append(entry)
+
+
+    def _history_entered(self) -> None:
+        """See whether the history kept the last line libedit entered.
+
+        H_SETUNIQUE drops a repeat of the newest entry, which shows as the
+        newest event staying what it was before the line.
+        """
+        entering, self._history_entering = self._history_entering, None
+        if entering is None:
+            return
+        line, before = entering
+        newest = None
+        if self.get_current_history_length() > 0:
+            newest = self.history(self.H_FIRST)
+        if newest is not None and newest[0] != before and newest[1] == line:
+            self._history_kept(line)
+
+
+    def load_history_backlog(self, count: int) -> int:
+        """Load older entries of the last history file read.
+
+        Args:
+            count: number of older entries to add
+
+        Returns:
+            Count of entries added.
+
+        The history grows to make room, so the entries already present are
+        kept.
+
+        """
+        self._merge_deferred_history(wait=True)
+
+        backlog = self._history_backlog
+        if backlog is None or backlog.exhausted:
+            return 0
+
+        entries = backlog.older(count)
+        if entries:
+            self._prepend_history(entries, grow=True)
+        return len(entries)
+
+
+    def _prepend_history(self, entries: list, grow: bool = False) -> None:
+        """Put entries ahead of (older than) the current history.
+
+        Args:
+            entries: history entries, oldest first
+            grow: enlarge history_size so nothing is dropped
+
+        """
+        # libedit only adds at the newest end, so rebuild it
+        current = self._history_entries()
+
+        total = len(entries) + len(current)
+        if grow and total > self.history_size:
+            self.history_size = total
+
+        self.history(self.H_CLEAR)
+        self.add_history_entries((entries + current)[-self.history_size:])
+
+
+    def _history_entries(self) -> list:
+        """Collect every entry of the history, oldest first."""
+        entries = []
+        event = None
+        if self.get_current_history_length() > 0:
+            event = self.history(self.H_LAST)
+        while event is not None:
+            entries.append(event[1])
+            event = self.history(self.H_PREV)
+        return entries
+
+
+    def _history_range(self) -> (tuple, None):
+        """Oldest and newest event numbers, counting a shared store's.
+
+        Returns None while there is no history at all.
+        """
+        base = len(self.history_store or ())
+        if self.get_current_history_length() > 0:
+            oldest = self.history(self.H_LAST)[0] + base
+            newest = self.history(self.H_FIRST)[0] + base
+            return (1 if base else oldest), newest
+        if base:
+            return 1, base
+        return None
+
+
+    def _deferred_history_load(self, filename: str) -> None:
+        """Thread body reading the history file (no libedit calls here)."""
+        try:
+            backlog = open_history(filename, self._history_indexed)
+        except (OSError, ValueError, RuntimeError):
+            self._history_loaded = (None, [])
+            return
+        self._history_loaded = (backlog, backlog.older(self.history_size))
+
+
+    def _merge_deferred_history(self, wait: bool = False) -> None:
+        """Fold the result of a background history load into the history.
+
+        Args:
+            wait: block until the load thread is done
+
+        Has to run on the thread which owns the instance since libedit
+        is not thread safe.
+
+        """
+        loader = self._history_loader
+        if loader is None:
+            return
+        if wait:
+            loader.join()
+        elif loader.is_alive():
+            return
+
+        backlog, entries = self._history_loaded
+        self._history_loader = None
+        self._history_loaded = None
+
+        if backlog is not None:
+            if self._history_backlog is not None:
+                self._history_backlog.close()
+            self._history_backlog = backlog
+
+        # lines entered while loading are newer than the file's
+        if entries:
+            self._prepend_history(entries)
+
+
+    def write_history_file(self, filename: str = None) -> int:
+        """Save the history to a file.
+
+        Args:
+            filename: name of the history file
+
+        Returns:
+            Count of entries written or a negative value on failure.
+
+        A shared history file already holds every command, so it is only
+        trimmed (merged with what the other processes wrote).  An SQLite
+        history needs nothing written at all.
+
+        A file named .z, .zz or .zlib (zlib) or .xz or .lzma (lzma), or one
+        which is compressed already, is written compressed in blocks.  When
+        it is the file the history was read from only the commands entered
+        since are compressed and appended, the rest of the file is left as
+        it is.
+
+        """
+        self._merge_deferred_history(wait=True)
+        self._history_entered()
+
+        # the database is written as the commands come in
+        database = self._history_db
+        if database is not None:
+            if (filename is None or os.path.realpath(filename) ==
+                    os.path.realpath(database.filename)):
+                return 0
+
+        shared = self._shared_history
+        if shared is None:
+            return self._save_history(filename)
+
+        if (filename is not None and
+                os.path.realpath(filename) != os.path.realpath(shared.filename)):
+            return self._save_history(filename)
+
+        shared.compact()
+        return 0
+
+
+    def _save_history(self, filename: str) -> int:
+        """Write the history in the format the file calls for."""
+        codec = None
+        if filename is not None:
+            codec = compressed_codec(filename)
+        if codec is None:
+            # the rewrite would pull the file out from under its mapping
+            backlog = self._history_backlog
+            if (backlog is not None and os.path.exists(filename) and
+                    os.path.samefile(backlog.filename, filename)):
+                backlog.close()
+                self._history_backlog = None
+
+            count = super().write_history_file(filename)
+            if count >= 0 and self._history_indexed:
+                try:
+                    write_index(filename)
+                except (OSError, ValueError):
+                    pass
+            return count
+
+        backlog = self._history_backlog
+        try:
+            if (isinstance(backlog, CompressedHistory) and
+                    os.path.exists(filename) and
+                    os.path.samefile(backlog.filename, filename)):
+                count = append_compressed(filename, self._history_pending)
+                self._history_pending = []
+                return count
+            return write_compressed(filename, self._history_entries(), codec)
+        except (OSError, ValueError, RuntimeError):
+            return -1
+
+
     def _basic_completer(self, text: str) -> list:
         """Very basic completion support.
 
@@ -159,8 +744,11 @@ class EditLine(_editline.EditLineBase):
         Returns:
             Nothing
 
+        The table is written with libedit's output, going out along with
+        the refresh which follows it.
+
         """
-        self.out_stream.write('\n')
+        table = ['\n']
 
         # alphebetize them...
         matches.sort()
@@ -183,9 +771,10 @@ class EditLine(_editline.EditLineBase):
             extra = '  '
             if (idx % per_line) == per_line-1:
                 extra = '\n'
-            self.out_stream.write(
+            table.append(
                 "{0:{width}}{1}".format(match, extra, width=maxlength))
-        self.out_stream.write('\n')
+        table.append('\n')
+        self._write_output(''.join(table))
 
 
     def show_history(self, args=None) -> None:
@@ -199,36 +788,117 @@ class EditLine(_editline.EditLineBase):
 
         This routine is called internally.
 
+        The arguments filter the list, in any order:
+
+            N           only the newest N commands
+            TEXT        only the commands containing TEXT
+            since=WHEN  only commands entered since WHEN, a date
+                        (2024-01-31) or an age (90m, 2h, 3d, 1w)
+            until=WHEN  only commands entered before WHEN
+            cwd=DIR     only commands run in DIR ('.' for the current one)
+
+        The time and directory filters need an SQLite history.  All of
+        them are served by indexes rather than a scan of every entry.
+
         """
-        # collect the current valid range
-        first_ev = self.history(self.H_FIRST)
-        last_ev = self.history(self.H_LAST)
+        # the whole list goes out in one write
+        self._write_output(''.join(self._history_listing(args)))
+        return None
+
 
-        # we'll always finish here...
-        finish = first_ev[0]
+    def _history_listing(self, args) -> iter:
+        """The lines show_history() writes."""
+        try:
+            count, text, filters = self._history_filters(args)
+        except ValueError as err:
+            yield "Invalid history filter: {0}\n".format(err)
+            return
+
+        if self._history_db is not None:
+            for record in self._history_db.query(contains=text, limit=count,
+                                                 **filters):
+                when = time.strftime('%Y-%m-%d %H:%M',
+                                     time.localtime(record.started))
+                yield "{0:5d}  {1}  {2}\n".format(record.id, when,
+                                                 record.entry.rstrip())
+            return
+
+        if filters:
+            yield "Time and directory filters need an SQLite history.\n"
+            return
+
+        # a search goes through the index rather than every entry
+        if text:
+            for event in reversed(self.history_search(text, count or 0)):
+                yield "{0:3d}  {1}\n".format(event[0], event[1].rstrip())
+            return
 
-        # start?  assume "the beginning"
-        idx = last_ev[0]
+        # collect the current valid range
+        span = self._history_range()
+        if span is None:
+            return
+
+        # start at "the beginning", we'll always finish at the newest
+        idx, finish = span
 
         # check the arg to see if it is a count of how many to display
-        if args is not None and args.isnumeric():
-            cnt = int(args)
-            if cnt < first_ev[0]-last_ev[0]:
-                idx = finish - cnt + 1
+        if count is not None:
+            if count < finish - idx:
+                idx = finish - count + 1
 
         # iterate through the list 'backwards' so the newest
         #   cmds are at the bottom
         while idx <= finish:
-            try:
-                event = self.history(self.H_PREV_EVENT, idx)
-                print("{0:3d}  {1}".format(event[0], event[1].rstrip()))
-            except ValueError:
-                pass    # probably should handle this better
-            finally:
-                idx += 1
+            event = self.history_event(idx)
+            if event is not None:
+                yield "{0:3d}  {1}\n".format(event[0], event[1].rstrip())
+            idx += 1
+
+
+    _age_re = re.compile(r'^(\d+(?:\.\d+)?)([smhdw])$')
+    _age_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+    def _parse_when(self, when: str) -> float:
+        """Translate a date or an age (2h, 3d, ...) to a time.time()."""
+        match = self._age_re.match(when)
+        if match:
+            age = float(match.group(1)) * self._age_units[match.group(2)]
+            return time.time() - age
+        return datetime.datetime.fromisoformat(when).timestamp()
 
-        # nothing for the parser to do
-        return None
+
+    def _history_filters(self, args: str) -> tuple:
+        """Split the ':history' arguments into (count, text, filters)."""
+        count = None
+        text = []
+        filters = {}
+
+        for arg in shlex.split(args or ''):
+            key, sep, value = arg.partition('=')
+            if sep and key in ('since', 'until'):
+                filters[key] = self._parse_when(value)
+            elif sep and key == 'cwd':
+                filters[key] = os.path.abspath(os.path.expanduser(value))
+            elif arg.isnumeric() and count is None:
+                count = int(arg)
+            else:
+                text.append(arg)
+
+        return count, ' '.join(text) or None, filters
+
+
+    def _line_started(self) -> None:
+        """Called from the C code as the interaction for a line begins."""
+        self._history_entered()
+
+        # a history file read in the background is ready to go
+        self._merge_deferred_history()
+
+        # the previous command has run its course
+        record = self._history_record
+        if record is not None:
+            self._history_record = None
+            self._history_db.finish(record[0], time.time() - record[1])
 
 
     def _run_command(self, cmd: str) -> (str, None):
@@ -237,9 +907,56 @@ class EditLine(_editline.EditLineBase):
         Args:
             cmd: private command to execute.
 
+        Returns:
+            The command line to pass on (and remember) or None if the
+            line was consumed.
+
         Is called from the C code upon completion of a line. Check
         for the existance of a "custom" command to implement
 
+        """
+        self._merge_deferred_history()
+
+        line = self._dispatch_command(cmd)
+
+        # the database notes when and where it ran
+        if (self._history_db is not None and isinstance(line, str) and
+                line.strip()):
+            started = time.time()
+            record_id = self._history_db.add(line, started, os.getcwd())
+            self._history_record = (record_id, started)
+
+        # libedit enters the line once this returns
+        if (self._history_appending and isinstance(line, str) and
+                line.strip()):
+            newest = None
+            if self.get_current_history_length() > 0:
+                newest = self.history(self.H_FIRST)[0]
+            self._history_entering = (line, newest)
+
+        # keep the shared history file in step
+        if self._shared_history is not None:
+            if isinstance(line, str) and line.strip():
+                others = self._shared_history.append([line])
+            else:
+                others = self._shared_history.pull()
+
+            # other sessions' lines land ahead of this one
+            for entry in others:
+                self.add_history_entry(entry)
+
+        return line
+
+
+    def _dispatch_command(self, cmd: str) -> (str, None):
+        """Decode and execute a 'private' command.
+
+        Args:
+            cmd: command line as typed
+
+        Returns:
+            The command line to pass on or None if the line was consumed.
+
         """
         # bail out immediately if no key
         if not cmd.startswith(self.command_token):
@@ -263,14 +980,13 @@ class EditLine(_editline.EditLineBase):
             #print("CMD: {:d}".format(idx))
 
             # get the valid range
-            first_ev = self.history(self.H_FIRST)
-            last_ev = self.history(self.H_LAST)
+            oldest, newest = self._history_range() or (0, 0)
 
             # make sure the requested history item is possible
-            if first_ev[0] >= idx >= last_ev[0]:
+            if newest >= idx >= oldest:
 
                 # look up the historic command by number
-                event = self.history(self.H_PREV_EVENT, idx)
+                event = self.history_event(idx)
                 if event is None:
                     return None
 
@@ -278,8 +994,9 @@ class EditLine(_editline.EditLineBase):
                 return event[1]
 
             # improper index
-            print("Invalid history id: {:d}. Range is {:d} -> {:d}"
-                  .format(idx, first_ev[0], last_ev[0]))
+            self._write_output(
+                "Invalid history id: {:d}. Range is {:d} -> {:d}\n"
+                .format(idx, newest, oldest))
 
         # command decode...
         elif base_cmd in self.commands:
@@ -288,7 +1005,7 @@ class EditLine(_editline.EditLineBase):
 
         # hmm. if we get here, it is an unknown infra cmd
         #   Error?  Certainly mark that it is consumed
-        print("Invalid line-editor command.")
+        self._write_output("Invalid line-editor command.\n")
         return None
 
 
@@ -0,0 +1,1150 @@
+"""
+History file support
+
+Provides Python level access to the history file format written by libedit
+so that history can be managed outside of the plain H_LOAD/H_SAVE calls.
+
+    - encoding/decoding of history file entries (libedit uses strvis(3))
+    - memory mapped loading of only the newest part of big history files
+    - a sidecar index of where each entry of a history file starts
+    - compressed history files made of independently compressed blocks
+    - shared history files which are safe for multiple processes
+    - an SQLite history store which keeps when and where each command ran
+
+"""
+
+import os
+import re
+import sys
+import stat
+import time
+import mmap
+import uuid
+import fcntl
+import struct
+import binascii
+import tempfile
+import itertools
+from array import array
+from collections import namedtuple
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+__all__ = ["HISTORY_COOKIE", "HISTORY_ZCOOKIE", "encode_entry",
+           "decode_entry", "INDEX_SUFFIX", "write_index", "MappedHistory",
+           "CompressedHistory",
+           "open_history", "compressed_codec", "write_compressed",
+           "append_compressed", "SharedHistory", "HistoryRecord",
+           "SQLiteHistory"]
+
+HISTORY_COOKIE = b'_HiStOrY_V2_\n'
+"""(bytes) - The header line libedit requires on a history file."""
+
+HISTORY_ZCOOKIE = b'_HiStOrY_Z1_'
+"""(bytes) - Start of the header line of a compressed history file."""
+
+_ENCODING = 'utf-8'
+_ERRORS = 'surrogateescape'
+
+# the C-style escapes which strunvis(3) understands
+_CSTYLE = {
+    'n': '\n', 'r': '\r', 'b': '\b', 'a': '\a', 'v': '\v',
+    't': '\t', 'f': '\f', 's': ' ', 'E': '\033', '0': '\0'
+}
+
+# match every escape form strvis(3) can produce
+_unvis_re = re.compile(r'''
+    \\(?:
+        ([0-7]{1,3})          # octal
+      | M\^(.)                # meta-control
+      | M-(.)                 # meta
+      | \^(.)                 # control
+      | (.)                   # C-style or a plain escaped char
+    )
+''', re.VERBOSE | re.DOTALL)
+
+
+def _unvis_sub(match) -> str:
+    """Translate one strvis(3) escape sequence."""
+    octal, meta_ctrl, meta, ctrl, other = match.groups()
+    if octal is not None:
+        return chr(int(octal, 8))
+    if meta_ctrl is not None:
+        return chr((ord(meta_ctrl) & 0x1f) | 0x80)
+    if meta is not None:
+        return chr(ord(meta) | 0x80)
+    if ctrl is not None:
+        return '\177' if ctrl == '?' else chr(ord(ctrl) & 0x1f)
+    return _CSTYLE.get(other, other)
+
+
+def encode_entry(text: str) -> bytes:
+    """Encode a history entry the way libedit's H_SAVE does.
+
+    Args:
+        text: the history entry (usually with its trailing newline)
+
+    Returns:
+        A single line of bytes, including the line terminator.
+
+    libedit uses strvis(3) with VIS_WHITE, so whitespace and control
+    characters are written as octal escapes.
+
+    """
+    chars = []
+    for char in text:
+        if char == '\\':
+            chars.append('\\\\')
+        elif char <= ' ' or char == '\177':
+            chars.append('\\{0:03o}'.format(ord(char)))
+        else:
+            chars.append(char)
+    chars.append('\n')
+    return ''.join(chars).encode(_ENCODING, _ERRORS)
+
+
+def decode_entry(line: bytes) -> str:
+    """Decode a single line of a history file.
+
+    Args:
+        line: raw line from the file, with or without the line terminator
+
+    Returns:
+        The history entry as it would be loaded by H_LOAD.
+
+    """
+    text = line.decode(_ENCODING, _ERRORS)
+    if text.endswith('\n'):
+        text = text[:-1]
+    if '\\' not in text:
+        return text
+    return _unvis_re.sub(_unvis_sub, text)
+
+
+INDEX_SUFFIX = '.idx'
+"""(str) - Added to a history file's name to name its sidecar index."""
+
+# the sidecar: a header line (naming the byte order), the state of the
+# history file it describes, then the offset of every entry in native
+# order.  The checksum covers the bytes ahead of the end it knows about,
+# so a file which was only appended to can be told from a rewritten one.
+_INDEX_COOKIE = (b'_HiStOrY_IDX01' +
+                 (b'<' if sys.byteorder == 'little' else b'>') + b'\n')
+_INDEX_HEAD = struct.Struct('=QqQI4x')  # size, mtime_ns, entries, crc
+_INDEX_DATA = len(_INDEX_COOKIE) + _INDEX_HEAD.size
+_INDEX_CRC_SPAN = 4096
+_SCAN_CHUNK = 1 << 22
+
+
+def _line_starts(data: bytes, start: int, end: int) -> array:
+    """Offsets of the lines beginning between start and end."""
+    offsets = array('Q')
+    if start >= end:
+        return offsets
+
+    # each line ends one past its length
+    offsets.append(start)
+    for base in range(start, end, _SCAN_CHUNK):
+        lines = data[base:min(end, base + _SCAN_CHUNK)].split(b'\n')
+        lines.pop()
+        ends = itertools.accumulate(
+            itertools.chain((base,), (len(line) + 1 for line in lines)))
+        offsets.extend(itertools.islice(ends, 1, None))
+
+    # a newline at the very end does not start a line
+    if offsets[-1] == end:
+        offsets.pop()
+    return offsets
+
+
+def _index_crc(data: bytes, end: int) -> int:
+    """Checksum of the bytes ahead of `end`."""
+    return binascii.crc32(data[max(0, end - _INDEX_CRC_SPAN):end])
+
+
+def _refresh_index(filename: str, data: bytes, mtime: int) -> (array, None):
+    """Bring the sidecar index of a mapped history file up to date.
+
+    An index which is current is left alone and one for a file which has
+    only been appended to is extended, anything else is rebuilt.
+
+    Returns:
+        None once the sidecar is current, or the offsets themselves when
+        it cannot be written.
+
+    """
+    size = len(data)
+    start = len(HISTORY_COOKIE)
+
+    # the offsets give away as much as the file's, it is no more readable
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+        fd = os.open(filename + INDEX_SUFFIX, os.O_RDWR | os.O_CREAT, mode)
+    except OSError:
+        return _line_starts(data, start, size)
+
+    with os.fdopen(fd, 'r+b') as fp:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        # the umask or an older sidecar may have left it otherwise
+        if stat.S_IMODE(os.fstat(fd).st_mode) != mode:
+            try:
+                os.fchmod(fd, mode)
+            except OSError:
+                pass
+
+        state = None
+        header = fp.read(_INDEX_DATA)
+        if len(header) == _INDEX_DATA and header.startswith(_INDEX_COOKIE):
+            state = _INDEX_HEAD.unpack_from(header, len(_INDEX_COOKIE))
+
+        if state is not None:
+            known, stamp, count, crc = state
+            if known == size and stamp == mtime:
+                return None
+            if (start <= known <= size and data[known - 1] == 0x0a and
+                    _index_crc(data, known) == crc):
+                offsets = _line_starts(data, known, size)
+                position = _INDEX_DATA + count * offsets.itemsize
+                count += len(offsets)
+            else:
+                state = None
+
+        if state is None:
+            offsets = _line_starts(data, start, size)
+            position = _INDEX_DATA
+            count = len(offsets)
+
+        try:
+            fp.seek(position)
+            offsets.tofile(fp)
+            fp.truncate()
+            fp.seek(0)
+            fp.write(_INDEX_COOKIE)
+            fp.write(_INDEX_HEAD.pack(size, mtime, count,
+                                      _index_crc(data, size)))
+        except OSError:
+            if state is not None:
+                offsets = _line_starts(data, start, size)
+            return offsets
+
+    return None
+
+
+def write_index(filename: str) -> int:
+    """Write (or update) the sidecar index of a history file.
+
+    Args:
+        filename: name of the (libedit format) history file
+
+    Returns:
+        Count of entries in the file.
+
+    Raises:
+        ValueError: the file is not a libedit history file
+
+    """
+    history = MappedHistory(filename, index=True)
+    try:
+        return len(history)
+    finally:
+        history.close()
+
+
+class MappedHistory(object):
+    """Read-only, memory mapped view of a history file.
+
+    Entries are handed out newest first, in chunks, by scanning backwards
+    for line boundaries.  Only the part of the file that is asked for is
+    ever touched, so the cost of loading the newest entries does not
+    depend on the size of the file.
+
+    With an index the file's sidecar (the name plus INDEX_SUFFIX) holds
+    the offset of every entry, so a chunk is a single slice of the file and
+    any entry can be fetched by its position.  The sidecar is made the
+    first time, then only extended while the file grows by appending.
+
+    Args:
+        filename: name of the (libedit format) history file
+        index: use (and maintain) the sidecar index
+
+    Raises:
+        ValueError: the file is not a libedit history file
+
+    """
+
+    def __init__(self, filename: str, index: bool = False):
+        self.filename = filename
+        self._map = None
+        self._offsets = None
+        self._index_map = None
+
+        with open(filename, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            size = stat.st_size
+            if size < len(HISTORY_COOKIE):
+                raise ValueError("'{0}' is not a history file"
+                                 .format(filename))
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(HISTORY_COOKIE)] != HISTORY_COOKIE:
+            self.close()
+            raise ValueError("'{0}' is not a history file".format(filename))
+
+        # everything between the cookie and the cursor is still unread
+        self._start = len(HISTORY_COOKIE)
+        self._cursor = size
+
+        if index:
+            self._open_index(stat.st_mtime_ns)
+
+    def __del__(self):
+        self.close()
+
+    def _open_index(self, mtime: int) -> None:
+        """Map the offsets held by the sidecar index."""
+        offsets = _refresh_index(self.filename, self._map, mtime)
+        if offsets is None:
+            with open(self.filename + INDEX_SUFFIX, 'rb') as fp:
+                self._index_map = mmap.mmap(fp.fileno(), 0,
+                                            access=mmap.ACCESS_READ)
+            count = _INDEX_HEAD.unpack_from(self._index_map,
+                                            len(_INDEX_COOKIE))[2]
+            end = _INDEX_DATA + count * 8
+            offsets = memoryview(self._index_map)[_INDEX_DATA:end].cast('Q')
+
+        self._offsets = offsets
+        # entries from this one on have been handed out
+        self._next = len(offsets)
+
+    def close(self) -> None:
+        """Release the mapping."""
+        if isinstance(getattr(self, '_offsets', None), memoryview):
+            self._offsets.release()
+        self._offsets = None
+        if getattr(self, '_index_map', None) is not None:
+            self._index_map.close()
+            self._index_map = None
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self) -> int:
+        """Count of entries in the file (needs the index)."""
+        if self._offsets is None:
+            raise ValueError("'{0}' is not indexed".format(self.filename))
+        return len(self._offsets)
+
+    def entry(self, position: int) -> str:
+        """Fetch one entry (needs the index).
+
+        Args:
+            position: place of the entry in the file, 0 for the oldest
+
+        Returns:
+            The history entry.
+
+        Raises:
+            IndexError: there is no such entry
+
+        """
+        count = len(self)
+        if position < 0:
+            position += count
+        if not 0 <= position < count:
+            raise IndexError("history entry out of range")
+        return decode_entry(self._map[self._offsets[position]:
+                                      self._entry_end(position)])
+
+    def _entry_end(self, position: int) -> int:
+        """Offset just past an entry (and its line terminator)."""
+        if position + 1 < len(self._offsets):
+            return self._offsets[position + 1]
+        return len(self._map)
+
+    @property
+    def exhausted(self) -> bool:
+        """(bool) - True once every entry has been handed out."""
+        return self._map is None or self._cursor <= self._start
+
+    def older(self, count: int) -> list:
+        """Collect the next `count` entries, working back from the newest.
+
+        Args:
+            count: maximum number of entries to return
+
+        Returns:
+            List of history entries, oldest first.
+
+        """
+        if self.exhausted:
+            return []
+
+        # the index knows exactly where the chunk is
+        if self._offsets is not None:
+            last = self._next
+            first = max(0, last - count)
+            self._next = first
+            self._cursor = self._offsets[first]
+            data = self._map[self._cursor:self._entry_end(last - 1)]
+            if data.endswith(b'\n'):
+                data = data[:-1]
+            return [decode_entry(line) for line in data.split(b'\n')]
+
+        mapped = self._map
+        start = self._start
+        pos = self._cursor
+        lines = []
+
+        # a line terminator belongs to the line in front of it
+        if mapped[pos - 1] == 0x0a:
+            pos -= 1
+
+        while len(lines) < count and pos >= start:
+            newline = mapped.rfind(b'\n', start, pos)
+            lines.append(mapped[newline + 1 if newline >= 0 else start:pos])
+            pos = newline if newline >= 0 else start - 1
+
+        self._cursor = max(pos + 1, start)
+
+        lines.reverse()
+        return [decode_entry(line) for line in lines]
+
+
+# compressed files: the cookie, a codec tag and a newline, then blocks of
+#   <payload size> <entry count> <payload> <payload size>
+# where the payload is the compressed lines of the plain format.  The size
+# is repeated at the end so the blocks can be walked from the newest.
+_ZHEADER_SIZE = len(HISTORY_ZCOOKIE) + 2
+_BLOCK_HEAD = struct.Struct('<II')
+_BLOCK_TAIL = struct.Struct('<I')
+_BLOCK_ENTRIES = 1024
+
+_CODECS = {b'z': zlib, b'x': lzma}
+_EXTENSIONS = {
+    '.z': b'z', '.zz': b'z', '.zlib': b'z',
+    '.xz': b'x', '.lzma': b'x'
+}
+
+
+def _codec(tag: bytes, filename: str) -> object:
+    """Find the module for a codec tag."""
+    if tag not in _CODECS:
+        raise ValueError("'{0}' is not a history file".format(filename))
+    module = _CODECS[tag]
+    if module is None:
+        raise RuntimeError("'{0}' needs the {1} module"
+                           .format(filename, 'zlib' if tag == b'z' else 'lzma'))
+    return module
+
+
+def _read_zheader(fd: int, filename: str) -> bytes:
+    """Check the header line of a compressed file, returning its codec."""
+    header = os.pread(fd, _ZHEADER_SIZE, 0)
+    if (len(header) != _ZHEADER_SIZE or
+            not header.startswith(HISTORY_ZCOOKIE) or
+            not header.endswith(b'\n')):
+        raise ValueError("'{0}' is not a history file".format(filename))
+    tag = header[len(HISTORY_ZCOOKIE):-1]
+    _codec(tag, filename)
+    return tag
+
+
+def _block_at_end(fd: int, end: int) -> tuple:
+    """Locate the block finishing at `end` as (start, header) or None."""
+    if end - _ZHEADER_SIZE < _BLOCK_HEAD.size + _BLOCK_TAIL.size:
+        return None
+    tail = os.pread(fd, _BLOCK_TAIL.size, end - _BLOCK_TAIL.size)
+    if len(tail) != _BLOCK_TAIL.size:
+        return None
+    length, = _BLOCK_TAIL.unpack(tail)
+    start = end - _BLOCK_TAIL.size - length - _BLOCK_HEAD.size
+    if start < _ZHEADER_SIZE:
+        return None
+    head = os.pread(fd, _BLOCK_HEAD.size, start)
+    if len(head) != _BLOCK_HEAD.size or _BLOCK_HEAD.unpack(head)[0] != length:
+        return None
+    return start, _BLOCK_HEAD.unpack(head)
+
+
+def _intact_end(fd: int, size: int) -> int:
+    """Offset past the last whole block.
+
+    Only a write cut short leaves anything else at the end of the file, so
+    the blocks are walked from the front only when the last one is torn.
+
+    """
+    if size == _ZHEADER_SIZE or _block_at_end(fd, size) is not None:
+        return size
+
+    pos = _ZHEADER_SIZE
+    while pos + _BLOCK_HEAD.size <= size:
+        head = _BLOCK_HEAD.unpack(os.pread(fd, _BLOCK_HEAD.size, pos))
+        end = pos + _BLOCK_HEAD.size + head[0] + _BLOCK_TAIL.size
+        if end > size or _block_at_end(fd, end) != (pos, head):
+            break
+        pos = end
+    return pos
+
+
+def _encode_block(tag: bytes, lines: bytes, count: int) -> bytes:
+    """Compress encoded history lines into a block."""
+    payload = _CODECS[tag].compress(lines)
+    return (_BLOCK_HEAD.pack(len(payload), count) + payload +
+            _BLOCK_TAIL.pack(len(payload)))
+
+
+def compressed_codec(filename: str) -> (bytes, None):
+    """Work out whether a history file is (to be) compressed.
+
+    Args:
+        filename: name of the history file
+
+    Returns:
+        The codec tag, b'z' for zlib or b'x' for lzma, or None for a plain
+        history file.
+
+    A file which already has content is judged by its header line, a new
+    (or empty) one by its extension: .z, .zz or .zlib for zlib and .xz or
+    .lzma for lzma.
+
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            header = fp.read(_ZHEADER_SIZE)
+    except OSError:
+        header = b''
+
+    if header:
+        if (header.startswith(HISTORY_ZCOOKIE) and
+                len(header) == _ZHEADER_SIZE):
+            return header[len(HISTORY_ZCOOKIE):-1]
+        return None
+
+    return _EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+class CompressedHistory(object):
+    """Read-only view of a compressed history file.
+
+    The same interface as MappedHistory.  Blocks are read and decompressed
+    one at a time working back from the end of the file, so loading the
+    newest entries only reads the last block or two.
+
+    Args:
+        filename: name of the compressed history file
+
+    Raises:
+        ValueError: the file is not a compressed history file
+        RuntimeError: the codec of the file is not available
+
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._fd = None
+        self._lines = []
+
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            self._codec = _codec(_read_zheader(fd, filename), filename)
+            self._cursor = _intact_end(fd, os.fstat(fd).st_size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def __del__(self):
+        self.close()
+
+    def close(self) -> None:
+        """Release the file handle."""
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def exhausted(self) -> bool:
+        """(bool) - True once every entry has been handed out."""
+        return self._fd is None or (not self._lines and
+                                    self._cursor <= _ZHEADER_SIZE)
+
+    def _previous_block(self) -> list:
+        """Decompress the block ahead of the cursor into raw lines."""
+        block = _block_at_end(self._fd, self._cursor)
+        if block is None:
+            self._cursor = _ZHEADER_SIZE
+            return []
+
+        start, (length, count) = block
+        payload = os.pread(self._fd, length, start + _BLOCK_HEAD.size)
+        try:
+            lines = self._codec.decompress(payload).split(b'\n')[:-1]
+        except Exception:
+            lines = None
+        if lines is None or len(lines) != count:
+            self._cursor = _ZHEADER_SIZE
+            return []
+
+        self._cursor = start
+        return lines
+
+    def older(self, count: int) -> list:
+        """Collect the next `count` entries, working back from the newest.
+
+        Args:
+            count: maximum number of entries to return
+
+        Returns:
+            List of history entries, oldest first.
+
+        """
+        chunks = []
+        while count > 0 and not self.exhausted:
+            if not self._lines:
+                self._lines = self._previous_block()
+                continue
+            chunk = self._lines[-count:]
+            del self._lines[-count:]
+            chunks.append(chunk)
+            count -= len(chunk)
+
+        chunks.reverse()
+        return [decode_entry(line) for chunk in chunks for line in chunk]
+
+
+def open_history(filename: str,
+                 index: bool = False) -> (MappedHistory, CompressedHistory):
+    """Open a plain or compressed history file, whichever it is.
+
+    Args:
+        filename: name of the history file
+        index: use the sidecar index of a plain file
+
+    Returns:
+        A CompressedHistory or MappedHistory for the file.
+
+    """
+    with open(filename, 'rb') as fp:
+        compressed = fp.read(len(HISTORY_ZCOOKIE)) == HISTORY_ZCOOKIE
+    if compressed:
+        return CompressedHistory(filename)
+    return MappedHistory(filename, index)
+
+
+def write_compressed(filename: str, entries: list,
+                     codec: bytes = b'z') -> int:
+    """Write a compressed history file, replacing any existing one.
+
+    Args:
+        filename: name of the history file
+        entries: history entries, oldest first
+        codec: b'z' for zlib or b'x' for lzma
+
+    Returns:
+        Count of entries written.
+
+    The file is written aside and renamed into place.
+
+    """
+    _codec(codec, filename)
+    data = [HISTORY_ZCOOKIE + codec + b'\n']
+    for first in range(0, len(entries), _BLOCK_ENTRIES):
+        chunk = entries[first:first + _BLOCK_ENTRIES]
+        lines = b''.join(encode_entry(entry) for entry in chunk)
+        data.append(_encode_block(codec, lines, len(chunk)))
+
+    temp = '{0}.{1}.tmp'.format(filename, os.getpid())
+    try:
+        with open(temp, 'wb') as fp:
+            fp.write(b''.join(data))
+        os.replace(temp, filename)
+    except OSError:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+    return len(entries)
+
+
+def append_compressed(filename: str, entries: list) -> int:
+    """Add entries to the end of a compressed history file.
+
+    Args:
+        filename: name of the history file, created if need be
+        entries: history entries, oldest first
+
+    Returns:
+        Count of entries written.
+
+    The entries go in new blocks after the last whole one, the blocks
+    already written are never touched, so a write cut short loses no more
+    than the entries being added.  The file is locked with flock(2) while
+    it changes.  Each append makes a block of its own, write_compressed()
+    packs them when the file is next rewritten.
+
+    """
+    if not entries:
+        return 0
+
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        size = os.fstat(fd).st_size
+        if size == 0:
+            tag = compressed_codec(filename) or b'z'
+            _codec(tag, filename)
+            os.write(fd, HISTORY_ZCOOKIE + tag + b'\n')
+            size = _ZHEADER_SIZE
+        else:
+            tag = _read_zheader(fd, filename)
+
+        # anything past the last whole block is a torn write
+        end = _intact_end(fd, size)
+        data = []
+        for first in range(0, len(entries), _BLOCK_ENTRIES):
+            chunk = entries[first:first + _BLOCK_ENTRIES]
+            lines = b''.join(encode_entry(entry) for entry in chunk)
+            data.append(_encode_block(tag, lines, len(chunk)))
+        data = b''.join(data)
+
+        os.pwrite(fd, data, end)
+        os.ftruncate(fd, end + len(data))
+    finally:
+        os.close(fd)
+
+    return len(entries)
+
+
+# ends a file compact() replaced, strvis() never leaves a NUL in an entry
+_COMPACTED = b'\0compacted '
+
+
+class SharedHistory(object):
+    """History file shared safely between many processes.
+
+    Rather than rewriting the whole file when the interpreter exits (and
+    clobbering every other session's history) each accepted command is
+    appended to the file immediately.  The file is locked with flock(2)
+    only for the time it takes to collect the lines other sessions have
+    written since the last visit and to append the new one.
+
+    Args:
+        filename: name of the (libedit format) history file
+        pull_interval: (optional) seconds between pulls of other sessions'
+                       new lines.  None only pulls when appending.
+        max_entries: (optional) number of entries to keep when the file
+                     is compacted.  None never compacts the file.
+
+    """
+
+    def __init__(self, filename: str, pull_interval: float = None,
+                 max_entries: int = None):
+        self.filename = filename
+        self.pull_interval = pull_interval
+        self.max_entries = max_entries
+
+        # everything before this offset has been seen by this session
+        self._offset = 0
+        self._last_pull = 0.0
+        self._carried = []
+        self._fd = self._open()
+
+    def __del__(self):
+        self.close()
+
+    def close(self) -> None:
+        """Release the file handle."""
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _open(self) -> int:
+        return os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                       0o600)
+
+    def _replaced(self) -> bool:
+        """Whether the file was compacted into a new one since it was opened."""
+        try:
+            current = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        held = os.fstat(self._fd)
+        return (current.st_ino, current.st_dev) != (held.st_ino, held.st_dev)
+
+    def _lock(self, how: int) -> None:
+        fcntl.flock(self._fd, how)
+
+        # compact() renames a new file over the old one, anything appended
+        # to the old one before that is still to be read from it, then the
+        # new one is read on from the end of what compact() wrote there
+        while self._replaced():
+            lines = self._read_new()
+            compacted = None
+            if lines and lines[-1].startswith(_COMPACTED):
+                compacted = int(lines.pop()[len(_COMPACTED):])
+            self._carried += lines
+
+            self._unlock()
+            os.close(self._fd)
+            self._fd = self._open()
+            fcntl.flock(self._fd, how)
+            size = os.fstat(self._fd).st_size
+            self._offset = size if compacted is None else min(compacted, size)
+
+    def _unlock(self) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read_new(self) -> list:
+        """Collect complete lines past the known offset (must be locked)."""
+        lines, self._carried = self._carried, []
+        size = os.fstat(self._fd).st_size
+
+        # truncated underneath us, start over at the end
+        if size < self._offset:
+            self._offset = size
+            return lines
+
+        if size == self._offset:
+            return lines
+
+        data = os.pread(self._fd, size - self._offset, self._offset)
+
+        # only take whole lines -- a writer may be mid-way through one
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        return lines + data[:end].splitlines()
+
+    def load(self) -> list:
+        """Read the whole file.
+
+        Returns:
+            List of history entries, oldest first.
+
+        """
+        self._last_pull = time.monotonic()
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._offset = 0
+            self._carried = []
+            lines = self._read_new()
+            if not lines:
+                os.write(self._fd, HISTORY_COOKIE)
+                self._offset = len(HISTORY_COOKIE)
+                return []
+        finally:
+            self._unlock()
+
+        if lines[0] + b'\n' != HISTORY_COOKIE:
+            raise ValueError("'{0}' is not a history file"
+                             .format(self.filename))
+
+        return [decode_entry(line) for line in lines[1:]]
+
+    def pull(self, force: bool = False) -> list:
+        """Collect the lines other sessions appended since the last visit.
+
+        Args:
+            force: ignore the pull interval
+
+        Returns:
+            List of new history entries, oldest first.
+
+        """
+        if not force:
+            if self.pull_interval is None:
+                return []
+            if time.monotonic() - self._last_pull < self.pull_interval:
+                return []
+
+        self._lock(fcntl.LOCK_SH)
+        try:
+            lines = self._read_new()
+        finally:
+            self._unlock()
+
+        self._last_pull = time.monotonic()
+        return [decode_entry(line) for line in lines]
+
+    def append(self, entries: list) -> list:
+        """Append entries to the file.
+
+        Args:
+            entries: history entries to add
+
+        Returns:
+            List of entries other sessions added ahead of these ones.
+
+        """
+        data = b''.join(encode_entry(entry) for entry in entries)
+
+        self._lock(fcntl.LOCK_EX)
+        try:
+            lines = self._read_new()
+            os.write(self._fd, data)
+            self._offset = os.fstat(self._fd).st_size
+        finally:
+            self._unlock()
+
+        self._last_pull = time.monotonic()
+        return [decode_entry(line) for line in lines]
+
+    def compact(self) -> None:
+        """Trim the file down to the newest `max_entries` entries.
+
+        Nothing happens unless the file has grown past twice that size,
+        so the (locked) rewrite is rare.  The entries kept are written to
+        a new file which is renamed over the old one, so a session reading
+        the old file never sees it half rewritten.
+
+        """
+        capacity = self.max_entries
+        if capacity is None:
+            return
+
+        self._lock(fcntl.LOCK_EX)
+        try:
+            info = os.fstat(self._fd)
+            lines = os.pread(self._fd, info.st_size, 0).splitlines(
+                keepends=True)
+            if len(lines) - 1 <= 2 * capacity:
+                return
+
+            # entries past the offset are still this session's to pull
+            self._carried += self._read_new()
+
+            data = HISTORY_COOKIE + b''.join(lines[-capacity:])
+            directory, name = os.path.split(os.path.abspath(self.filename))
+            fd, temp = tempfile.mkstemp(prefix=name + '.', dir=directory)
+            try:
+                os.fchmod(fd, stat.S_IMODE(info.st_mode))
+                os.write(fd, data)
+                os.fsync(fd)
+            except BaseException:
+                os.close(fd)
+                os.unlink(temp)
+                raise
+            os.close(fd)
+            os.replace(temp, self.filename)
+
+            # only sessions still holding the old file can read this
+            os.write(self._fd, _COMPACTED + str(len(data)).encode() + b'\n')
+        finally:
+            self._unlock()
+
+
+HistoryRecord = namedtuple('HistoryRecord',
+                           'id entry started duration cwd session')
+HistoryRecord.__doc__ = """A command kept by SQLiteHistory.
+
+started is the time.time() the command was entered and duration the
+seconds until the next prompt (None until it is known).
+"""
+
+
+class SQLiteHistory(object):
+    """History kept in an SQLite database.
+
+    Each command is stored with the time it was entered, how long it ran,
+    the working directory and the session which entered it.  Queries by
+    time range, directory or substring are served by indexes -- the
+    substring one by a trigram full text index where SQLite provides it.
+
+    The database runs in WAL mode so any number of interpreters can add
+    to it while others read.
+
+    Args:
+        filename: name of the database file
+        session: (optional) id for this session's commands.  A unique
+                 one is made up if not given.
+
+    Raises:
+        RuntimeError: Python was built without sqlite3
+
+    """
+
+    _schema = (
+        """CREATE TABLE IF NOT EXISTS history (
+               id INTEGER PRIMARY KEY,
+               entry TEXT NOT NULL,
+               started REAL NOT NULL,
+               duration REAL,
+               cwd TEXT,
+               session TEXT NOT NULL)""",
+        """CREATE INDEX IF NOT EXISTS history_started
+               ON history (started)""",
+        """CREATE INDEX IF NOT EXISTS history_cwd
+               ON history (cwd, started)""",
+        """CREATE INDEX IF NOT EXISTS history_session
+               ON history (session, started)""",
+    )
+
+    _text_schema = (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS history_text
+               USING fts5(entry, content='history', content_rowid='id',
+                          tokenize='trigram')""",
+        """CREATE TRIGGER IF NOT EXISTS history_text_add
+               AFTER INSERT ON history BEGIN
+                   INSERT INTO history_text (rowid, entry)
+                       VALUES (new.id, new.entry);
+               END""",
+        """CREATE TRIGGER IF NOT EXISTS history_text_del
+               AFTER DELETE ON history BEGIN
+                   INSERT INTO history_text (history_text, rowid, entry)
+                       VALUES ('delete', old.id, old.entry);
+               END""",
+    )
+
+    def __init__(self, filename: str, session: str = None):
+        if sqlite3 is None:
+            raise RuntimeError("SQLite history needs the sqlite3 module")
+
+        self.filename = filename
+        self.session = session or uuid.uuid4().hex
+
+        self._db = sqlite3.connect(filename, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        with self._db:
+            for statement in self._schema:
+                self._db.execute(statement)
+
+        # the trigram tokenizer arrived in SQLite 3.34
+        self._text_index = True
+        try:
+            with self._db:
+                for statement in self._text_schema:
+                    self._db.execute(statement)
+        except sqlite3.OperationalError:
+            self._text_index = False
+
+    def __del__(self):
+        self.close()
+
+    def close(self) -> None:
+        """Release the database."""
+        if getattr(self, '_db', None) is not None:
+            self._db.close()
+            self._db = None
+
+    def add(self, entry: str, started: float = None,
+            cwd: str = None) -> int:
+        """Record a command.
+
+        Args:
+            entry: the command
+            started: (optional) time.time() it was entered, default now
+            cwd: (optional) working directory it ran in
+
+        Returns:
+            The id of the record.
+
+        """
+        if started is None:
+            started = time.time()
+        cursor = self._db.execute(
+            'INSERT INTO history (entry, started, cwd, session) '
+            'VALUES (?, ?, ?, ?)', (entry, started, cwd, self.session))
+        return cursor.lastrowid
+
+    def finish(self, record_id: int, duration: float) -> None:
+        """Note how long a command ran.
+
+        Args:
+            record_id: id returned by add()
+            duration: seconds the command took
+
+        """
+        self._db.execute('UPDATE history SET duration = ? WHERE id = ?',
+                         (duration, record_id))
+
+    def newest(self, count: int) -> list:
+        """Collect the newest commands.
+
+        Args:
+            count: maximum number of commands
+
+        Returns:
+            List of commands, oldest first.
+
+        """
+        rows = self._db.execute(
+            'SELECT entry FROM history ORDER BY started DESC, id DESC '
+            'LIMIT ?', (count,)).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def query(self, contains: str = None, cwd: str = None,
+              since: float = None, until: float = None,
+              session: str = None, limit: int = None) -> list:
+        """Find commands.
+
+        Args:
+            contains: (optional) text the command must contain, case and
+                      all (as EditLine.history_search() matches it)
+            cwd: (optional) directory the command ran in
+            since: (optional) earliest time.time() it was entered
+            until: (optional) latest time.time() it was entered
+            session: (optional) session which entered it
+            limit: (optional) maximum number of records, the newest win
+
+        Returns:
+            List of HistoryRecord, oldest first.
+
+        """
+        sql, params = self._query_sql(contains, cwd, since, until, session,
+                                      limit)
+        rows = self._db.execute(sql, params).fetchall()
+        return [HistoryRecord(*row) for row in reversed(rows)]
+
+    def _query_sql(self, contains: str, cwd: str, since: float,
+                   until: float, session: str, limit: int) -> tuple:
+        """The statement and parameters query() runs."""
+        where = []
+        params = []
+
+        if contains:
+            # the trigram index finds the text as a phrase, ignoring case
+            # (LIKE with an ESCAPE clause would not use it), then instr()
+            # keeps the exact matches
+            if self._text_index and len(contains) >= 3:
+                where.append('id IN (SELECT rowid FROM history_text '
+                             'WHERE history_text MATCH ?)')
+                params.append('"' + contains.replace('"', '""') + '"')
+            where.append('instr(entry, ?) > 0')
+            params.append(contains)
+        if cwd is not None:
+            where.append('cwd = ?')
+            params.append(cwd)
+        if session is not None:
+            where.append('session = ?')
+            params.append(session)
+        if since is not None:
+            where.append('started >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('started <= ?')
+            params.append(until)
+
+        sql = ('SELECT id, entry, started, duration, cwd, session '
+               'FROM history')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY started DESC, id DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return sql, params
@@ -0,0 +1,397 @@
+"""
+Line editing server
+
+Serves many EditLine instances from one thread, each its own session with
+its own line, history and completion.
+
+    - sessions on a pseudo-terminal, the client holding the master side
+    - sessions for clients connecting to a Unix socket, which are run
+      headless so no terminal sits between the socket and the editor
+    - one selector dispatches the input of every session, an idle session
+      costs neither a thread nor any CPU
+
+A handler is called with each line entered and what it returns is written
+back to the session:
+
+    >>> server = SessionServer(lambda session, line: line.upper())
+    >>> server.listen('/tmp/repl.sock')
+    >>> server.start()
+
+"""
+
+import os
+import socket
+import logging
+import threading
+import traceback
+import selectors
+from collections import deque
+
+from editline.editline import EditLine, _open_pty
+
+__all__ = ["Session", "SessionServer"]
+
+logger = logging.getLogger(__name__)
+
+
+class Session(object):
+    """A client of a SessionServer and the EditLine instance it edits with.
+
+    Attributes:
+        name: the name given to the instance
+        editline: the EditLine instance of the session
+        fd: the master side of a pseudo-terminal session, which the client
+            reads and writes (None for socket sessions)
+        closed: whether the session has ended
+
+    """
+
+    def __init__(self, server: 'SessionServer', name: str, editline: object,
+                 fd: int = None, sock: socket.socket = None):
+        self.server = server
+        self.name = name
+        self.editline = editline
+        self.fd = fd
+        self.closed = False
+        self._sock = sock
+        self._pending = bytearray()
+        self._writing = False
+
+        if sock is None:
+            self._input = editline.in_stream.fileno()
+        else:
+            self._input = sock.fileno()
+
+    def fileno(self) -> int:
+        return self._input
+
+    def write(self, text: str) -> None:
+        """Write text to the session's screen."""
+        self.server._call(lambda: self._write(text))
+
+    def _write(self, text: str) -> None:
+        if self.closed:
+            return
+        self.editline._write_output(text)
+        self._send_output()
+
+    def close(self) -> None:
+        """End the session, the server releases what it held for it."""
+        self.server._call(self._teardown)
+
+    def _begin(self) -> None:
+        """Start collecting the next line, the prompt goes out."""
+        self.editline._line_started()
+        self.editline._feed_start()
+        self._send_output()
+
+    def _readable(self, mask: int) -> None:
+        """Hand what the client sent to the editor and run any lines."""
+        if mask & selectors.EVENT_WRITE:
+            self._send_output()
+        if not mask & selectors.EVENT_READ:
+            return
+
+        try:
+            if self._sock is None:
+                data = os.read(self._input, 4096)
+            else:
+                data = self._sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # the client hung up its end of the terminal
+            data = b''
+
+        self.editline.feed(data)
+        self._run_lines()
+
+    def _run_lines(self) -> None:
+        """Pass each line completed by the input to the handler."""
+        editline = self.editline
+        while not self.closed:
+            line = editline._feed_line()
+            if line is None:
+                break
+
+            editline._feed_stop()
+            if not line:
+                self._teardown()
+                return
+
+            try:
+                reply = self.server.handler(self, line)
+            except Exception:
+                reply = traceback.format_exc()
+            if reply:
+                self._write(reply)
+
+            # typeahead may already hold the next line
+            if not self.closed:
+                self._begin()
+
+        self._send_output()
+
+    def _send_output(self) -> None:
+        """Pass a headless session's output on to its socket."""
+        if self._sock is None or self.closed:
+            return
+
+        self._pending += self.editline.take_output()
+        try:
+            sent = self._sock.send(self._pending) if self._pending else 0
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            # reading will see the client has gone
+            self._pending.clear()
+            sent = 0
+        del self._pending[:sent]
+
+        # a slow client is written to as it drains
+        writing = bool(self._pending)
+        if writing != self._writing:
+            self._writing = writing
+            events = selectors.EVENT_READ
+            if writing:
+                events |= selectors.EVENT_WRITE
+            self.server._selector.modify(self._input, events,
+                                         self._readable)
+
+    def _teardown(self) -> None:
+        """Release the session's descriptors and instance."""
+        if self.closed:
+            return
+        self.closed = True
+
+        self.server._forget(self)
+        self.editline._feed_stop()
+        if self._sock is not None:
+            # whatever the client has room for yet
+            try:
+                self._sock.send(self._pending + self.editline.take_output())
+            except OSError:
+                pass
+            self._sock.close()
+        if self.fd is not None:
+            os.close(self.fd)
+        self.editline = None
+
+
+class SessionServer(object):
+    """Serve EditLine sessions from a single thread.
+
+    Args:
+        handler: called as handler(session, line) with each line entered,
+                 a string it returns is written to the session
+        factory: the EditLine class to create instances of
+        prompt: the prompt of every session, the instances' default if None
+
+    Sessions are added by open_pty() or by clients connecting to a socket
+    set up with listen(), and are run by serve_forever() or by the thread
+    start() creates.  A session ends when its client hangs up or enters
+    end of file, or on Session.close().
+
+    A client which cannot be given a session (the factory failing, say,
+    once the system runs out of pseudo-terminals) is disconnected and the
+    error logged to the 'editline.server' logger; the server carries on
+    with the others.
+
+    """
+
+    def __init__(self, handler: callable, factory: type = EditLine,
+                 prompt: str = None):
+        self.handler = handler
+        self.factory = factory
+        self.prompt = prompt
+        self.sessions = {}
+
+        self._selector = selectors.DefaultSelector()
+        self._listeners = []
+        self._calls = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._loop_thread = None
+        self._running = False
+        self._count = 0
+
+        # wakes the loop for work handed over by other threads
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ,
+                                self._woken)
+
+    def __enter__(self) -> 'SessionServer':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _next_name(self, name: str) -> str:
+        self._count += 1
+        return name or 'session-{0}'.format(self._count)
+
+    def _configure(self, editline: object) -> None:
+        if self.prompt is not None:
+            editline.prompt = self.prompt
+
+    def open_pty(self, name: str = None, columns: int = 80,
+                 lines: int = 24) -> Session:
+        """Start a session on a new pseudo-terminal.
+
+        Args:
+            name: a name for the session's instance
+            columns: width of the terminal
+            lines: height of the terminal
+
+        Returns:
+            The session, its fd is the master side of the terminal which
+            the client uses (it is closed when the session ends).
+
+        """
+        name = self._next_name(name)
+        master, streams = _open_pty(columns, lines)
+        try:
+            editline = self.factory(name, *streams)
+            self._configure(editline)
+        except BaseException:
+            os.close(master)
+            raise
+        session = Session(self, name, editline, fd=master)
+        self._call(lambda: self._add(session))
+        return session
+
+    def listen(self, path: str, backlog: int = 128) -> socket.socket:
+        """Accept sessions from clients connecting to a Unix socket.
+
+        Args:
+            path: filesystem path to bind the socket to
+            backlog: connections which may wait to be accepted
+
+        Returns:
+            The listening socket.
+
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            listener.listen(backlog)
+            listener.setblocking(False)
+        except BaseException:
+            listener.close()
+            raise
+
+        def register():
+            self._listeners.append(listener)
+            self._selector.register(listener, selectors.EVENT_READ,
+                                    lambda mask: self._accept(listener))
+        self._call(register)
+        return listener
+
+    def _accept(self, listener: socket.socket) -> None:
+        try:
+            sock, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+
+        name = self._next_name(None)
+        try:
+            editline = self.factory.headless(name)
+            self._configure(editline)
+        except Exception:
+            logger.exception('no session for a client of %s',
+                             listener.getsockname())
+            sock.close()
+            return
+        self._add(Session(self, name, editline, sock=sock))
+
+    def _add(self, session: Session) -> None:
+        self.sessions[session.name] = session
+        self._selector.register(session.fileno(), selectors.EVENT_READ,
+                                session._readable)
+        try:
+            session._begin()
+
+            # something may have been typed before it was registered
+            session._run_lines()
+        except Exception:
+            logger.exception('session %s failed to start', session.name)
+            session._teardown()
+
+    def _forget(self, session: Session) -> None:
+        self.sessions.pop(session.name, None)
+        self._selector.unregister(session.fileno())
+
+    def _call(self, function: callable) -> None:
+        """Run function on the serving thread, now if that is this one."""
+        if (self._loop_thread is None or
+                self._loop_thread is threading.current_thread()):
+            function()
+            return
+
+        with self._lock:
+            self._calls.append(function)
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            # already awake
+            pass
+
+    def _woken(self, mask: int) -> None:
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self._lock:
+            calls, self._calls = self._calls, deque()
+        for function in calls:
+            function()
+
+    def serve_forever(self) -> None:
+        """Dispatch the sessions' input until stop() is called."""
+        self._loop_thread = threading.current_thread()
+        self._running = True
+        try:
+            # picks up what was handed over before it was serving
+            self._woken(selectors.EVENT_READ)
+            while self._running:
+                for key, mask in self._selector.select():
+                    key.data(mask)
+        finally:
+            self._loop_thread = None
+
+    def start(self) -> threading.Thread:
+        """Serve from a daemon thread of its own."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='editline-server', daemon=True)
+        self._loop_thread = self._thread
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+        """Have serve_forever() return, the sessions stay open."""
+        def halt():
+            self._running = False
+        self._call(halt)
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+            self._thread = None
+
+    def close(self) -> None:
+        """Stop serving and end every session."""
+        self.stop()
+        for session in list(self.sessions.values()):
+            session._teardown()
+        for listener in self._listeners:
+            self._selector.unregister(listener)
+            listener.close()
+        self._listeners = []
+        self._selector.unregister(self._wake_read)
+        self._selector.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
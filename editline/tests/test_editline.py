@@ -5,7 +5,10 @@ import os
 import sys
 import unittest
 import subprocess
-from test.support import import_module
+try:
+    from test.support.import_helper import import_module
+except ImportError:
+    from test.support import import_module
 
 # too bad this thing moved ...
 try:
@@ -101,5 +104,335 @@ class TestEditline(unittest.TestCase):
         el_cols = el.gettc('co')
         self.assertEqual(el_cols, columns)
 
+    @unittest.skipUnless(check_test_support(), "no script_helper")
+    def test_300_readline_releases_gil(self):
+        # the line only arrives once another thread has run, which it
+        # cannot do while readline() holds on to the GIL
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            import os, sys, threading, time
+            from editline.editline import EditLine
+            rfd, wfd = os.pipe()
+            el = EditLine("gil", os.fdopen(rfd), sys.stdout, sys.stderr)
+            def feed():
+                time.sleep(0.1)
+                os.write(wfd, b"fed\\n")
+            threading.Thread(target=feed, daemon=True).start()
+            print(repr(el.readline()))
+            ''')
+        self.assertEqual(stdout.strip(), b"'fed\\n'")
+        self.assertEqual(rc, 0)
+
+    @unittest.skipUnless(check_test_support(), "no script_helper")
+    def test_301_readline_async(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            import asyncio, os, sys
+            from editline.editline import EditLine
+            rfd, wfd = os.pipe()
+            el = EditLine("async", os.fdopen(rfd), sys.stdout, sys.stderr)
+            async def main():
+                async def feed():
+                    for part in (b"one\\ntw", b"o\\nthree"):
+                        await asyncio.sleep(0.05)
+                        os.write(wfd, part)
+                    os.close(wfd)
+                asyncio.ensure_future(feed())
+                lines = [await el.readline_async()]
+                while lines[-1]:
+                    lines.append(await el.readline_async())
+                print(lines, el.get_current_history_length())
+            asyncio.run(main())
+            ''')
+        self.assertEqual(stdout.strip(),
+                         b"['one\\n', 'two\\n', 'three', ''] 3")
+        self.assertEqual(rc, 0)
+
+    def test_302_headless(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            el = EditLine.headless(keys=[b"x = 2\\x1b[D\\x1b[D", b"\\x7f\\r",
+                                         b"pri\\t\\r", b"\\x1b[A\\x1b[A\\r"])
+            el.completer = lambda text: [text + "nt("]
+            lines = [el.readline()]
+            while lines[-1]:
+                lines.append(el.readline())
+            print(lines, b"EL> x = 2" in el.take_output(), el.take_output())
+
+            # its out_stream outliving it drops what is written
+            import gc
+            out = el.out_stream
+            del el
+            gc.collect()
+            print(out.write("late"))
+            ''')
+        self.assertEqual(stdout.strip().split(b'\n'),
+                         [b"['x  2\\n', 'print(\\n', 'x  2\\n', ''] True b''",
+                          b"4"])
+        self.assertEqual(rc, 0)
+
+    def test_303_utf8_strings(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            el = EditLine.headless(keys="καλη\\tμέρα\\r".encode())
+            el.prompt = "λ\\udcff> "
+            prompt = el.prompt
+            el.prompt = "λ> "
+            el.completer = lambda text: [text + "ς"]
+            print(ascii([prompt, el.readline(), el.get_begidx(),
+                         el.get_endidx()]))
+            ''', LC_ALL='C.UTF-8')
+        self.assertEqual(stdout.strip(),
+            b"['\\u03bb\\udcff> ', '\\u03ba\\u03b1\\u03bb\\u03b7\\u03c2"
+            b"\\u03bc\\u03ad\\u03c1\\u03b1\\n', 0, 4]")
+        self.assertEqual(rc, 0)
+
+    def test_304_line_view(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            el = EditLine.headless(keys=b"print(x)\\x1b[D\\t\\r")
+            seen = []
+            def completer(text):
+                with el.line_view() as view:
+                    seen.append("".join(map(chr, view)))
+                seen.append(el.line_cursor)
+                return []
+            el.completer = completer
+            generation = el.line_generation
+            print(repr(el.readline()), seen, el.line_generation > generation)
+            view = el.line_view()
+            try:
+                el.insert_text("y")
+            except BufferError:
+                print("refused")
+            view.release()
+            el.insert_text("y")
+            print("y" in el.get_line_buffer())
+
+            # a view kept by a key function stops the typing after it
+            kept = []
+            el.add_function("ed-keep", lambda el, key:
+                            kept.append(el.line_view()))
+            el.bind("^K", "ed-keep")
+            el.feed(b"ab\\x0bcd\\r")
+            try:
+                el.readline()
+            except BufferError:
+                print("refused", "".join(map(chr, kept[0])))
+            kept[0].release()
+            print(repr(el.readline()))
+            ''')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"'print(x)\\n' ['print(x)', 7] True",
+                          b"refused", b"True", b"refused ab", b"'cd\\n'",
+                          b""])
+        self.assertIn(b"line_view() held beyond the key function", stderr)
+        self.assertEqual(rc, 0)
+
+    def test_305_bracketed_paste(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            keys = [b"x = \\x1b[200~if a:\\r\\n\\tb()\\n", b"\\tc(\\xce",
+                    b"\\xbb)\\x1b[20", b"1~\\r"]
+            el = EditLine.headless(keys=keys)
+            el.completer = lambda text: print("completing") or []
+            print(ascii(el.readline()), b"\\x1b[?2004h" in el.take_output())
+
+            # only a real terminal is asked to bracket pastes
+            import os, pty
+            master, slave = pty.openpty()
+            tty = EditLine("tty", os.fdopen(os.dup(slave)),
+                           os.fdopen(os.dup(slave), "w"),
+                           os.fdopen(slave, "w"))
+            for on in (True, False):
+                tty.bracketed_paste = on
+                os.write(master, b"y\\r")
+                line = tty.readline()
+                print(ascii(line), b"\\x1b[?2004h" in os.read(master, 1024))
+            ''')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"'x = if a:\\n\\tb()\\n\\tc(\\u03bb)\\n' False",
+                          b"'y\\n' True", b"'y\\n' False", b""])
+        self.assertEqual(rc, 0)
+
+    def test_306_bulk_input(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            import os, sys, time, asyncio, threading
+            from editline.editline import EditLine
+            r, w = os.pipe()
+            os.write(w, b"abc \\xce")
+            def rest():
+                time.sleep(0.2)
+                os.write(w, b"\\xbb\\nsecond\\nthird\\n")
+                os.close(w)
+            threading.Thread(target=rest).start()
+            el = EditLine("t", os.fdopen(r), sys.stdout, sys.stderr)
+            print(ascii(el.readline()), ascii(el.readline()))
+            print(ascii(asyncio.run(el.readline_async())))
+            ''', LC_ALL='C.UTF-8')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"'abc \\u03bb\\n' 'second\\n'", b"'third\\n'",
+                          b""])
+        self.assertEqual(rc, 0)
+
+    def test_307_one_output_stream(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            el = EditLine.headless(keys=[b"x\\t", b"\\r"])
+            el.completer = lambda text: ["xa", "xb"]
+            el.add_history_entries(["one\\n", "two\\n"])
+            el.show_history()
+            print(ascii(el.take_output()))
+            el.readline()
+            print(ascii(el.take_output().replace(b"\\x1b[K", b"")))
+            ''')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"b'  1  one\\n  2  two\\n'",
+                          b"b'EL> x\\nxa  xb  \\n\\rEL> x\\n'", b""])
+        self.assertEqual(rc, 0)
+
+    def test_308_batched_edits(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            el = EditLine.headless(keys=[b"abc", b"\\x14", b"\\r"])
+            def swap(editline, key):
+                with editline.batch():
+                    editline.delete_text(1)
+                    editline.redisplay()
+                    editline.insert_text("XY")
+                    editline.redisplay()
+            el.add_function("ed-swap", swap)
+            el.bind("^T", "ed-swap")
+            print(ascii(el.readline()), el.take_output().count(b"EL> "))
+            with el.batch():
+                el.insert_text("1")
+                el.redisplay()
+                el.insert_text("2")
+                el.redisplay()
+            print(el.take_output().count(b"EL> "))
+
+            # a view of the line holds off the edits of a batch too
+            def viewed(editline, key):
+                with editline.line_view() as view, editline.batch():
+                    for edit in (lambda: editline.insert_text("Z"),
+                                 lambda: editline.delete_text(1)):
+                        try:
+                            edit()
+                        except BufferError:
+                            print("refused", len(view))
+                editline.insert_text("Z")
+            el.add_function("ed-viewed", viewed)
+            el.bind("^V", "ed-viewed")
+            el.feed(b"ab\\x16\\r")
+            print(ascii(el.readline()))
+            ''')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"'abXY\\n' 1", b"1", b"refused 2", b"refused 2",
+                          b"'abZ\\n'", b""])
+        self.assertEqual(rc, 0)
+
+    def test_309_horizontal_scroll(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            from editline.editline import EditLine
+            el = EditLine.headless(keys=[b"0123456789abcdefghijklmnopqrstuvwxyz",
+                                         b"\\x01", b"\\x06" * 3, b"-^",
+                                         b"\\r"],
+                                   columns=20)
+            el.prompt = "> "
+            el.bind("^F", "ed-move-to-end")
+            el.horizontal_scroll = True
+            print(ascii(el.readline()))
+            # rows cleared to their end, then drawn again up to the cursor
+            for row in el.take_output().split(b"\\r> ")[1:]:
+                print(row.replace(b"\\x1b[K", b"|").rstrip().decode())
+            el.horizontal_scroll = False
+            el.feed(b"a-b\\x01\\x06c\\r")
+            print(ascii(el.readline()))
+
+            # without a sequence to clear, the row is padded out
+            el = EditLine.headless(keys=[b"abc", b"\\x02\\r"], columns=10,
+                                   term="dumb")
+            el.prompt = "> "
+            el.horizontal_scroll = True
+            print(ascii(el.readline()))
+            print(ascii(el.take_output()))
+            ''')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"'012-^3456789abcdefghijklmnopqrstuvwxyz\\n'",
+                          b"|",
+                          b"<tuvwxyz|",
+                          b"0123456789abcdef>|",
+                          b"",
+                          b"0123456789abcdef>|",
+                          b"012",
+                          b"012-^3456789abcd>|",
+                          b"012-^",
+                          b"012-^3456789abcd>|",
+                          b"012-^",
+                          b"'a-bc\\n'",
+                          b"'abc\\n'",
+                          b"b'\\r>        \\r> \\r> abc    \\r> abc"
+                          b"\\r> abc    \\r> ab\\n'",
+                          b""])
+        self.assertEqual(rc, 0)
+
+    def test_310_one_reader(self):
+        self.load_assert_python_ok()
+        rc, stdout, stderr = assert_python_ok('-c', '''if 1:
+            import os, pty, threading
+            from editline.editline import EditLine, HistoryStore
+            master, slave = pty.openpty()
+            el = EditLine("reader", os.fdopen(os.dup(slave)),
+                          os.fdopen(os.dup(slave), "w"),
+                          os.fdopen(slave, "w"))
+            store = HistoryStore(["abc %d\\n" % i for i in range(1000)])
+            other = EditLine.headless("other")
+            el.history_store = other.history_store = store
+            el.add_history_entries(["abc own %d\\n" % i for i in range(100)])
+            refused = []
+            def meanwhile():
+                # only the reading thread may use the instance
+                while not refused:
+                    try:
+                        el.get_line_buffer()
+                    except RuntimeError:
+                        refused.append("get_line_buffer")
+                for name, call in [("insert_text", lambda: el.insert_text("z")),
+                                   ("add_history_entry",
+                                    lambda: el.add_history_entry("x\\n")),
+                                   ("history_search",
+                                    lambda: el.history_search("abc")),
+                                   ("readline", el.readline)]:
+                    try:
+                        call()
+                    except RuntimeError:
+                        refused.append(name)
+                # the navigation goes through the shared index meanwhile
+                os.write(master, b"abc" + b"\\x1b[A" * 300 +
+                         b"\\x1b[B" * 300 + b"\\r")
+                for i in range(300):
+                    other.history_search("abc 5", 3)
+                    other.history_fuzzy("ab9")
+            thread = threading.Thread(target=meanwhile)
+            thread.start()
+            print(repr(el.readline()), refused)
+            thread.join()
+            el.insert_text("z")
+            print("z" in el.get_line_buffer())
+            ''')
+        self.assertEqual(stdout.split(b'\n'),
+                         [b"'abc\\n' ['get_line_buffer', 'insert_text', "
+                          b"'add_history_entry', 'history_search', "
+                          b"'readline']", b"True", b""])
+        self.assertEqual(rc, 0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,684 @@
+"""
+Unit testing for the history file support.
+"""
+import os
+import sys
+import tempfile
+import textwrap
+import subprocess
+import unittest
+
+try:
+    from test.support.import_helper import import_module
+except ImportError:
+    from test.support import import_module
+
+
+class HistoryCodec(unittest.TestCase):
+
+    entries = [
+        'print("hello world")\n',
+        'a = {"key": "\\t"}\n',
+        'if x:\n    pass\n',
+        'tab\there\n',
+        'π = 3.14159\n',
+        'no newline'
+    ]
+
+    def setUp(self):
+        self.history = import_module('editline.history')
+
+    def test_001_round_trip(self):
+        for entry in self.entries:
+            line = self.history.encode_entry(entry)
+            self.assertTrue(line.endswith(b'\n'))
+            self.assertEqual(line.count(b'\n'), 1)
+            self.assertEqual(self.history.decode_entry(line), entry)
+
+    def test_002_libedit_forms(self):
+        # strvis(3) may use any of these for whitespace
+        self.assertEqual(self.history.decode_entry(b'a\\040b\\012\n'),
+                         'a b\n')
+        self.assertEqual(self.history.decode_entry(b'a\\sb\\^J\n'),
+                         'a b\n')
+        self.assertEqual(self.history.decode_entry(b'\\\\n\n'), '\\n')
+
+
+class MappedHistoryFile(unittest.TestCase):
+
+    def setUp(self):
+        self.history = import_module('editline.history')
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+        if os.path.exists(self.filename + self.history.INDEX_SUFFIX):
+            os.unlink(self.filename + self.history.INDEX_SUFFIX)
+
+    def write_entries(self, entries, mode='wb'):
+        with open(self.filename, mode) as fp:
+            if mode == 'wb':
+                fp.write(self.history.HISTORY_COOKIE)
+            for entry in entries:
+                fp.write(self.history.encode_entry(entry))
+
+    def test_001_not_history(self):
+        with open(self.filename, 'wb') as fp:
+            fp.write(b'just some text\n')
+        with self.assertRaises(ValueError):
+            self.history.MappedHistory(self.filename)
+
+    def test_002_empty(self):
+        self.write_entries([])
+        mapped = self.history.MappedHistory(self.filename)
+        self.assertTrue(mapped.exhausted)
+        self.assertEqual(mapped.older(10), [])
+        mapped.close()
+
+    def test_003_newest_first(self):
+        entries = ['cmd {0}\n'.format(i) for i in range(100)]
+        self.write_entries(entries)
+        mapped = self.history.MappedHistory(self.filename)
+        self.assertEqual(mapped.older(10), entries[-10:])
+        self.assertEqual(mapped.older(85), entries[5:90])
+        self.assertFalse(mapped.exhausted)
+        self.assertEqual(mapped.older(10), entries[:5])
+        self.assertTrue(mapped.exhausted)
+        self.assertEqual(mapped.older(10), [])
+        mapped.close()
+
+    def test_004_blank_entries(self):
+        entries = ['', 'one\n', '', 'two\n']
+        self.write_entries(entries)
+        mapped = self.history.MappedHistory(self.filename)
+        self.assertEqual(mapped.older(1), entries[-1:])
+        self.assertEqual(mapped.older(10), entries[:-1])
+        mapped.close()
+
+    def test_005_index(self):
+        entries = ['cmd {0}\n'.format(i) for i in range(100)] + ['', 'x\ty']
+        self.write_entries(entries)
+        mapped = self.history.MappedHistory(self.filename, index=True)
+        self.assertEqual(len(mapped), 102)
+        self.assertEqual(mapped.entry(0), 'cmd 0\n')
+        self.assertEqual(mapped.entry(-2), '')
+        with self.assertRaises(IndexError):
+            mapped.entry(102)
+        self.assertEqual(mapped.older(10), entries[-10:])
+        self.assertEqual(mapped.older(85), entries[7:92])
+        self.assertEqual(mapped.older(10), entries[:7])
+        self.assertTrue(mapped.exhausted)
+        mapped.close()
+
+    def test_006_index_update(self):
+        self.write_entries(['one\n', 'two\n'])
+        self.assertEqual(self.history.write_index(self.filename), 2)
+        sidecar = self.filename + self.history.INDEX_SUFFIX
+        size = os.path.getsize(sidecar)
+
+        # appending only adds the new offsets
+        self.write_entries(['three\n'], mode='ab')
+        mapped = self.history.MappedHistory(self.filename, index=True)
+        self.assertEqual(len(mapped), 3)
+        self.assertEqual(mapped.entry(2), 'three\n')
+        mapped.close()
+        self.assertEqual(os.path.getsize(sidecar), size + 8)
+
+        # anything else means starting over
+        self.write_entries(['four\n'])
+        mapped = self.history.MappedHistory(self.filename, index=True)
+        self.assertEqual(len(mapped), 1)
+        self.assertEqual(mapped.older(5), ['four\n'])
+        mapped.close()
+
+    def test_007_index_mode(self):
+        # mkstemp() made the history file private
+        self.write_entries(['one\n'])
+        sidecar = self.filename + self.history.INDEX_SUFFIX
+        self.history.write_index(self.filename)
+        self.assertEqual(os.stat(sidecar).st_mode & 0o777, 0o600)
+
+        # an older, readable sidecar is brought into line
+        os.chmod(sidecar, 0o644)
+        self.write_entries(['two\n'], mode='ab')
+        self.history.write_index(self.filename)
+        self.assertEqual(os.stat(sidecar).st_mode & 0o777, 0o600)
+
+
+class CompressedHistoryFile(unittest.TestCase):
+
+    def setUp(self):
+        self.history = import_module('editline.history')
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def read_all(self, filename):
+        reader = self.history.open_history(filename)
+        self.assertIsInstance(reader, self.history.CompressedHistory)
+        entries = []
+        while not reader.exhausted:
+            entries[:0] = reader.older(700)
+        reader.close()
+        return entries
+
+    def test_001_codec(self):
+        self.assertEqual(self.history.compressed_codec(self.path('h.zz')),
+                         b'z')
+        self.assertEqual(self.history.compressed_codec(self.path('h.xz')),
+                         b'x')
+        self.assertIsNone(self.history.compressed_codec(self.path('h')))
+
+        # an existing file goes by its header, not its name
+        filename = self.path('plain.xz')
+        with open(filename, 'wb') as fp:
+            fp.write(self.history.HISTORY_COOKIE)
+        self.assertIsNone(self.history.compressed_codec(filename))
+        filename = self.path('packed')
+        self.history.write_compressed(filename, ['one\n'], b'x')
+        self.assertEqual(self.history.compressed_codec(filename), b'x')
+
+    def test_002_round_trip(self):
+        entries = ['cmd {0}\n'.format(i) for i in range(3000)]
+        entries.append('tab\there π\n')
+        for codec in (b'z', b'x'):
+            filename = self.path('h' + codec.decode())
+            self.history.write_compressed(filename, entries, codec)
+            reader = self.history.CompressedHistory(filename)
+            self.assertEqual(reader.older(2), entries[-2:])
+            reader.close()
+            self.assertEqual(self.read_all(filename), entries)
+
+    def test_003_append(self):
+        filename = self.path('h.zz')
+        entries = []
+        for i in range(30):
+            chunk = ['cmd {0} {1}\n'.format(i, j) for j in range(50)]
+            self.history.append_compressed(filename, chunk)
+            entries.extend(chunk)
+        self.assertEqual(self.read_all(filename), entries)
+
+    def test_004_torn_end(self):
+        filename = self.path('h.zz')
+        self.history.write_compressed(filename, ['one\n', 'two\n'])
+        with open(filename, 'ab') as fp:
+            fp.write(b'\x40\0\0\0\1\0\0\0cut short')
+        self.assertEqual(self.read_all(filename), ['one\n', 'two\n'])
+        self.history.append_compressed(filename, ['three\n'])
+        self.assertEqual(self.read_all(filename),
+                         ['one\n', 'two\n', 'three\n'])
+
+    def test_005_append_leaves_blocks(self):
+        filename = self.path('h.zz')
+        self.history.write_compressed(filename, ['one\n', 'two\n'])
+        with open(filename, 'rb') as fp:
+            written = fp.read()
+        self.history.append_compressed(filename, ['three\n'])
+        with open(filename, 'rb') as fp:
+            self.assertTrue(fp.read().startswith(written))
+        self.assertEqual(self.read_all(filename),
+                         ['one\n', 'two\n', 'three\n'])
+
+
+class SharedHistoryFile(unittest.TestCase):
+
+    def setUp(self):
+        self.history = import_module('editline.history')
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_001_empty_file(self):
+        shared = self.history.SharedHistory(self.filename)
+        self.assertEqual(shared.load(), [])
+        with open(self.filename, 'rb') as fp:
+            self.assertEqual(fp.read(), self.history.HISTORY_COOKIE)
+        shared.close()
+
+    def test_002_merge_sessions(self):
+        one = self.history.SharedHistory(self.filename)
+        two = self.history.SharedHistory(self.filename)
+        one.load()
+        two.load()
+
+        self.assertEqual(one.append(['one-1\n']), [])
+        self.assertEqual(two.append(['two-1\n']), ['one-1\n'])
+        self.assertEqual(one.pull(force=True), ['two-1\n'])
+        self.assertEqual(one.pull(force=True), [])
+
+        three = self.history.SharedHistory(self.filename)
+        self.assertEqual(three.load(), ['one-1\n', 'two-1\n'])
+
+        for shared in (one, two, three):
+            shared.close()
+
+    def test_003_pull_interval(self):
+        one = self.history.SharedHistory(self.filename, pull_interval=3600)
+        two = self.history.SharedHistory(self.filename)
+        one.load()
+        two.load()
+        two.append(['two-1\n'])
+        self.assertEqual(one.pull(), [])
+        one.pull_interval = 0
+        self.assertEqual(one.pull(), ['two-1\n'])
+        one.close()
+        two.close()
+
+    def test_004_compact(self):
+        shared = self.history.SharedHistory(self.filename, max_entries=5)
+        shared.load()
+        shared.append(['cmd {0}\n'.format(i) for i in range(20)])
+        shared.compact()
+        shared.close()
+
+        shared = self.history.SharedHistory(self.filename)
+        self.assertEqual(shared.load(),
+                         ['cmd {0}\n'.format(i) for i in range(15, 20)])
+        shared.close()
+
+    def test_005_compact_under_a_session(self):
+        one = self.history.SharedHistory(self.filename, max_entries=5)
+        two = self.history.SharedHistory(self.filename)
+        one.load()
+        one.append(['cmd {0}\n'.format(i) for i in range(20)])
+        two.load()
+
+        # two's offset is past the end of the compacted file; three's is
+        # inside it, where it would land amid the rewritten lines
+        one.append(['one-1\n'])
+        three = self.history.SharedHistory(self.filename)
+        three.load()
+        three.append(['three-1\n'])
+        one.compact()
+        self.assertEqual(one.append(['one-2\n']), ['three-1\n'])
+
+        self.assertEqual(two.pull(force=True),
+                         ['one-1\n', 'three-1\n', 'one-2\n'])
+        self.assertEqual(three.pull(force=True), ['one-2\n'])
+        self.assertEqual(one.pull(force=True), [])
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o600)
+
+        for shared in (one, two, three):
+            shared.close()
+
+
+class SQLiteHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        import_module('sqlite3')
+        self.history = import_module('editline.history')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'history.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_001_add_and_newest(self):
+        db = self.history.SQLiteHistory(self.filename)
+        for i in range(10):
+            db.add('cmd {0}\n'.format(i), started=1000 + i, cwd='/tmp')
+        self.assertEqual(db.newest(3), ['cmd 7\n', 'cmd 8\n', 'cmd 9\n'])
+        db.close()
+
+        db = self.history.SQLiteHistory(self.filename)
+        self.assertEqual(len(db.newest(100)), 10)
+        db.close()
+
+    def test_002_query(self):
+        db = self.history.SQLiteHistory(self.filename, session='one')
+        for i in range(20):
+            cwd = '/home' if i % 2 else '/tmp'
+            db.add('cmd {0}\n'.format(i), started=1000 + i, cwd=cwd)
+        rows = db.query(contains='cmd 1', cwd='/tmp')
+        self.assertEqual([r.entry for r in rows],
+                         ['cmd 10\n', 'cmd 12\n', 'cmd 14\n',
+                          'cmd 16\n', 'cmd 18\n'])
+        rows = db.query(since=1015, until=1017)
+        self.assertEqual([r.started for r in rows], [1015, 1016, 1017])
+        rows = db.query(limit=2)
+        self.assertEqual([r.entry for r in rows], ['cmd 18\n', 'cmd 19\n'])
+        self.assertEqual(db.query(contains='100%_'), [])
+        self.assertEqual(len(db.query(session='one')), 20)
+        self.assertEqual(db.query(session='two'), [])
+        db.close()
+
+    def test_003_duration(self):
+        db = self.history.SQLiteHistory(self.filename)
+        rid = db.add('sleep 1\n', started=1000)
+        self.assertIsNone(db.query()[0].duration)
+        db.finish(rid, 1.5)
+        self.assertEqual(db.query()[0].duration, 1.5)
+        db.close()
+
+    def test_004_query_case(self):
+        db = self.history.SQLiteHistory(self.filename)
+        for entry in ('Import os\n', 'import os\n', 'IMPORT OS\n', 'im\n'):
+            db.add(entry)
+        self.assertEqual([r.entry for r in db.query(contains='import')],
+                         ['import os\n'])
+        self.assertEqual([r.entry for r in db.query(contains='IM')],
+                         ['IMPORT OS\n'])
+        db.close()
+
+    def test_005_query_plan(self):
+        db = self.history.SQLiteHistory(self.filename)
+        if not db._text_index:
+            db.close()
+            self.skipTest('SQLite without the trigram tokenizer')
+        for entry in ('say "100%_"\n', 'say 100\n', 'a\\b\n'):
+            db.add(entry)
+        self.assertEqual([r.entry for r in db.query(contains='"100%_"')],
+                         ['say "100%_"\n'])
+        self.assertEqual([r.entry for r in db.query(contains='a\\b')],
+                         ['a\\b\n'])
+
+        sql, params = db._query_sql('100%_', None, None, None, None, None)
+        plan = db._db.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        detail = [row[-1] for row in plan if 'history_text' in row[-1]]
+        self.assertEqual(len(detail), 1)
+        self.assertRegex(detail[0], r'INDEX \d+:M')
+        db.close()
+
+
+class EditLineHistory(unittest.TestCase):
+    """Exercise the history support of an EditLine instance.
+
+    Each case runs in its own interpreter so libedit gets real streams.
+    """
+
+    prep = textwrap.dedent('''\
+        import sys
+        from editline.editline import EditLine
+        from editline import history
+        el = EditLine("histtest", sys.stdin, sys.stdout, sys.stderr)
+        def entries():
+            if el.get_current_history_length() == 0:
+                return []
+            out = []
+            event = el.history(el.H_LAST)
+            while event is not None:
+                out.append(event[1])
+                event = el.history(el.H_PREV)
+            return out
+        ''')
+
+    def setUp(self):
+        import_module('editline._editline')
+        self.history = import_module('editline.history')
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        with open(self.filename, 'wb') as fp:
+            fp.write(self.history.HISTORY_COOKIE)
+            for i in range(500):
+                fp.write(self.history.encode_entry('cmd {0}\n'.format(i)))
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def run_script(self, script):
+        code = self.prep + textwrap.dedent(script)
+        proc = subprocess.run([sys.executable, '-c', code],
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              env=dict(os.environ, HISTFILE=self.filename))
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode())
+        return proc.stdout.decode().splitlines()
+
+    def test_001_newest_window(self):
+        output = self.run_script('''
+            import os
+            print(el.read_history_file(os.environ['HISTFILE']))
+            ents = entries()
+            print(repr(ents[0]), repr(ents[-1]))
+            print(el.load_history_backlog(50), len(entries()))
+            ''')
+        self.assertEqual(output[0], '100')
+        self.assertEqual(output[1], "'cmd 400\\n' 'cmd 499\\n'")
+        self.assertEqual(output[2], '50 150')
+
+    def test_002_deferred(self):
+        output = self.run_script('''
+            import os
+            print(el.read_history_file(os.environ['HISTFILE'], deferred=True))
+            el.add_history_entry("early\\n")
+            el._merge_deferred_history(wait=True)
+            ents = entries()
+            print(len(ents), repr(ents[0]), repr(ents[-2]), repr(ents[-1]))
+            ''')
+        self.assertEqual(output[0], '0')
+        self.assertEqual(output[1], "100 'cmd 401\\n' 'cmd 499\\n' 'early\\n'")
+
+    def test_003_search(self):
+        output = self.run_script('''
+            import os
+            el.read_history_file(os.environ['HISTFILE'])
+            print([e[1] for e in el.history_search('cmd 45')])
+            print([e[1] for e in el.history_search('d 4', 2)])
+            print(el.history_search('cmd 3'))
+            el.add_history_entry('cmd 4500\\n')
+            el.history_size = 5
+            el.add_history_entry('other\\n')
+            print([e[1] for e in el.history_search('cmd 45')])
+            el.history(el.H_CLEAR)
+            print(el.history_search('cmd'))
+            ''')
+        self.assertEqual(output[0], str(['cmd {0}\n'.format(i)
+                                         for i in range(459, 449, -1)]))
+        self.assertEqual(output[1], "['cmd 499\\n', 'cmd 498\\n']")
+        self.assertEqual(output[2], '[]')
+        self.assertEqual(output[3], "['cmd 4500\\n']")
+        self.assertEqual(output[4], '[]')
+
+    def test_004_fuzzy(self):
+        output = self.run_script('''
+            el.history_size = 1000
+            el.add_history_entries(['git status\\n', 'ls\\n', 'git stash\\n',
+                                    'grep -r stat .\\n', 'git status\\n',
+                                    'ls\\n', 'git status\\n'])
+            print([e[1] for e in el.history_fuzzy('gstat')])
+            print([e[1] for e in el.history_fuzzy('gstatu')])
+            print([e[1] for e in el.history_fuzzy('GSTASH', 1)])
+            print(el.history_fuzzy('xyz'))
+            ''')
+        self.assertEqual(output[0], "['git status\\n', 'grep -r stat .\\n']")
+        self.assertEqual(output[1], "['git status\\n']")
+        self.assertEqual(output[2], "['git stash\\n']")
+        self.assertEqual(output[3], '[]')
+
+    def test_005_dedupe(self):
+        output = self.run_script('''
+            el.add_history_entries(['a\\n', 'b\\n', 'a\\n', 'c\\n', 'b\\n'])
+            el.history_dedupe = True
+            print(entries())
+            el.add_history_entry('a\\n')
+            print(entries())
+            print([e[1] for e in el.history_search('a')])
+            el.history_size = 3
+            el.add_history_entry('d\\n')
+            el.add_history_entry('c\\n')
+            print(entries())
+            ''')
+        self.assertEqual(output[0], "['a\\n', 'c\\n', 'b\\n']")
+        self.assertEqual(output[1], "['c\\n', 'b\\n', 'a\\n']")
+        self.assertEqual(output[2], "['a\\n']")
+        self.assertEqual(output[3], "['a\\n', 'd\\n', 'c\\n']")
+
+    def test_006_compressed(self):
+        output = self.run_script('''
+            import os
+            name = os.environ['HISTFILE'] + '.xz'
+            el.read_history_file(os.environ['HISTFILE'])
+            print(el.write_history_file(name))
+            el.history(el.H_CLEAR)
+            print(el.read_history_file(name), repr(entries()[-1]))
+            el.add_history_entry('fresh\\n')
+            print(el.write_history_file(name))
+            print(history.CompressedHistory(name).older(2))
+            os.unlink(name)
+            ''')
+        self.assertEqual(output[0], '100')
+        self.assertEqual(output[1], "100 'cmd 499\\n'")
+        self.assertEqual(output[2], '1')
+        self.assertEqual(output[3], "['cmd 499\\n', 'fresh\\n']")
+
+    def test_007_event(self):
+        output = self.run_script('''
+            import os
+            print(el.read_history_file(os.environ['HISTFILE'], index=True))
+            print(el.history_event(1), el.history_event(100))
+            print(el.history_event(0), el.history_event(101))
+            el.add_history_entry('new\\n')
+            print(el.write_history_file(os.environ['HISTFILE']))
+            mapped = history.MappedHistory(os.environ['HISTFILE'], index=True)
+            print(len(mapped), repr(mapped.entry(-1)))
+            mapped.close()
+            os.unlink(os.environ['HISTFILE'] + history.INDEX_SUFFIX)
+            ''')
+        self.assertEqual(output[0], '100')
+        self.assertEqual(output[1], "(1, 'cmd 400\\n') (100, 'cmd 499\\n')")
+        self.assertEqual(output[2], 'None None')
+        self.assertEqual(output[3], '100')
+        self.assertEqual(output[4], "100 'new\\n'")
+
+    def test_008_store(self):
+        output = self.run_script('''
+            import os
+            from editline.editline import HistoryStore
+            store = HistoryStore(history.MappedHistory(
+                os.environ['HISTFILE']).older(500))
+            other = EditLine("other", sys.stdin, sys.stdout, sys.stderr)
+            el.history_store = other.history_store = store
+            del store
+            el.add_history_entry('cmd 7 local\\n')
+            print(len(el.history_store), len(entries()))
+            print(el.history_event(8), el.history_event(501))
+            print([e[0] for e in el.history_search('cmd 7', 3)])
+            print([e[1] for e in el.history_fuzzy('cmd7loc')])
+            print(other.history_search('local'), len(other.history_store))
+            el.history_store = None
+            print(el.history_event(1), el.history_search('cmd 1'))
+            ''')
+        self.assertEqual(output[0], '500 1')
+        self.assertEqual(output[1], "(8, 'cmd 7\\n') (501, 'cmd 7 local\\n')")
+        self.assertEqual(output[2], '[501, 80, 79]')
+        self.assertEqual(output[3], "['cmd 7 local\\n']")
+        self.assertEqual(output[4], '[] 500')
+        self.assertEqual(output[5], "(1, 'cmd 7 local\\n') []")
+
+    def test_009_incremental_search_key(self):
+        output = self.run_script('''
+            print(el.incremental_search)
+            for on in (True, False):
+                search = EditLine.headless("search")
+                search.add_history_entries(["cmd 1\\n", "other\\n"])
+                search.incremental_search = on
+                search.feed(b"\\x12cmd\\r\\r")
+                line = search.readline()
+                print(b"search: cmd" in search.take_output(), repr(line))
+
+            # turned off, ^R goes back to what it was bound to before
+            kept = EditLine.headless("kept")
+            kept.bind("^R", "ed-move-to-beg")
+            kept.incremental_search = True
+            kept.incremental_search = False
+            kept.feed(b"bc\\x12a\\r")
+            print(repr(kept.readline()))
+
+            # unless it was bound to something else meanwhile
+            kept.incremental_search = True
+            kept.bind("^R", "ed-move-to-end")
+            kept.incremental_search = False
+            kept.feed(b"bc\\x01a\\x12d\\r")
+            print(repr(kept.readline()))
+            ''')
+        self.assertEqual(output, ['False', "True 'cmd 1\\n'",
+                                  "False 'cmd 1\\n'", "'abc\\n'",
+                                  "'abcd\\n'"])
+
+    def test_010_deferred_navigation(self):
+        output = self.run_script('''
+            import os
+            import threading
+            ready = EditLine.headless("ready")
+            ready.read_history_file(os.environ['HISTFILE'], deferred=True)
+            ready._history_loader.join()
+            ready.feed(b"\\x1b[A\\r")
+            print(repr(ready.readline()))
+
+            # the load finishes after the line was started
+            late = EditLine.headless("late")
+            gate = threading.Event()
+            load = late._deferred_history_load
+            late._deferred_history_load = lambda name: (gate.wait(),
+                                                        load(name))
+            late.incremental_search = True
+            late.read_history_file(os.environ['HISTFILE'], deferred=True)
+            late._line_started()
+            late._feed_start()
+            gate.set()
+            late._history_loader.join()
+            late.feed(b"\\x12cmd 45\\r\\r")
+            print(repr(late._feed_line()))
+            late._feed_stop()
+            ''')
+        self.assertEqual(output, ["'cmd 499\\n'", "'cmd 459\\n'"])
+
+    def test_011_compressed_pending(self):
+        output = self.run_script('''
+            import os
+            name = os.environ['HISTFILE'] + '.xz'
+            el.read_history_file(os.environ['HISTFILE'])
+            el.write_history_file(name)
+
+            # nothing is held back for a plain file
+            el.add_history_entry('plain\\n')
+            print(len(el._history_pending))
+
+            typed = EditLine.headless('typed')
+            typed.read_history_file(name)
+            typed.add_history_entry('cmd 499\\n')
+            typed.feed(b'a\\ra\\rb\\r')
+            for i in range(3):
+                typed.readline()
+            print(typed.write_history_file(name))
+            print(history.CompressedHistory(name).older(3))
+            os.unlink(name)
+            ''')
+        self.assertEqual(output, ['0', '2', "['cmd 499\\n', 'a\\n', 'b\\n']"])
+
+    def test_012_wide_search(self):
+        output = self.run_script('''
+            search = EditLine.headless("search")
+            search.incremental_search = True
+            search.add_history_entries(["caf\\u00e9 au lait\\n", "cafe noir\\n",
+                                        "th\\u00e9\\n"])
+            search.feed("\\x12caf\\u00e9\\r\\r\\x12caf\\u00e9\\x7fe\\r\\r"
+                        "\\x12\\u00e9\\x01\\u00e0\\r".encode())
+            for i in range(3):
+                print(ascii(search.readline()))
+            ''')
+        self.assertEqual(output, ["'caf\\xe9 au lait\\n'", "'cafe noir\\n'",
+                                  "'\\xe0caf\\xe9 au lait\\n'"])
+
+    def test_013_sqlite_filename(self):
+        output = self.run_script('''
+            try:
+                el.read_history_file(sqlite=True)
+            except ValueError as exc:
+                print(exc)
+            print(el._history_db)
+            ''')
+        self.assertEqual(output, ['An SQLite history needs a filename.',
+                                  'None'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,301 @@
+"""
+Micro-benchmarks of the calls between libedit and Python.
+
+Each reports a rate (shown with pytest -s or when run directly) and checks
+the calls were made as they should be.
+"""
+import gc
+import os
+import sys
+import time
+import random
+import select
+import socket
+import tempfile
+import threading
+import unittest
+
+try:
+    from test.support.import_helper import import_module
+except ImportError:
+    from test.support import import_module
+
+
+def report(what, count, seconds):
+    print('{0}: {1:.0f}/s'.format(what, count / seconds), file=sys.stderr)
+
+
+class Upcalls(unittest.TestCase):
+
+    def setUp(self):
+        _editline = import_module('editline._editline')
+        editline = import_module('editline.editline')
+
+        # as little Python as possible behind each upcall
+        class Bench(editline.EditLine):
+            calls = 0
+
+            def _completer(self, text):
+                self.calls += 1
+                return _editline.CC_NORM
+
+            def _run_command(self, cmd):
+                return None
+
+        self.editline = Bench.headless('bench')
+
+    def best_time(self, keys, runs=5):
+        best = None
+        for run in range(runs):
+            self.editline.feed(keys)
+            started = time.perf_counter()
+            self.editline.readline()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    # Tab through libedit to the completer, against calling the completer
+    # straight from Python: about 0.5 when added, so a run under half of
+    # that has become twice as slow.
+    upcall_ratio = 0.25
+
+    def test_001_completer(self):
+        count = 50000
+        seconds = self.best_time(b'import os.pa' + b'\t' * count + b'\r')
+        report('completer upcalls', count, seconds)
+        self.assertEqual(self.editline.calls, 5 * count)
+
+        completer = self.editline._completer
+        direct = None
+        for run in range(5):
+            started = time.perf_counter()
+            for call in range(count):
+                completer('os.pa')
+            elapsed = time.perf_counter() - started
+            direct = elapsed if direct is None else min(direct, elapsed)
+        report('completer calls from Python', count, direct)
+        self.assertGreater(direct / seconds, self.upcall_ratio)
+        self.assertEqual(self.editline.begidx, 0)
+        self.assertEqual(self.editline.endidx, len('import os.pa'))
+
+    def test_002_run_command(self):
+        count = 20000
+        self.editline.feed(b'x\r' * count)
+        started = time.perf_counter()
+        for line in range(count):
+            self.assertEqual(self.editline.readline(), '\n')
+        report('lines', count, time.perf_counter() - started)
+
+    def test_003_key_function(self):
+        count = 50000
+        keys = []
+        self.editline.add_function('ed-bench', lambda el, key: keys.append(key))
+        self.editline.bind('^T', 'ed-bench')
+        seconds = self.best_time(b'\x14' * count + b'\r')
+        report('key function calls', count, seconds)
+        self.assertEqual(keys, ['\x14'] * (5 * count))
+
+
+class LongLines(unittest.TestCase):
+
+    # 100MB takes a while and a few GB, PYEDITLINE_BENCH_HUGE=1 adds it
+    sizes = [1, 10]
+    if os.environ.get('PYEDITLINE_BENCH_HUGE'):
+        sizes.append(100)
+
+    def setUp(self):
+        self.editline = import_module('editline.editline')
+
+    def test_001_readline(self):
+        for megabytes in self.sizes:
+            editline = self.editline.EditLine.headless('bench', columns=200)
+            length = megabytes * 1000 * 1000
+            editline.feed(b'x' * length + b'\r')
+            started = time.perf_counter()
+            line = editline.readline()
+            elapsed = time.perf_counter() - started
+            report('{0}MB line bytes'.format(megabytes), length, elapsed)
+            self.assertEqual(len(line), length + 1)
+            self.assertEqual(editline.get_current_history_length(), 1)
+
+    def test_002_typing(self):
+        count = 1000
+        for scrolled in (False, True):
+            editline = self.editline.EditLine.headless('bench')
+            editline.horizontal_scroll = scrolled
+            # a 50KB paste, then typing at the start of it
+            editline.feed(b'\x1b[200~' + b'x' * 50000 + b'\x1b[201~\x01' +
+                          b'y' * count + b'\r')
+            started = time.perf_counter()
+            line = editline.readline()
+            elapsed = time.perf_counter() - started
+            report('keys on a 50KB line{0}'.format(
+                ', scrolled' if scrolled else ''), count, elapsed)
+            self.assertEqual(line, 'y' * count + 'x' * 50000 + '\n')
+
+
+def system_calls(kind):
+    """read() ('syscr') or write() ('syscw') system calls made by this
+    thread so far (Linux only)."""
+    try:
+        with open('/proc/thread-self/io') as io:
+            for line in io:
+                if line.startswith(kind + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class TerminalInput(unittest.TestCase):
+
+    def setUp(self):
+        self.editline = import_module('editline.editline')
+
+    def test_001_bulk_reads(self):
+        length = 1000 * 1000
+        r, w = os.pipe()
+        writer = threading.Thread(
+            target=lambda: (os.write(w, b'x' * length + b'\n'), os.close(w)))
+        writer.start()
+        # the instance closes its streams, so none of the test's own
+        editline = self.editline.EditLine('bench', os.fdopen(r),
+                                          open(os.devnull, 'w'),
+                                          open(os.devnull, 'w'))
+
+        calls = system_calls('syscr')
+        started = time.perf_counter()
+        line = editline.readline()
+        elapsed = time.perf_counter() - started
+        writer.join()
+        report('1MB input bytes', length, elapsed)
+        self.assertEqual(len(line), length + 1)
+        if calls is not None:
+            calls = system_calls('syscr') - calls
+            print('1MB input: {0} reads'.format(calls), file=sys.stderr)
+            self.assertLess(calls, length // 1000)
+
+
+class TerminalOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.editline = import_module('editline.editline')
+
+    def test_001_show_history(self):
+        master, streams = self.editline._open_pty(80, 24)
+        try:
+            editline = self.editline.EditLine('bench', *streams)
+            editline.add_history_entries(
+                ['command number {0}\n'.format(n) for n in range(100)])
+
+            calls = system_calls('syscw')
+            editline.show_history()
+            if calls is not None:
+                calls = system_calls('syscw') - calls
+                print('100 history lines: {0} writes'.format(calls),
+                      file=sys.stderr)
+                # one write, and a second should the pty take it short
+                self.assertLessEqual(calls, 2)
+            # the pty may hand it over in pieces
+            out = b''
+            while b'command number 99' not in out:
+                poller = select.poll()
+                poller.register(master, select.POLLIN)
+                self.assertTrue(poller.poll(5000))
+                data = os.read(master, 65536)
+                self.assertTrue(data)
+                out += data
+        finally:
+            os.close(master)
+
+
+def resident_kib():
+    """Resident size of the process in KiB (Linux only)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Server(unittest.TestCase):
+
+    # PYEDITLINE_BENCH_SESSIONS=1000 reproduces a full-size run
+    count = int(os.environ.get('PYEDITLINE_BENCH_SESSIONS', 100))
+    keystrokes = 2000
+
+    def setUp(self):
+        server = import_module('editline.server')
+        self.server = server.SessionServer(lambda session, line: None,
+                                           prompt='> ')
+        self.addCleanup(self.server.close)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def read_until(self, fd, tail):
+        out = b''
+        while not out.endswith(tail):
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            self.assertTrue(poller.poll(5000))
+            data = os.read(fd, 65536)
+            self.assertTrue(data)
+            out += data
+        return out
+
+    def sessions(self, kind, connect):
+        gc.collect()
+        before = resident_kib()
+        clients = [connect() for count in range(self.count)]
+        for client, fd in clients:
+            self.read_until(fd, b'> ')
+        gc.collect()
+        after = resident_kib()
+        if before is not None:
+            print('{0} {1} sessions: {2:.0f} KiB each'.format(
+                self.count, kind, (after - before) / self.count),
+                file=sys.stderr)
+
+        # a keystroke to a random session until its echo comes back
+        chooser = random.Random(self.count)
+        times = []
+        for count in range(self.keystrokes):
+            client, fd = chooser.choice(clients)
+            started = time.perf_counter()
+            os.write(fd, b'x')
+            self.read_until(fd, b'x')
+            times.append(time.perf_counter() - started)
+        times.sort()
+        print('{0} keystroke round trip: median {1:.0f}us, '
+              'p99 {2:.0f}us'.format(kind, times[len(times) // 2] * 1e6,
+                                     times[len(times) * 99 // 100] * 1e6),
+              file=sys.stderr)
+        self.assertEqual(len(self.server.sessions), self.count)
+        return clients
+
+    def test_001_sockets(self):
+        path = os.path.join(self.tmpdir.name, 'sock')
+        self.server.listen(path, backlog=self.count)
+        self.server.start()
+
+        def connect():
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.addCleanup(client.close)
+            client.connect(path)
+            return client, client.fileno()
+        self.sessions('socket', connect)
+
+    def test_002_ptys(self):
+        self.server.start()
+
+        def connect():
+            session = self.server.open_pty()
+            return session, session.fd
+        self.sessions('pty', connect)
+
+
+if __name__ == "__main__":
+    unittest.main()
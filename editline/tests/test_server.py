@@ -0,0 +1,134 @@
+"""
+Unit testing for the line editing server.
+"""
+import os
+import socket
+import select
+import tempfile
+import time
+import unittest
+
+try:
+    from test.support.import_helper import import_module
+except ImportError:
+    from test.support import import_module
+
+
+class Sessions(unittest.TestCase):
+
+    def setUp(self):
+        server = import_module('editline.server')
+        self.server = server.SessionServer(self.handler, prompt='> ')
+        self.addCleanup(self.server.close)
+
+    def handler(self, session, line):
+        if line == 'bye\n':
+            session.close()
+            return None
+        return 'got ' + line
+
+    def read_until(self, fd, tail):
+        out = b''
+        while not out.endswith(tail):
+            self.assertTrue(select.select([fd], [], [], 5)[0])
+            data = os.read(fd, 4096)
+            self.assertTrue(data)
+            out += data
+        return out
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_001_pty(self):
+        session = self.server.open_pty()
+        self.server.start()
+        self.read_until(session.fd, b'> ')
+
+        os.write(session.fd, b'abc\x1b[D\x7f\r')
+        self.assertIn(b'got ac\r\n', self.read_until(session.fd, b'> '))
+
+        # end of file ends the session
+        os.write(session.fd, b'\x04')
+        self.wait_for(lambda: session.closed)
+        self.assertEqual(self.server.sessions, {})
+
+    def test_002_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sock')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.unlink, path)
+        self.server.listen(path)
+        self.server.start()
+
+        clients = []
+        for count in range(3):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.addCleanup(client.close)
+            client.connect(path)
+            self.read_until(client.fileno(), b'> ')
+            clients.append(client)
+
+        # typeahead runs as lines of its own, each session keeps its line
+        clients[0].sendall(b'one\rtw')
+        clients[1].sendall(b'three\r')
+        self.assertIn(b'got one\n', self.read_until(clients[0].fileno(),
+                                                    b'> tw'))
+        self.assertIn(b'got three\n', self.read_until(clients[1].fileno(),
+                                                      b'> '))
+        clients[0].sendall(b'o\r')
+        self.assertIn(b'got two\n', self.read_until(clients[0].fileno(),
+                                                    b'> '))
+
+        # hanging up or closing from the handler ends a session
+        clients[2].close()
+        clients[1].sendall(b'bye\r')
+        out = b''
+        while True:
+            self.assertTrue(select.select([clients[1]], [], [], 5)[0])
+            data = clients[1].recv(4096)
+            if not data:
+                break
+            out += data
+        self.assertIn(b'bye\n', out)
+        self.wait_for(lambda: len(self.server.sessions) == 1)
+
+    def test_003_factory_failure(self):
+        editline = import_module('editline.editline')
+
+        class Scarce(editline.EditLine):
+            failures = 1
+
+            @classmethod
+            def headless(cls, name):
+                if cls.failures:
+                    cls.failures -= 1
+                    raise OSError('out of pseudo-terminals')
+                return super().headless(name)
+
+        self.server.factory = Scarce
+        path = os.path.join(tempfile.mkdtemp(), 'sock')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.unlink, path)
+        self.server.listen(path)
+        self.server.start()
+
+        # the first client is turned away, the server keeps serving
+        with self.assertLogs('editline.server', 'ERROR'):
+            refused = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.addCleanup(refused.close)
+            refused.connect(path)
+            self.assertTrue(select.select([refused], [], [], 5)[0])
+            self.assertEqual(refused.recv(4096), b'')
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.connect(path)
+        self.read_until(client.fileno(), b'> ')
+        client.sendall(b'hi\r')
+        self.assertIn(b'got hi\n', self.read_until(client.fileno(), b'> '))
+
+
+if __name__ == "__main__":
+    unittest.main()
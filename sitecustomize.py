@@ -94,9 +94,32 @@ def enable_line_completer():
             # through a PYTHONSTARTUP hook, see:
             # http://bugs.python.org/issue5845#msg198636
             history = os.path.join(os.path.expanduser('~'), '.python_history')
+
+            # elsewhere, perhaps compressed: ~/.python_history.xz
+            if os.environ.get('PYEDITLINE_HISTORY_FILE'):
+                history = os.path.expanduser(
+                    os.environ['PYEDITLINE_HISTORY_FILE'])
+
+            # concurrent interpreters can share the file instead of the
+            # last one to exit overwriting the others
+            shared = bool(os.environ.get('PYEDITLINE_SHARED_HISTORY'))
+
+            # one copy of each command, repeats move up to the newest
+            if os.environ.get('PYEDITLINE_HISTORY_DEDUPE'):
+                editline_system.history_dedupe = True
+
+            # keep big history files off the path to the first prompt
+            deferred = bool(os.environ.get('PYEDITLINE_DEFER_HISTORY'))
+
+            # or keep it in a database which records when and where
+            database = os.environ.get('PYEDITLINE_HISTORY_DB')
+            if database:
+                history = os.path.expanduser(database)
             try:
-                editline_system.read_history_file(history)
-            except IOError:
+                editline_system.read_history_file(history, shared=shared,
+                                                  deferred=deferred,
+                                                  sqlite=bool(database))
+            except (IOError, ValueError, RuntimeError):
                 pass
             atexit.register(editline_system.write_history_file, history)
 
@@ -1,4 +1,5 @@
 /* Standard definitions */
+#define PY_SSIZE_T_CLEAN
 #include "Python.h"
 #include "structmember.h"
 #include <stddef.h>
@@ -6,6 +7,11 @@
 #include <signal.h>
 #include <errno.h>
 #include <sys/time.h>
+#include <sys/ioctl.h>
+#include <unistd.h>
+#include <limits.h>
+#include <wchar.h>
+#include <langinfo.h>
 
 #include <histedit.h>
 
@@ -34,20 +40,78 @@ typedef struct {
     Tokenizer *tok;
     History   *hist;
     HistEvent  ev;
+    int        hist_size;   /* capacity given to H_SETSIZE */
+    struct HistIndex *hidx; /* search index mirroring the history */
+    int        hist_dedupe; /* re-entered commands move to the newest */
+    struct HistoryStoreObject *store;  /* shared entries ahead of our own */
+    struct HistCandidates *store_fuzzy; /* fuzzy candidates from the store */
     
     PyObject *completer; /* Specify a word completer in Python */
-    PyObject *begidx;
-    PyObject *endidx;
+    int       begidx;    /* scope of the tab-completion, in characters */
+    int       endidx;
 
     char     *prompt;
     char      prompt_esc;
     char     *rprompt;
     char      rprompt_esc;
+    char     *search_status;  /* shown instead of rprompt while searching */
 
     char      _debug;
 
+    /* input handed over by feed() rather than read from the terminal */
+    char     *fed;
+    size_t    fed_len;
+    size_t    fed_pos;
+    size_t    fed_alloc;
+    mbstate_t fed_mbs;
+    char      fed_eof;      /* no more is coming */
+    char      fed_state;
+    char      fed_active;   /* a line is being collected from it */
+    char      fed_plain;    /* not a terminal, libedit does no editing */
+
+    /* input read from the terminal in bulk, handed to libedit by the char */
+    char     *in_buf;
+    size_t    in_pos;
+    size_t    in_len;
+
+    char      paste_mode;   /* ask the terminal to bracket pastes */
+
+    /* libedit's output goes out in one write() per refresh */
+    char     *out_buf;
+    char      reading;      /* in el_wgets(), which flushes before reading */
+    unsigned long reader;   /* the thread reading a line, 0 when none is */
+
+    /* edits from Python held back for one redisplay */
+    int       batch_depth;
+    char      batch_dirty;
+
+    /* ^R runs ed-search-history rather than em-inc-search-prev */
+    char      isearch;
+    char     *isearch_saved;  /* ^R's binding before, see _bind_save() */
+
+    /* the line kept to one row, scrolled sideways */
+    char      hscroll;
+    char      hs_line;      /* the line being read is drawn that way */
+    char      hs_keys;      /* its editor functions have been added */
+    size_t    hs_offset;    /* first character shown */
+    FILE     *hs_discard;   /* where libedit's own drawing goes */
+    char    **hs_saved;     /* the keys' bindings before, NULL ended */
+    char     *hs_buf;
+    size_t    hs_size;
+
+    /* headless: everything libedit writes collects in memory */
+    FILE     *sink;
+    char     *sink_buf;
+    size_t    sink_size;
+
+    /* memoryviews lent out over libedit's line (see line_view()) */
+    unsigned long line_gen;    /* bumped whenever the line may change */
+    int       line_exports;
+    Py_ssize_t line_shape;
+
     /* optimization -- scratch pad, same size as LineInfo */
-    int       buffer_size;
+    size_t    buffer_size;
+    size_t    buffer_keep;  /* larger pads are let go after the line */
     char     *buffer;
 
 } EditLineObject;
@@ -63,6 +127,13 @@ typedef struct {
 /* module reference */
 EditLineModule *editline_module_state = NULL;
 
+/* names of the upcalls, interned once at import */
+static PyObject *str_completer = NULL;
+static PyObject *str_run_command = NULL;
+static PyObject *str_line_started = NULL;
+static PyObject *str_key_function = NULL;
+static PyObject *str_merge_history = NULL;
+
 /*******************************************************************************
  *
  *              Common Routines
@@ -74,27 +145,132 @@ static void pel_note(const char *str)
     //printf("PEL: %s\n", str); 
 }
 
+/* call self.<name>(arg, arg2), the arguments ending at the first NULL */
+static PyObject *
+call_upcall(EditLineObject *self, PyObject *name, PyObject *arg,
+	    PyObject *arg2)
+{
+#if PY_VERSION_HEX >= 0x03090000
+    PyObject *args[3] = { (PyObject *) self, arg, arg2 };
+
+    return PyObject_VectorcallMethod(name, args,
+				     arg ? (arg2 ? 3 : 2) : 1, NULL);
+#else
+    return PyObject_CallMethodObjArgs((PyObject *) self, name, arg, arg2,
+				      NULL);
+#endif
+}
+
+/*
+ * Strings cross to libedit in the locale's encoding.  That is nearly
+ * always UTF-8, which Python's own codec does without a trip through the
+ * C library's multibyte conversions, so the codeset is checked once at
+ * import and the locale codec is only used for anything else.
+ */
+static int locale_is_utf8 = 0;
+
+static void
+detect_locale_encoding(void)
+{
+    const char *codeset = nl_langinfo(CODESET);
+
+    locale_is_utf8 = (codeset != NULL &&
+		      (strcmp(codeset, "UTF-8") == 0 ||
+		       strcmp(codeset, "utf8") == 0));
+}
+
+/*
+ * libedit is about to change the line (and may move it).  Refused with a
+ * BufferError, like resizing a bytearray, while a view of it is held.
+ */
+static int
+line_will_change(EditLineObject *self)
+{
+    if (self->line_exports > 0) {
+	PyErr_SetString(PyExc_BufferError,
+			"the line is still viewed, release the memoryview "
+			"from line_view() first");
+	return -1;
+    }
+    self->line_gen++;
+    return 0;
+}
+
+/*
+ * readline() lets the GIL go while libedit waits for the line, so other
+ * threads could get at the instance meanwhile.  Only the reading thread
+ * (its completer, key functions and the like) may use it until the line
+ * is done; output from other threads is what 'reading' is there for.
+ */
+static int
+_check_reader(EditLineObject *self)
+{
+    if (self->reader != 0 && self->reader != PyThread_get_thread_ident()) {
+	PyErr_SetString(PyExc_RuntimeError,
+			"the instance is reading a line in another thread");
+	return -1;
+    }
+    return 0;
+}
+
+/* one line is read at a time, whichever thread asks */
+static int
+_start_reading(EditLineObject *self)
+{
+    if (self->reader != 0) {
+	PyErr_SetString(PyExc_RuntimeError,
+			"the instance is already reading a line");
+	return -1;
+    }
+    self->reader = PyThread_get_thread_ident();
+    return 0;
+}
+
 static PyObject *
 encode(PyObject *b)
 {
+    if (locale_is_utf8)
+	return PyUnicode_AsEncodedString(b, "utf-8", "surrogateescape");
     return PyUnicode_EncodeLocale(b, "surrogateescape");
 }
 
 static PyObject *
 decode(const char *s)
 {
+    if (locale_is_utf8)
+	return PyUnicode_DecodeUTF8(s, strlen(s), "surrogateescape");
     return PyUnicode_DecodeLocale(s, "surrogateescape");
 }
 
+/* the output stream's buffer, enough for a screenful redrawn */
+#define OUTPUT_SIZE 16384
+
+/* the scratch pad starts out (and shrinks back to) this size */
+#define SCRATCH_SIZE 2048
+#define SCRATCH_KEEP (1024 * 1024)
+
 static int
-copy_to_buffer(EditLineObject *self, const char *src, int len)
+copy_to_buffer(EditLineObject *self, const char *src, size_t len)
 {
-    /* make sure it will fit -- resize if necessary */
-    if (len > self->buffer_size-2) {
-	int nsize = ((len + 2 + 1023) >> 10) * 1024;
-	char *nbuf = PyMem_RawMalloc(nsize);
+    /* make sure it will fit -- grow geometrically, big pastes come in */
+    if (len + 2 > self->buffer_size) {
+	size_t nsize = self->buffer_size ? self->buffer_size : SCRATCH_SIZE;
+	char *nbuf;
+
+	while (nsize < len + 2)
+	    nsize = (nsize > SIZE_MAX / 2) ? len + 2 : nsize * 2;
+
+	/* nothing in the old one is kept, so no realloc() copying it */
+	nbuf = PyMem_RawMalloc(nsize);
 	if (nbuf == NULL) {
+	    /* may be called from libedit without the GIL */
+#ifdef WITH_THREAD
+	    PyGILState_STATE gilstate = PyGILState_Ensure();
+#endif
 	    PyErr_NoMemory();
+#ifdef WITH_THREAD
+	    PyGILState_Release(gilstate);
+#endif
 	    /*PyErr_SetString(PyExc_SystemError,
 	      "Command buffer exceeds maximum length.");*/
 	    return -1;
@@ -110,7 +286,7 @@ copy_to_buffer(EditLineObject *self, const char *src, int len)
     }
 
     /* copy it */
-    strncpy(self->buffer, src, len);
+    memcpy(self->buffer, src, len);
 
     /* force termination */
     self->buffer[len] = '\0';
@@ -119,485 +295,3749 @@ copy_to_buffer(EditLineObject *self, const char *src, int len)
     return 0;
 }
 
-static PyObject *
-dump_state(EditLineObject *self, PyObject *noarg);
-
-/* callback triggered from libedit on a completion-char request */
-static unsigned char
-el_complete(EditLine *el, int ch)
-{
-    const LineInfo *li = el_line(el);
-    EditLineObject *self = NULL;
-    int rv = CC_REFRESH;
-    PyObject *r = NULL;
-    PyObject *t;
-
-    el_get(el, EL_CLIENTDATA, &self);
-    if (self == NULL) {
-        PyErr_BadInternalCall();
-        return CC_FATAL;
-    }
+/*******************************************************************************
+ *
+ *              History Search Index
+ *
+ * libedit keeps the history as a linked list, so every substring search
+ * is a scan of all entries.  The index mirrors the entries in an array
+ * keyed by event number and keeps a trigram -> event posting list, so a
+ * search only has to verify the entries filed under the rarest trigram
+ * of the pattern.
+ *
+ * A hash table keyed on the entry text counts how often each command
+ * was entered, which feeds the ranking of the fuzzy search.  It also
+ * knows the newest event holding each text, which is how a repeated
+ * command is found when the history is kept free of duplicates.  Each
+ * distinct text is stored once, in its count, and the slots of the
+ * entries holding it point there.
+ *
+ * The distinct texts are also kept sorted (once prefix navigation asks
+ * for them) so the entries starting with a prefix are one range, found
+ * with two binary searches.
+ *
+ ******************************************************************************/
 
-    /*fprintf(stderr, "ch = %d", ch);
-    fprintf(stderr, "  > li `%.*s_%.*s'\n",
-	    (int)(li->cursor - li->buffer), li->buffer,
-	    (int)(li->lastchar - 1 - li->cursor),
-	    (li->cursor >= li->lastchar) ? "" : li->cursor); */
-
-    Py_XDECREF(self->begidx);
-    Py_XDECREF(self->endidx);
-    self->begidx = PyLong_FromLong((long) 0);
-    self->endidx = PyLong_FromLong((long) (li->cursor - li->buffer));
-    
+#define HIDX_BUCKETS  (1 << 14)
 
-    /* tmp copy to do the decode */
-    copy_to_buffer(self, li->buffer, (li->cursor - li->buffer));
+typedef struct {
+    int    *events;      /* event numbers, ascending */
+    int     count;
+    int     alloc;
+} HistPosting;
 
-    /* push up to the main routine in python -- better to manage strings */
+typedef struct {
+    unsigned long long hash;    /* of the text, zero marks a free slot */
+    char   *text;               /* owned, shared by the entries' slots */
+    int     event;              /* newest event holding the text */
+    int     copies;             /* entries holding the text */
+    int     uses;               /* times the text was entered */
+} HistCount;
+
+typedef struct HistCandidates {
+    char    pattern[256];       /* folded pattern the candidates match */
+    size_t  plen;
+    int    *events;             /* matching events, newest first */
+    int    *ends;               /* where the leftmost match ends */
+    unsigned char *depth;       /* pattern characters it has been matched to */
+    int     count;
+    int     alloc;
+    int     valid;
+    unsigned int generation;    /* of the index they were taken from */
+} HistCandidates;
 
-#ifdef WITH_THREAD
-    PyGILState_STATE gilstate;
-    if (self == editline_module_state->global_instance)
-	gilstate = PyGILState_Ensure();
-#endif
+typedef struct {
+    char  **sorted;     /* distinct texts in strcmp order, owned */
+    int     count;
+    int     alloc;
+    char  **added;      /* distinct texts which turned up since, unsorted */
+    int     nadded;
+    int     added_alloc;
+    int     built;
+} HistPrefix;
 
-    /* t is created here but deallocated in CallMethod */
-    t = decode(self->buffer);
-    if (t == NULL || t == Py_None) {
-#ifdef WITH_THREAD
-	if (self == editline_module_state->global_instance)
-	    PyGILState_Release(gilstate);
-#endif
-	rv = CC_ERROR;
-	goto error;
-    }
+typedef struct {
+    char   *prefix;     /* NULL when no navigation is under way */
+    size_t  plen;
+    char   *saved;      /* the line as it was typed */
+    size_t  saved_len;
+    size_t  saved_point;
+    int    *heap;       /* newest events of the matches not reached yet */
+    int     heap_count;
+    int    *path;       /* events shown so far, newest first */
+    int     path_count;
+    int     path_alloc;
+    int     pos;        /* path[pos] is on the line, -1 for the saved line */
+    int     walk;       /* without a prefix, the next slot to look at */
+    int     shared_walk;    /* ... and then the next slot of the store */
+    unsigned int generation;
+} HistNavigation;
+
+typedef struct HistIndex {
+    char       **text;   /* text[i] belongs to event (base + i), see counts */
+    unsigned long long *masks;   /* characters present in text[i] */
+    int         *uses;   /* times text[i] was entered, as of the newest */
+    int          base;
+    int          first;  /* slots ahead of this have been evicted */
+    int          count;
+    int          alloc;
+    int          live;   /* slots holding an entry */
+    HistPosting *grams;
+    HistCount   *counts;
+    int          counts_size;    /* a power of two */
+    int          counts_used;
+    HistCandidates fuzzy;
+    HistPrefix   prefix;
+    HistNavigation nav;
+    unsigned int generation;     /* bumped whenever the entries change */
+} HistIndex;
+
+static unsigned int
+hidx_gram(const char *s)
+{
+    const unsigned char *u = (const unsigned char *) s;
+    unsigned int h = u[0] | (u[1] << 8) | (u[2] << 16);
 
-    /* this should call the overridden one too! */
-    r = PyObject_CallMethod((PyObject*)self, "_completer", "N", t);
+    return (h * 0x9E3779B1U) >> 18;
+}
 
-#ifdef WITH_THREAD
-    if (self == editline_module_state->global_instance)
-	PyGILState_Release(gilstate);
-#endif
+/* fold to lower case, the fuzzy search ignores case */
+#define HIDX_FOLD(c) \
+    (((c) >= 'A' && (c) <= 'Z') ? (c) + ('a' - 'A') : (c))
 
-    if (r == NULL || r == Py_None) {
-	rv = CC_ERROR;
-	goto error;
+/* one bit per letter and digit, the rest share the remaining bits */
+static unsigned long long
+hidx_mask(const char *s)
+{
+    unsigned long long mask = 0;
+    unsigned char c;
+
+    while ((c = (unsigned char) *s++) != '\0') {
+	c = HIDX_FOLD(c);
+	if (c >= 'a' && c <= 'z')
+	    mask |= 1ULL << (c - 'a');
+	else if (c >= '0' && c <= '9')
+	    mask |= 1ULL << (c - '0' + 26);
+	else
+	    mask |= 1ULL << (36 + c % 28);
     }
+    return mask;
+}
 
-    /* should check to be sure it is a long */    
-    if (!PyLong_Check(r)) {
-	rv = CC_ERROR;
-	goto error;
+/* FNV-1a, never zero */
+static unsigned long long
+hidx_hash(const char *s)
+{
+    unsigned long long h = 0xCBF29CE484222325ULL;
+
+    while (*s != '\0') {
+	h ^= (unsigned char) *s++;
+	h *= 0x100000001B3ULL;
     }
+    return h ? h : 1;
+}
 
-    rv = PyLong_AsLong(r);
+/* the count of exactly 'str' -- texts can share a hash */
+static HistCount *
+hidx_count_find(const HistIndex *idx, const char *str)
+{
+    unsigned long long hash = hidx_hash(str);
+    int mask = idx->counts_size - 1;
+    int i;
 
-  error:
-    Py_XDECREF(r);
+    if (idx->counts == NULL)
+	return NULL;
 
-    return rv;
+    for (i = (int) (hash & mask); idx->counts[i].hash != 0; i = (i + 1) & mask)
+	if (idx->counts[i].hash == hash && strcmp(idx->counts[i].text, str) == 0)
+	    return &idx->counts[i];
+    return NULL;
 }
 
-static char *
-_prompt(EditLine *el)
+static int
+hidx_count_grow(HistIndex *idx)
 {
-    int rv;
-    EditLineObject *self = NULL;
-
-    rv = el_get(el, EL_CLIENTDATA, &self);
+    HistCount *old = idx->counts;
+    int i, j, old_size = idx->counts_size;
+    int size = old_size ? old_size * 2 : 1024;
 
-    /* should raise exception or something */
-    if (rv < 0 || self == NULL) {
-	PyErr_SetString(PyExc_SystemError, "libedit lost clientdata");
-	return NULL;
+    idx->counts = PyMem_RawCalloc(size, sizeof(HistCount));
+    if (idx->counts == NULL) {
+	idx->counts = old;
+	return -1;
     }
+    idx->counts_size = size;
 
-    /* use the internal member */
-    return self->prompt;
+    for (i = 0; i < old_size; i++) {
+	if (old[i].hash == 0)
+	    continue;
+	for (j = (int) (old[i].hash & (size - 1)); idx->counts[j].hash != 0;
+	     j = (j + 1) & (size - 1))
+	    ;
+	idx->counts[j] = old[i];
+    }
+    PyMem_RawFree(old);
+    return 0;
 }
 
-static char *
-_rprompt(EditLine *el)
+/* account for another entry holding the text */
+static HistCount *
+hidx_count_add(HistIndex *idx, const char *str, int event)
 {
-    int rv;
-    EditLineObject *self = NULL;
+    HistCount *hc = hidx_count_find(idx, str);
+    unsigned long long hash;
+    size_t len;
+    char *copy;
+    int i, mask;
+
+    if (hc == NULL) {
+	/* keep the table at most three quarters full */
+	if ((idx->counts_used + 1) * 4 > idx->counts_size * 3 &&
+	    hidx_count_grow(idx) < 0)
+	    return NULL;
+	len = strlen(str);
+	copy = PyMem_RawMalloc(len + 1);
+	if (copy == NULL)
+	    return NULL;
+	memcpy(copy, str, len + 1);
+
+	hash = hidx_hash(str);
+	mask = idx->counts_size - 1;
+	for (i = (int) (hash & mask); idx->counts[i].hash != 0;
+	     i = (i + 1) & mask)
+	    ;
+	hc = &idx->counts[i];
+	hc->hash = hash;
+	hc->text = copy;
+	idx->counts_used++;
+    }
 
-    rv = el_get(el, EL_CLIENTDATA, &self);
+    hc->event = event;
+    hc->copies++;
+    hc->uses++;
+    return hc;
+}
 
-    /* should raise exception or something */
-    if (rv < 0 || self == NULL) {
-	PyErr_SetString(PyExc_SystemError, "libedit lost clientdata");
-	return NULL;
+/* an entry holding the text is gone, the last one takes the text along */
+static void
+hidx_count_drop(HistIndex *idx, const char *str)
+{
+    HistCount *hc = hidx_count_find(idx, str);
+    int i, j, home, mask = idx->counts_size - 1;
+
+    if (hc == NULL || --hc->copies > 0)
+	return;
+    PyMem_RawFree(hc->text);
+
+    /* backward shift deletion keeps the probe chains intact */
+    i = (int) (hc - idx->counts);
+    for (j = (i + 1) & mask; idx->counts[j].hash != 0; j = (j + 1) & mask) {
+	home = (int) (idx->counts[j].hash & mask);
+	if (((j - home) & mask) >= ((j - i) & mask)) {
+	    idx->counts[i] = idx->counts[j];
+	    i = j;
+	}
     }
-
-    /* use the internal member */
-    return self->rprompt;
+    memset(&idx->counts[i], 0, sizeof(HistCount));
+    idx->counts_used--;
 }
 
+static void
+hidx_prefix_free(HistIndex *idx);
 
-/*******************************************************************************
- *
- *              EditLine Object Definition
- *
- ******************************************************************************/
+static void
+hidx_candidates_free(HistCandidates *cand)
+{
+    PyMem_RawFree(cand->events);
+    PyMem_RawFree(cand->ends);
+    PyMem_RawFree(cand->depth);
+    memset(cand, 0, sizeof(*cand));
+}
 
 static void
-_cleanup_editlineobject(EditLineObject *self)
+hidx_clear(HistIndex *idx)
 {
-    /* mop up libedit */
-    if (self->el)
-	el_end(self->el);
-    if (self->tok)
-	tok_end(self->tok);
-    if (self->hist)
-	history_end(self->hist);
+    int i;
 
-    /* tidy up the allocated bits */
-    if (self->name)
-	PyMem_RawFree(self->name);
-    if (self->prompt)
-	PyMem_RawFree(self->prompt);
-    if (self->rprompt)
-	PyMem_RawFree(self->rprompt);
-    if (self->buffer)
-	PyMem_RawFree(self->buffer);
-    
-    /* manage file-handles? */
-    if (self->fin)
-	fclose(self->fin);
-    if (self->fout)
-	fclose(self->fout);
-    if (self->ferr)
-	fclose(self->ferr);
+    unsigned int generation = idx->generation;
 
-    /* release my ownership of the I/O refs */
-    Py_DECREF(self->pyin);
-    Py_DECREF(self->pyout);
-    Py_DECREF(self->pyerr);
+    hidx_prefix_free(idx);
+
+    /* the slots' texts belong to the counts */
+    for (i = 0; i < idx->counts_size; i++)
+	PyMem_RawFree(idx->counts[i].text);
+    PyMem_RawFree(idx->text);
+    PyMem_RawFree(idx->masks);
+    PyMem_RawFree(idx->uses);
+
+    if (idx->grams) {
+	for (i = 0; i < HIDX_BUCKETS; i++)
+	    PyMem_RawFree(idx->grams[i].events);
+	PyMem_RawFree(idx->grams);
+    }
+
+    PyMem_RawFree(idx->counts);
+    hidx_candidates_free(&idx->fuzzy);
+
+    memset(idx, 0, sizeof(*idx));
+    idx->generation = generation + 1;
 }
 
 static void
-elObj_dealloc(EditLineObject* self)
+hidx_free(HistIndex *idx)
 {
-    /* free up resources */
-    _cleanup_editlineobject(self);
-    
-    /* nuke myself */
-    Py_TYPE(self)->tp_free((PyObject*)self);
+    if (idx == NULL)
+	return;
+    hidx_clear(idx);
+    PyMem_RawFree(idx);
 }
 
+/* position of the first posting at or above 'event' */
 static int
-elObj_init(EditLineObject *self, PyObject *args, PyObject *kwds)
+hidx_lower_bound(const HistPosting *p, int event)
 {
-    PyObject *pyfd;
-    int fd_in, fd_out, fd_err, rv;
-    char *name;
+    int lo = 0, hi = p->count;
+
+    while (lo < hi) {
+	int mid = lo + (hi - lo) / 2;
+	if (p->events[mid] < event)
+	    lo = mid + 1;
+	else
+	    hi = mid;
+    }
+    return lo;
+}
 
-    if (!PyArg_ParseTuple(args, "sOOO", &name,
-			  &self->pyin, &self->pyout, &self->pyerr))
-	return -1;
+/* drop the evicted slots and every posting which refers to them */
+static void
+hidx_compact(HistIndex *idx)
+{
+    int i, cut;
+    HistPosting *p;
+
+    if (idx->first == 0)
+	return;
+
+    memmove(idx->text, idx->text + idx->first,
+	    (idx->count - idx->first) * sizeof(char *));
+    memmove(idx->masks, idx->masks + idx->first,
+	    (idx->count - idx->first) * sizeof(unsigned long long));
+    memmove(idx->uses, idx->uses + idx->first,
+	    (idx->count - idx->first) * sizeof(int));
+    idx->count -= idx->first;
+    idx->base += idx->first;
+    idx->first = 0;
+
+    for (i = 0; i < HIDX_BUCKETS; i++) {
+	p = &idx->grams[i];
+	cut = hidx_lower_bound(p, idx->base);
+	if (cut == 0)
+	    continue;
+	memmove(p->events, p->events + cut, (p->count - cut) * sizeof(int));
+	p->count -= cut;
+    }
+}
 
-    /* need to ensure I own the refs */
-    Py_INCREF(self->pyin);
-    Py_INCREF(self->pyout);
-    Py_INCREF(self->pyerr);
+static int
+hidx_post(HistPosting *p, int event)
+{
+    /* a trigram appearing twice in one entry is filed once */
+    if (p->count > 0 && p->events[p->count-1] == event)
+	return 0;
+
+    if (p->count == p->alloc) {
+	int nalloc = p->alloc ? p->alloc * 2 : 4;
+	int *nevents = PyMem_RawRealloc(p->events, nalloc * sizeof(int));
+	if (nevents == NULL)
+	    return -1;
+	p->events = nevents;
+	p->alloc = nalloc;
+    }
 
-    /* check that there is fileno() on each stream */
-    pyfd = PyObject_CallMethod(self->pyin, "fileno", NULL);
-    fd_in = (int) PyLong_AsLong(pyfd);
-    self->fin = fdopen(fd_in, "r");
-    pyfd = PyObject_CallMethod(self->pyout, "fileno", NULL);
-    fd_out = (int) PyLong_AsLong(pyfd);
-    self->fout = fdopen(fd_out, "w");
-    pyfd = PyObject_CallMethod(self->pyerr, "fileno", NULL);
-    fd_err = (int) PyLong_AsLong(pyfd);
-    self->ferr = fdopen(fd_err, "w");
+    p->events[p->count++] = event;
+    return 0;
+}
 
-    //printf("in: %d  out:%d  err:%d\n", fd_in, fd_out, fd_err);
+static void
+hidx_prefix_note(HistIndex *idx, const char *str);
 
-    /* save the name */
-    self->name = PyMem_RawMalloc(strlen(name)+1);
-    if (self->name == NULL) {
-	PyErr_NoMemory();
-	goto error;
+static int
+hidx_add(HistIndex *idx, int event, const char *str)
+{
+    size_t i, len = strlen(str);
+    int slot;
+    HistCount *hc;
+
+    /* events only ever count up -- going backwards means a reset */
+    if (event < idx->base + idx->count)
+	hidx_clear(idx);
+
+    if (idx->grams == NULL) {
+	idx->grams = PyMem_RawCalloc(HIDX_BUCKETS, sizeof(HistPosting));
+	if (idx->grams == NULL)
+	    return -1;
     }
-    strcpy(self->name, name);
 
-    /* prepare the default prompt */
-    #define MY_INIT_PROMPT "EL> "
-    self->prompt = PyMem_RawMalloc(strlen(MY_INIT_PROMPT)+1);
-    if (self->prompt == NULL) {
-	PyErr_NoMemory();
-	goto error;
+    if (idx->count == idx->first) {
+	idx->first = idx->count = 0;
+	idx->base = event;
     }
-    strcpy(self->prompt, MY_INIT_PROMPT);
-    self->prompt_esc = '\1';
+
+    slot = event - idx->base;
+    if (slot >= idx->alloc) {
+	/* reuse the evicted space before growing */
+	if (idx->first >= idx->count / 2) {
+	    hidx_compact(idx);
+	    slot = event - idx->base;
+	}
+	if (slot >= idx->alloc) {
+	    int nalloc = idx->alloc ? idx->alloc * 2 : 64;
+	    char **ntext;
+	    unsigned long long *nmasks;
+	    int *nuses;
+	    if (nalloc <= slot)
+		nalloc = slot + 1;
+	    ntext = PyMem_RawRealloc(idx->text, nalloc * sizeof(char *));
+	    if (ntext == NULL)
+		return -1;
+	    idx->text = ntext;
+	    nmasks = PyMem_RawRealloc(idx->masks,
+				      nalloc * sizeof(unsigned long long));
+	    if (nmasks == NULL)
+		return -1;
+	    idx->masks = nmasks;
+	    nuses = PyMem_RawRealloc(idx->uses, nalloc * sizeof(int));
+	    if (nuses == NULL)
+		return -1;
+	    idx->uses = nuses;
+	    idx->alloc = nalloc;
+	}
+    }
+
+    hc = hidx_count_add(idx, str, event);
+    if (hc == NULL)
+	return -1;
+
+    while (idx->count < slot)
+	idx->text[idx->count++] = NULL;
+    idx->text[slot] = hc->text;
+    idx->masks[slot] = hidx_mask(str);
+    idx->uses[slot] = hc->uses;
+    idx->count = slot + 1;
+    idx->live++;
+    idx->generation++;
+
+    for (i = 0; i + 3 <= len; i++)
+	if (hidx_post(&idx->grams[hidx_gram(str + i)], event) < 0)
+	    return -1;
+
+    /* the first copy of a text is new to the prefix index */
+    if (hc->copies == 1)
+	hidx_prefix_note(idx, str);
+
+    return 0;
+}
+
+/* a repeat of the newest entry was not stored, but it still counts */
+static void
+hidx_touch(HistIndex *idx, const char *str)
+{
+    HistCount *hc = hidx_count_find(idx, str);
+    int slot;
+
+    if (hc == NULL)
+	return;
+
+    hc->uses++;
+    slot = hc->event - idx->base;
+    if (slot >= idx->first && slot < idx->count && idx->text[slot] != NULL) {
+	idx->uses[slot] = hc->uses;
+	idx->generation++;
+    }
+}
+
+/* evict the oldest entries until no more than 'keep' are left */
+static void
+hidx_trim(HistIndex *idx, int keep)
+{
+    while (idx->live > keep && idx->first < idx->count) {
+	if (idx->text[idx->first] != NULL) {
+	    hidx_count_drop(idx, idx->text[idx->first]);
+	    idx->live--;
+	    idx->generation++;
+	}
+	idx->text[idx->first++] = NULL;
+    }
+}
+
+static const char *
+hidx_text(const HistIndex *idx, int event)
+{
+    int slot = event - idx->base;
+
+    if (slot < idx->first || slot >= idx->count)
+	return NULL;
+    return idx->text[slot];
+}
+
+/* newest event holding exactly 'str', or -1 */
+static int
+hidx_find(const HistIndex *idx, const char *str)
+{
+    HistCount *hc = hidx_count_find(idx, str);
+
+    /* the newest copy may have been deleted from under it */
+    if (hc == NULL || hidx_text(idx, hc->event) == NULL)
+	return -1;
+    return hc->event;
+}
+
+/* an entry was deleted from the middle of the history */
+static void
+hidx_remove(HistIndex *idx, int event)
+{
+    int slot = event - idx->base;
+
+    if (slot < idx->first || slot >= idx->count || idx->text[slot] == NULL)
+	return;
+
+    /* its postings stay behind and are skipped over as empty slots */
+    hidx_count_drop(idx, idx->text[slot]);
+    idx->text[slot] = NULL;
+    idx->live--;
+    idx->generation++;
+}
+
+static void
+hidx_nav_reset(HistNavigation *nav)
+{
+    PyMem_RawFree(nav->prefix);
+    PyMem_RawFree(nav->saved);
+    PyMem_RawFree(nav->heap);
+    PyMem_RawFree(nav->path);
+    memset(nav, 0, sizeof(*nav));
+}
+
+static void
+hidx_prefix_free(HistIndex *idx)
+{
+    HistPrefix *px = &idx->prefix;
+    int i;
+
+    for (i = 0; i < px->count; i++)
+	PyMem_RawFree(px->sorted[i]);
+    for (i = 0; i < px->nadded; i++)
+	PyMem_RawFree(px->added[i]);
+    PyMem_RawFree(px->sorted);
+    PyMem_RawFree(px->added);
+    memset(px, 0, sizeof(*px));
+
+    hidx_nav_reset(&idx->nav);
+}
+
+/* a text the history did not hold before -- noted once the index is built */
+static void
+hidx_prefix_note(HistIndex *idx, const char *str)
+{
+    HistPrefix *px = &idx->prefix;
+    size_t len = strlen(str);
+    char *copy;
+
+    if (!px->built)
+	return;
+
+    if (px->nadded == px->added_alloc) {
+	int nalloc = px->added_alloc ? px->added_alloc * 2 : 64;
+	char **nadded = PyMem_RawRealloc(px->added, nalloc * sizeof(char *));
+	if (nadded == NULL)
+	    goto lost;
+	px->added = nadded;
+	px->added_alloc = nalloc;
+    }
+
+    copy = PyMem_RawMalloc(len + 1);
+    if (copy == NULL)
+	goto lost;
+    memcpy(copy, str, len + 1);
+    px->added[px->nadded++] = copy;
+    return;
+
+ lost:
+    /* start over from the history the next time */
+    hidx_prefix_free(idx);
+}
+
+static int
+hidx_strcmp(const void *a, const void *b)
+{
+    return strcmp(*(char * const *) a, *(char * const *) b);
+}
+
+/*
+ * Get the sorted texts up to date: made from the hash table the first
+ * time, after that the texts added since are sorted and merged in, and
+ * the ones the history no longer holds are dropped on the way.
+ */
+static int
+hidx_prefix_build(HistIndex *idx)
+{
+    HistPrefix *px = &idx->prefix;
+    char **merged, **a, **b, **a_end, **b_end, *text;
+    const char *str;
+    int i, n = 0;
+
+    if (!px->built) {
+	px->sorted = PyMem_RawMalloc((idx->counts_used + 1) * sizeof(char *));
+	if (px->sorted == NULL)
+	    return -1;
+	for (i = 0; i < idx->counts_size; i++) {
+	    if (idx->counts[i].hash == 0)
+		continue;
+	    str = idx->counts[i].text;
+	    text = PyMem_RawMalloc(strlen(str) + 1);
+	    if (text == NULL) {
+		px->count = n;
+		hidx_prefix_free(idx);
+		return -1;
+	    }
+	    strcpy(text, str);
+	    px->sorted[n++] = text;
+	}
+	qsort(px->sorted, n, sizeof(char *), hidx_strcmp);
+	px->count = px->alloc = n;
+	px->built = 1;
+	return 0;
+    }
+
+    if (px->nadded == 0)
+	return 0;
+
+    qsort(px->added, px->nadded, sizeof(char *), hidx_strcmp);
+    merged = PyMem_RawMalloc((px->count + px->nadded) * sizeof(char *));
+    if (merged == NULL)
+	return -1;
+
+    a = px->sorted;
+    a_end = a + px->count;
+    b = px->added;
+    b_end = b + px->nadded;
+    while (a < a_end || b < b_end) {
+	if (b == b_end || (a < a_end && strcmp(*a, *b) <= 0))
+	    text = *a++;
+	else
+	    text = *b++;
+
+	/* gone from the history, or a text which came back */
+	if (hidx_find(idx, text) < 0 ||
+	    (n > 0 && strcmp(merged[n-1], text) == 0))
+	    PyMem_RawFree(text);
+	else
+	    merged[n++] = text;
+    }
+
+    PyMem_RawFree(px->sorted);
+    px->sorted = merged;
+    px->count = n;
+    px->alloc = n;
+    px->nadded = 0;
+    return 0;
+}
+
+/* first of the sorted texts at or above 'str' (compared over 'len') */
+static int
+hidx_prefix_bound(const HistPrefix *px, const char *str, size_t len, int upper)
+{
+    int lo = 0, hi = px->count, mid, cmp;
+
+    while (lo < hi) {
+	mid = lo + (hi - lo) / 2;
+	cmp = strncmp(px->sorted[mid], str, len);
+	if (cmp < 0 || (upper && cmp == 0))
+	    lo = mid + 1;
+	else
+	    hi = mid;
+    }
+    return lo;
+}
+
+static void
+hidx_heap_push(int *heap, int *count, int event)
+{
+    int i = (*count)++, parent;
+
+    for (; i > 0 && heap[parent = (i - 1) / 2] < event; i = parent)
+	heap[i] = heap[parent];
+    heap[i] = event;
+}
+
+static int
+hidx_heap_pop(int *heap, int *count)
+{
+    int top = heap[0], last = heap[--(*count)];
+    int i = 0, child;
+
+    while ((child = 2 * i + 1) < *count) {
+	if (child + 1 < *count && heap[child+1] > heap[child])
+	    child++;
+	if (heap[child] <= last)
+	    break;
+	heap[i] = heap[child];
+	i = child;
+    }
+    heap[i] = last;
+    return top;
+}
+
+/*
+ * Begin navigating the entries starting with 'prefix'.  The newest event
+ * of each distinct text in the prefix range goes on a heap, so every step
+ * back in time is one pop.  The entries of a 'shared' store come in below
+ * the index's own, which are numbered from 'base' on, and a text the
+ * index holds itself is not taken from the store.
+ */
+static int
+hidx_nav_start(HistIndex *idx, HistIndex *shared, int base,
+	       const char *prefix, size_t plen)
+{
+    HistNavigation *nav = &idx->nav;
+    HistPrefix *px = &idx->prefix;
+    int lo, hi, slo = 0, shi = 0, i, event;
+
+    hidx_nav_reset(nav);
+    nav->prefix = PyMem_RawMalloc(plen + 1);
+    if (nav->prefix == NULL)
+	return -1;
+    memcpy(nav->prefix, prefix, plen);
+    nav->prefix[plen] = '\0';
+    nav->plen = plen;
+    nav->pos = -1;
+    nav->walk = idx->count - 1;
+    nav->shared_walk = (shared != NULL) ? shared->count - 1 : -1;
+    nav->generation = idx->generation;
+
+    /* no prefix, every entry in turn */
+    if (plen == 0)
+	return 0;
+
+    if (hidx_prefix_build(idx) < 0)
+	return -1;
+
+    lo = hidx_prefix_bound(px, prefix, plen, 0);
+    hi = hidx_prefix_bound(px, prefix, plen, 1);
+    if (shared != NULL) {
+	slo = hidx_prefix_bound(&shared->prefix, prefix, plen, 0);
+	shi = hidx_prefix_bound(&shared->prefix, prefix, plen, 1);
+    }
+    nav->heap = PyMem_RawMalloc((hi - lo + shi - slo + 1) * sizeof(int));
+    if (nav->heap == NULL)
+	return -1;
+    for (i = lo; i < hi; i++) {
+	event = hidx_find(idx, px->sorted[i]);
+	if (event >= 0)
+	    hidx_heap_push(nav->heap, &nav->heap_count, base + event);
+    }
+    for (i = slo; i < shi; i++) {
+	if (hidx_find(idx, shared->prefix.sorted[i]) >= 0)
+	    continue;
+	event = hidx_find(shared, shared->prefix.sorted[i]);
+	if (event >= 0)
+	    hidx_heap_push(nav->heap, &nav->heap_count, event);
+    }
+
+    return 0;
+}
+
+/* the next older entry of the navigation, -1 when there is none */
+static int
+hidx_nav_older(HistIndex *idx, HistIndex *shared, int base)
+{
+    HistNavigation *nav = &idx->nav;
+    int event = -1;
+
+    if (nav->pos + 1 < nav->path_count)
+	return nav->path[++nav->pos];
+
+    if (nav->plen == 0) {
+	while (nav->walk >= idx->first && idx->text[nav->walk] == NULL)
+	    nav->walk--;
+	if (nav->walk >= idx->first)
+	    event = base + idx->base + nav->walk--;
+	else if (shared != NULL) {
+	    while (nav->shared_walk >= shared->first &&
+		   shared->text[nav->shared_walk] == NULL)
+		nav->shared_walk--;
+	    if (nav->shared_walk >= shared->first)
+		event = shared->base + nav->shared_walk--;
+	}
+    }
+    else if (nav->heap_count > 0)
+	event = hidx_heap_pop(nav->heap, &nav->heap_count);
+
+    if (event < 0)
+	return -1;
+
+    if (nav->path_count == nav->path_alloc) {
+	int nalloc = nav->path_alloc ? nav->path_alloc * 2 : 16;
+	int *npath = PyMem_RawRealloc(nav->path, nalloc * sizeof(int));
+	if (npath == NULL)
+	    return -1;
+	nav->path = npath;
+	nav->path_alloc = nalloc;
+    }
+    nav->path[nav->path_count++] = event;
+    nav->pos = nav->path_count - 1;
+    return event;
+}
+
+/*
+ * Collect up to 'limit' events older than 'before' whose text contains
+ * 'pattern', newest first.  Returns the number of events found.
+ */
+static int
+hidx_search(const HistIndex *idx, const char *pattern, int before,
+	    int *found, int limit)
+{
+    size_t i, plen = strlen(pattern);
+    int n = 0, top, low, pos, event;
+    const HistPosting *best = NULL, *p;
+    const char *text;
+
+    if (idx->grams == NULL)
+	return 0;
+
+    /* short patterns have no trigram, check every entry */
+    if (plen < 3) {
+	top = before - idx->base;
+	if (top > idx->count)
+	    top = idx->count;
+	for (pos = top - 1; pos >= idx->first && n < limit; pos--) {
+	    text = idx->text[pos];
+	    if (text != NULL && strstr(text, pattern) != NULL)
+		found[n++] = idx->base + pos;
+	}
+	return n;
+    }
+
+    /* the rarest trigram gives the shortest list to verify */
+    for (i = 0; i + 3 <= plen; i++) {
+	p = &idx->grams[hidx_gram(pattern + i)];
+	if (best == NULL || p->count < best->count)
+	    best = p;
+    }
+
+    low = hidx_lower_bound(best, idx->base + idx->first);
+    pos = hidx_lower_bound(best, before);
+    while (pos-- > low && n < limit) {
+	event = best->events[pos];
+	text = idx->text[event - idx->base];
+	if (text != NULL && strstr(text, pattern) != NULL)
+	    found[n++] = event;
+    }
+
+    return n;
+}
+
+/*
+ * fzf style score of the match of 'pattern' (already folded) which ends
+ * just ahead of 'end'.  The tightest span ending there is scored: points
+ * for every matched character, more when it follows another match or
+ * starts a word, and a point off for every character skipped.  Nothing
+ * scores more than 24 per character plus 8.
+ */
+static int
+hidx_fuzzy_score(const char *text, const char *end, const char *pattern,
+		 size_t plen)
+{
+    const char *t, *start;
+    size_t i;
+    int score = 0, matched = 0;
+
+    if (plen == 0)
+	return 0;
+
+    /* walk back from the end for the tightest start */
+    for (i = plen, t = end - 1; ; t--) {
+	if (HIDX_FOLD(*t) == pattern[i-1] && --i == 0)
+	    break;
+    }
+    start = t;
+
+    for (i = 0, t = start; t < end; t++) {
+	if (i < plen && HIDX_FOLD(*t) == pattern[i]) {
+	    score += 16;
+	    if (matched || t == text || !isalnum((unsigned char) t[-1]))
+		score += 8;
+	    matched = 1;
+	    i++;
+	}
+	else {
+	    score--;
+	    matched = 0;
+	}
+    }
+
+    if (start == text)
+	score += 8;
+
+    return score;
+}
+
+static int
+hidx_log2(unsigned int value)
+{
+    int bits = 0;
+
+    while (value >>= 1)
+	bits++;
+    return bits;
+}
+
+#define FUZZY_TOP 64
+
+typedef struct {
+    int     event;
+    int     rank;
+} HistRanked;
+
+/*
+ * Rank the entries matching 'pattern' as a subsequence by score, how often
+ * they were entered and how recent they are.  The best 'limit' (at most
+ * FUZZY_TOP, duplicates dropped) go to 'top', best first.  Returns the
+ * number placed there.
+ *
+ * The candidates are kept along with how far into the pattern their
+ * leftmost match has been followed, so when the pattern grows only the
+ * previous candidates are checked, and only for the new characters.  A
+ * candidate which could not be placed even with a perfect score is not
+ * looked at at all -- it stays in the running as it is.  The candidates
+ * live in 'cand', the index's own unless the index is shared, and 'age'
+ * is added to the age of every entry (entries newer than the index).
+ */
+static int
+hidx_fuzzy(HistIndex *idx, HistCandidates *cand, const char *pattern,
+	   HistRanked *top, int limit, int age)
+{
+    char folded[sizeof(cand->pattern)];
+    unsigned long long pmask;
+    size_t plen, i;
+    int j, k, n = 0, ntop = 0, newest, event, rank, best, slot, end, scan;
+    const char *text, *t;
+
+    for (plen = 0; pattern[plen] != '\0' && plen + 1 < sizeof(folded); plen++)
+	folded[plen] = HIDX_FOLD(pattern[plen]);
+    folded[plen] = '\0';
+    pmask = hidx_mask(folded);
+    best = (plen == 0) ? 0 : 4 * (24 * (int) plen + 8);
+
+    if (limit < 1 || limit > FUZZY_TOP)
+	limit = FUZZY_TOP;
+    newest = idx->base + idx->count - 1;
+
+    /* narrow the previous candidates or start over with every entry */
+    scan = !(cand->valid && cand->generation == idx->generation &&
+	     plen >= cand->plen && memcmp(cand->pattern, folded, cand->plen) == 0);
+    if (scan && cand->alloc < idx->live) {
+	int *nevents = PyMem_RawRealloc(cand->events, idx->live * sizeof(int));
+	int *nends = PyMem_RawRealloc(cand->ends, idx->live * sizeof(int));
+	unsigned char *ndepth = PyMem_RawRealloc(cand->depth, idx->live);
+	if (nevents != NULL)
+	    cand->events = nevents;
+	if (nends != NULL)
+	    cand->ends = nends;
+	if (ndepth != NULL)
+	    cand->depth = ndepth;
+	if (nevents == NULL || nends == NULL || ndepth == NULL) {
+	    cand->valid = 0;
+	    return -1;
+	}
+	cand->alloc = idx->live;
+    }
+    k = scan ? idx->count - 1 : 0;
+
+    for (;;) {
+	if (scan) {
+	    if (k < idx->first)
+		break;
+	    slot = k--;
+	    end = 0;
+	    i = 0;
+	    if (idx->text[slot] == NULL)
+		continue;
+	}
+	else {
+	    if (k >= cand->count)
+		break;
+	    slot = cand->events[k] - idx->base;
+	    end = cand->ends[k];
+	    i = cand->depth[k++];
+	}
+
+	if ((idx->masks[slot] & pmask) != pmask)
+	    continue;
+
+	event = idx->base + slot;
+	rank = 8 * hidx_log2(idx->uses[slot]) -
+	    2 * hidx_log2(newest - event + 1 + age);
+
+	/* no chance of being placed, leave it be */
+	if (ntop == limit && rank + best <= top[ntop-1].rank) {
+	    cand->events[n] = event;
+	    cand->ends[n] = end;
+	    cand->depth[n++] = (unsigned char) i;
+	    continue;
+	}
+
+	/* carry the leftmost match on over the new characters */
+	text = idx->text[slot];
+	for (t = text + end; i < plen && *t != '\0'; t++)
+	    if (HIDX_FOLD(*t) == folded[i])
+		i++;
+	if (i < plen)
+	    continue;
+
+	cand->events[n] = event;
+	cand->ends[n] = (int) (t - text);
+	cand->depth[n++] = (unsigned char) plen;
+
+	rank += 4 * hidx_fuzzy_score(text, t, folded, plen);
+
+	/* older copies of a line already placed can only rank lower */
+	if (ntop == limit && rank <= top[ntop-1].rank)
+	    continue;
+	for (j = 0; j < ntop; j++)
+	    if (strcmp(idx->text[top[j].event - idx->base], text) == 0)
+		break;
+	if (j < ntop)
+	    continue;
+
+	if (ntop < limit)
+	    ntop++;
+	for (j = ntop - 1; j > 0 && top[j-1].rank < rank; j--)
+	    top[j] = top[j-1];
+	top[j].event = event;
+	top[j].rank = rank;
+    }
+
+    memcpy(cand->pattern, folded, plen + 1);
+    cand->plen = plen;
+    cand->count = n;
+    cand->generation = idx->generation;
+    cand->valid = 1;
+
+    return ntop;
+}
+
+/*******************************************************************************
+ *
+ *              Shared History Store
+ *
+ * Sessions which all start from one site-wide history would each hold a
+ * copy of it, in libedit and in the index.  A HistoryStore indexes those
+ * entries once and any number of instances can take it on as the common
+ * part of their history, keeping only their own session's entries in
+ * libedit.  A store never changes once made, so the sessions sharing it
+ * only ever read it and it lives for as long as one of them refers to it.
+ *
+ * Its entries are numbered 1 to len(store) and a session's own entries
+ * are numbered on from there by the searches, the navigation and
+ * history_event().  libedit's own history commands only see the session.
+ *
+ ******************************************************************************/
+
+typedef struct HistoryStoreObject {
+    PyObject_HEAD
+    HistIndex *hidx;
+    int        size;     /* entries, numbered 1 to size */
+} HistoryStoreObject;
+
+static PyTypeObject HistoryStoreType;
+
+static void
+_history_store_release(EditLineObject *self)
+{
+    if (self->store_fuzzy != NULL) {
+	hidx_candidates_free(self->store_fuzzy);
+	PyMem_RawFree(self->store_fuzzy);
+	self->store_fuzzy = NULL;
+    }
+    Py_CLEAR(self->store);
+}
+
+/* the session's own events are numbered on from the store's */
+static int
+_history_base(EditLineObject *self)
+{
+    return (self->store != NULL) ? self->store->size : 0;
+}
+
+static const char *
+_history_text(EditLineObject *self, int event)
+{
+    int base = _history_base(self);
+
+    if (event > base)
+	return hidx_text(self->hidx, event - base);
+    if (self->store != NULL)
+	return hidx_text(self->store->hidx, event);
+    return NULL;
+}
+
+/* hidx_search() over the session's entries, then on into the store's */
+static int
+_history_search(EditLineObject *self, const char *pattern, int before,
+		int *found, int limit)
+{
+    int base = _history_base(self), n = 0, i;
+
+    if (before > base) {
+	n = hidx_search(self->hidx, pattern, before - base, found, limit);
+	for (i = 0; i < n; i++)
+	    found[i] += base;
+	before = base + 1;
+    }
+    if (self->store != NULL && n < limit)
+	n += hidx_search(self->store->hidx, pattern, before,
+			 found + n, limit - n);
+
+    return n;
+}
+
+/* hidx_fuzzy() of the session's entries with the store's ranked in */
+static int
+_history_fuzzy(EditLineObject *self, const char *pattern, HistRanked *top,
+	       int limit)
+{
+    HistRanked more[FUZZY_TOP];
+    HistIndex *shared;
+    int base = _history_base(self), ntop, nmore, i, j;
+
+    if (limit < 1 || limit > FUZZY_TOP)
+	limit = FUZZY_TOP;
+
+    ntop = hidx_fuzzy(self->hidx, &self->hidx->fuzzy, pattern, top, limit, 0);
+    if (ntop < 0 || self->store == NULL)
+	return ntop;
+    for (i = 0; i < ntop; i++)
+	top[i].event += base;
+
+    /* the store's entries are all older than the session's */
+    shared = self->store->hidx;
+    nmore = hidx_fuzzy(shared, self->store_fuzzy, pattern, more, limit,
+		       self->hidx->live);
+    if (nmore < 0)
+	return -1;
+
+    for (i = 0; i < nmore; i++) {
+	if (ntop == limit && more[i].rank <= top[ntop-1].rank)
+	    break;
+	/* the session's copy of a text stands for it */
+	if (hidx_find(self->hidx, hidx_text(shared, more[i].event)) >= 0)
+	    continue;
+	if (ntop < limit)
+	    ntop++;
+	for (j = ntop - 1; j > 0 && top[j-1].rank < more[i].rank; j--)
+	    top[j] = top[j-1];
+	top[j] = more[i];
+    }
+
+    return ntop;
+}
+
+/*
+ * A history file read in the background is merged, if it is done with,
+ * before a search or a navigation looks through the history.
+ */
+static void
+_history_wanted(EditLineObject *self)
+{
+    PyObject *r;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+
+    gilstate = PyGILState_Ensure();
+#endif
+    r = call_upcall(self, str_merge_history, NULL, NULL);
+    if (r == NULL)
+	PyErr_Clear();
+    Py_XDECREF(r);
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+}
+
+/* keep the index down to the number of entries libedit holds */
+static void
+_history_index_sync(EditLineObject *self)
+{
+    HistEvent ev;
+
+    if (history(self->hist, &ev, H_GETSIZE) >= 0)
+	hidx_trim(self->hidx, ev.num);
+}
+
+/* H_DEL of one event, keeping the index in step */
+static int
+_history_delete(EditLineObject *self, int event)
+{
+    HistEvent ev;
+    int rv;
+
+    rv = history(self->hist, &ev, H_DEL, event);
+    if (rv >= 0) {
+	/* libedit hands back a copy of the deleted text */
+	free((void *) ev.str);
+	hidx_remove(self->hidx, event);
+    }
+    return rv;
+}
+
+/*
+ * Drop every entry which has a newer copy.  The walk goes from newest to
+ * oldest so libedit's cursor already sits on each entry it deletes and
+ * H_DEL does not have to go looking for it.
+ */
+static void
+_history_dedupe_all(EditLineObject *self)
+{
+    HistEvent ev;
+    int rv, newest;
+
+    for (rv = history(self->hist, &ev, H_FIRST); rv >= 0;
+	 rv = history(self->hist, &ev, H_NEXT)) {
+	newest = hidx_find(self->hidx, ev.str);
+	if (newest >= 0 && newest != ev.num &&
+	    _history_delete(self, ev.num) < 0)
+	    break;
+    }
+}
+
+/* rebuild the index from the history itself (after H_LOAD) */
+static void
+_history_reindex(EditLineObject *self)
+{
+    HistEvent ev;
+    int rv;
+
+    hidx_clear(self->hidx);
+    for (rv = history(self->hist, &ev, H_LAST); rv >= 0;
+	 rv = history(self->hist, &ev, H_PREV)) {
+	if (hidx_add(self->hidx, ev.num, ev.str) < 0) {
+	    hidx_clear(self->hidx);
+	    return;
+	}
+    }
+
+    if (self->hist_dedupe)
+	_history_dedupe_all(self);
+}
+
+/* every H_ENTER goes through here so the index stays in step */
+static int
+_history_enter(EditLineObject *self, const char *str)
+{
+    HistEvent ev;
+    int rv, old = -1;
+
+    /* take an earlier copy out first so it does not count against the size */
+    if (self->hist_dedupe) {
+	old = hidx_find(self->hidx, str);
+	if (old >= 0 && history(self->hist, &ev, H_DEL, old) >= 0)
+	    free((void *) ev.str);
+	else
+	    old = -1;
+    }
+
+    rv = history(self->hist, &ev, H_ENTER, str);
+
+    /* zero means H_SETUNIQUE swallowed a repeat of the last entry */
+    if (rv > 0) {
+	/* the new copy inherits the use count before the old one goes */
+	if (hidx_add(self->hidx, ev.num, str) < 0)
+	    hidx_clear(self->hidx);
+    }
+    else if (rv == 0)
+	hidx_touch(self->hidx, str);
+
+    if (old >= 0)
+	hidx_remove(self->hidx, old);
+    if (rv > 0)
+	_history_index_sync(self);
+
+    return rv;
+}
+
+static PyObject *
+dump_state(EditLineObject *self, PyObject *noarg);
+
+static unsigned char
+el_bracketed_paste(EditLine *el, int ch);
+
+static void
+_paste_mode(EditLineObject *self, int on);
+
+static int
+_batch_close(EditLineObject *self, int rv);
+
+static void
+_hscroll_begin(EditLineObject *self);
+
+static void
+_hscroll_end(EditLineObject *self, int newline);
+
+static int
+_input_getc(EditLine *el, wchar_t *wc);
+
+static PyObject *
+_histevent_to_pyobject(HistEvent *ev);
+
+/* callback triggered from libedit on a completion-char request */
+static unsigned char
+el_complete(EditLine *el, int ch)
+{
+    const LineInfoW *lw = el_wline(el);
+    EditLineObject *self = NULL;
+    int rv = CC_REFRESH;
+    PyObject *r = NULL;
+    PyObject *t;
+    int len = lw->cursor - lw->buffer;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+#endif
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL) {
+        PyErr_BadInternalCall();
+        return CC_FATAL;
+    }
+
+    /*fprintf(stderr, "ch = %d", ch);
+    fprintf(stderr, "  > lw `%.*ls_%.*ls'\n",
+	    (int)(lw->cursor - lw->buffer), lw->buffer,
+	    (int)(lw->lastchar - 1 - lw->cursor),
+	    (lw->cursor >= lw->lastchar) ? L"" : lw->cursor); */
+
+    /* libedit is reading without the GIL, take it for the upcall */
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+
+    self->begidx = 0;
+    self->endidx = len;
+
+    /* keystrokes since Python last saw the line */
+    self->line_gen++;
+    self->batch_depth++;
+
+    /* straight from libedit's own (wide) line, up to the cursor */
+    t = PyUnicode_FromWideChar(lw->buffer, len);
+    if (t == NULL) {
+	rv = CC_ERROR;
+	goto error;
+    }
+
+    /* push up to the main routine in python -- better to manage strings */
+
+    /* this should call the overridden one too! */
+    r = call_upcall(self, str_completer, t, NULL);
+    Py_DECREF(t);
+
+    /* a view kept beyond the completer would outlive the line */
+    if (r != NULL && self->line_exports > 0) {
+	Py_DECREF(r);
+	r = NULL;
+	PyErr_SetString(PyExc_BufferError,
+			"line_view() held beyond the completer");
+	PyErr_WriteUnraisable((PyObject *) self);
+    }
+
+    if (r == NULL || r == Py_None) {
+	rv = CC_ERROR;
+	goto error;
+    }
+
+    /* should check to be sure it is a long */    
+    if (!PyLong_Check(r)) {
+	rv = CC_ERROR;
+	goto error;
+    }
+
+    rv = PyLong_AsLong(r);
+
+  error:
+    Py_XDECREF(r);
+    rv = _batch_close(self, rv);
+
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+
+    return rv;
+}
+
+/* swap the edit line for 'len' bytes of text, the cursor at byte 'point' */
+static void
+_replace_line(EditLineObject *self, EditLine *el, const char *text,
+	      size_t len, size_t point)
+{
+    const LineInfoW *lw = el_wline(el);
+    int chars = lw->lastchar - lw->buffer;
+    size_t wlen, tail;
+    wchar_t *wtext;
+
+    if (copy_to_buffer(self, text, len) != 0)
+	return;
+
+    /* libedit edits and moves the cursor in characters, not bytes */
+    wlen = mbstowcs(NULL, self->buffer, 0);
+    tail = mbstowcs(NULL, self->buffer + point, 0);
+    if (wlen == (size_t) -1 || tail == (size_t) -1)
+	return;
+    wtext = PyMem_RawMalloc((wlen + 1) * sizeof(wchar_t));
+    if (wtext == NULL)
+	return;
+    mbstowcs(wtext, self->buffer, wlen + 1);
+
+    self->line_gen++;
+    el_cursor(el, lw->lastchar - lw->cursor);
+    el_wdeletestr(el, chars);
+    el_winsertstr(el, wtext);
+    el_cursor(el, -(int) tail);
+    PyMem_RawFree(wtext);
+}
+
+/* copy of the edit line, its length and the cursor offset (in bytes) */
+static char *
+_copy_line(EditLine *el, size_t *len, size_t *point)
+{
+    const LineInfoW *lw = el_wline(el);
+    const wchar_t *wc;
+    mbstate_t mbs;
+    char *copy, *p;
+    size_t n;
+
+    copy = PyMem_RawMalloc((lw->lastchar - lw->buffer) * MB_CUR_MAX + 1);
+    if (copy == NULL)
+	return NULL;
+
+    memset(&mbs, 0, sizeof(mbs));
+    *point = 0;
+    for (p = copy, wc = lw->buffer; wc < lw->lastchar; wc++) {
+	if (wc == lw->cursor)
+	    *point = p - copy;
+	n = wcrtomb(p, *wc, &mbs);
+	if (n == (size_t) -1) {
+	    memset(&mbs, 0, sizeof(mbs));
+	    *p = '?';
+	    n = 1;
+	}
+	p += n;
+    }
+    if (lw->cursor >= lw->lastchar)
+	*point = p - copy;
+    *p = '\0';
+    *len = p - copy;
+
+    return copy;
+}
+
+/* add a character typed to a (multibyte) search pattern, if it fits */
+static int
+_pattern_add(char *pattern, size_t *plen, size_t size, wchar_t wc)
+{
+    char mb[MB_LEN_MAX];
+    mbstate_t mbs;
+    size_t n;
+
+    memset(&mbs, 0, sizeof(mbs));
+    n = wcrtomb(mb, wc, &mbs);
+    if (n == (size_t) -1 || *plen + n >= size)
+	return 0;
+    memcpy(pattern + *plen, mb, n);
+    *plen += n;
+    pattern[*plen] = '\0';
+    return 1;
+}
+
+/* drop the last character of a search pattern */
+static void
+_pattern_rubout(char *pattern, size_t *plen)
+{
+    mbstate_t mbs;
+    size_t at = 0, n;
+
+    memset(&mbs, 0, sizeof(mbs));
+    while (at < *plen) {
+	n = mbrtowc(NULL, pattern + at, *plen - at, &mbs);
+	if (n == (size_t) -1 || n == (size_t) -2 || n == 0) {
+	    memset(&mbs, 0, sizeof(mbs));
+	    n = 1;
+	}
+	if (at + n >= *plen)
+	    break;
+	at += n;
+    }
+    *plen = at;
+    pattern[at] = '\0';
+}
+
+/* callback triggered from libedit for an incremental history search */
+static unsigned char
+el_search_history(EditLine *el, int ch)
+{
+    EditLineObject *self = NULL;
+    char pattern[256];
+    char status[sizeof(pattern) + 32];
+    size_t plen = 0, len, orig_len, orig_point;
+    char *orig;
+    const char *text = NULL, *match;
+    int rv = CC_REFRESH;
+    int before = INT_MAX, event = 0, found, got;
+    wchar_t c;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+#endif
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return CC_FATAL;
+
+    /* hang on to the line in case the search is abandoned */
+    orig = _copy_line(el, &orig_len, &orig_point);
+    if (orig == NULL)
+	return CC_ERROR;
+
+    /* Python changes the index under the GIL, let go only for the keys */
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+    _history_wanted(self);
+    _history_index_sync(self);
+    pattern[0] = '\0';
+    self->search_status = status;
+
+    for (;;) {
+	snprintf(status, sizeof(status), "%ssearch: %s",
+		 (plen > 0 && text == NULL) ? "failed " : "", pattern);
+	el_set(el, EL_REFRESH);
+
+#ifdef WITH_THREAD
+	PyGILState_Release(gilstate);
+#endif
+	got = el_wgetc(el, &c);
+#ifdef WITH_THREAD
+	gilstate = PyGILState_Ensure();
+#endif
+	if (got != 1) {
+	    _replace_line(self, el, orig, orig_len, orig_point);
+	    break;
+	}
+
+	/* ^R looks further back for the same pattern */
+	if (c == '\022') {
+	    if (event == 0)
+		continue;
+	    before = event;
+	}
+
+	/* ^G gives up and puts the line back */
+	else if (c == '\007') {
+	    _replace_line(self, el, orig, orig_len, orig_point);
+	    break;
+	}
+
+	/* rubout shortens the pattern and starts again at the newest */
+	else if (c == '\010' || c == '\177') {
+	    if (plen == 0)
+		continue;
+	    _pattern_rubout(pattern, &plen);
+	    before = INT_MAX;
+	}
+
+	/* accept the match as the line */
+	else if (c == '\n' || c == '\r') {
+	    rv = CC_NEWLINE;
+	    break;
+	}
+
+	/* any other control key keeps the match and is handled as usual */
+	else if (c < L' ') {
+	    wchar_t pushed[2] = { c, L'\0' };
+	    el_wpush(el, pushed);
+	    break;
+	}
+
+	/* grow the pattern -- the current match may still do */
+	else {
+	    if (!_pattern_add(pattern, &plen, sizeof(pattern), c))
+		continue;
+	    before = (event == 0) ? INT_MAX : event + 1;
+	}
+
+	text = NULL;
+	if (_history_search(self, pattern, before, &found, 1) == 1) {
+	    event = found;
+	    text = _history_text(self, event);
+	    match = strstr(text, pattern);
+	    len = strlen(text);
+	    if (len > 0 && text[len-1] == '\n')
+		len--;
+	    _replace_line(self, el, text, len, match - text);
+	}
+    }
+
+    self->search_status = NULL;
+    PyMem_RawFree(orig);
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+
+    return rv;
+}
+
+/* callback triggered from libedit for the ranked (fuzzy) history search */
+static unsigned char
+el_fuzzy_history(EditLine *el, int ch)
+{
+    EditLineObject *self = NULL;
+    HistRanked top[FUZZY_TOP];
+    char pattern[256];
+    char status[sizeof(pattern) + 48];
+    size_t plen = 0, len, orig_len, orig_point;
+    char *orig;
+    const char *text;
+    int rv = CC_REFRESH, ntop = 0, pick = 0, rerank = 1, got;
+    wchar_t c;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+#endif
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return CC_FATAL;
+
+    orig = _copy_line(el, &orig_len, &orig_point);
+    if (orig == NULL)
+	return CC_ERROR;
+
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+    _history_wanted(self);
+    _history_index_sync(self);
+    pattern[0] = '\0';
+    self->search_status = status;
+
+    for (;;) {
+	if (rerank) {
+	    ntop = _history_fuzzy(self, pattern, top, FUZZY_TOP);
+	    if (ntop < 0)
+		ntop = 0;
+	    pick = 0;
+	    rerank = 0;
+	}
+
+	/* without a match the last one shown stays put */
+	if (ntop > 0) {
+	    text = _history_text(self, top[pick].event);
+	    len = strlen(text);
+	    if (len > 0 && text[len-1] == '\n')
+		len--;
+	    _replace_line(self, el, text, len, len);
+	}
+
+	snprintf(status, sizeof(status), "fuzzy %d/%d: %s",
+		 ntop ? pick + 1 : 0, ntop, pattern);
+	el_set(el, EL_REFRESH);
+
+#ifdef WITH_THREAD
+	PyGILState_Release(gilstate);
+#endif
+	got = el_wgetc(el, &c);
+#ifdef WITH_THREAD
+	gilstate = PyGILState_Ensure();
+#endif
+	if (got != 1) {
+	    _replace_line(self, el, orig, orig_len, orig_point);
+	    break;
+	}
+
+	/* ^R/^P and ^S/^N step down and up the ranking */
+	if (c == '\022' || c == '\020') {
+	    if (pick + 1 < ntop)
+		pick++;
+	}
+	else if (c == '\023' || c == '\016') {
+	    if (pick > 0)
+		pick--;
+	}
+
+	/* ^G gives up and puts the line back */
+	else if (c == '\007') {
+	    _replace_line(self, el, orig, orig_len, orig_point);
+	    break;
+	}
+
+	else if (c == '\010' || c == '\177') {
+	    if (plen == 0)
+		continue;
+	    _pattern_rubout(pattern, &plen);
+	    rerank = 1;
+	}
+
+	/* accept the pick as the line */
+	else if (c == '\n' || c == '\r') {
+	    rv = CC_NEWLINE;
+	    break;
+	}
+
+	/* any other control key keeps the pick and is handled as usual */
+	else if (c < L' ') {
+	    wchar_t pushed[2] = { c, L'\0' };
+	    el_wpush(el, pushed);
+	    break;
+	}
+
+	else if (_pattern_add(pattern, &plen, sizeof(pattern), c))
+	    rerank = 1;
+    }
+
+    self->search_status = NULL;
+    PyMem_RawFree(orig);
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+
+    return rv;
+}
+
+/*
+ * Up/Down through the entries which start with what was typed ahead of
+ * the cursor.  A navigation carries on for as long as the line holds
+ * what it last put there, any edit starts a new one.
+ */
+static unsigned char
+_prefix_navigate(EditLine *el, int older)
+{
+    EditLineObject *self = NULL;
+    HistNavigation *nav;
+    HistIndex *shared;
+    size_t len, point;
+    char *line;
+    const char *text;
+    int event, current;
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return CC_FATAL;
+
+    line = _copy_line(el, &len, &point);
+    if (line == NULL)
+	return CC_ERROR;
+
+    _history_index_sync(self);
+    nav = &self->hidx->nav;
+    shared = (self->store != NULL) ? self->store->hidx : NULL;
+
+    /* what the navigation put on the line last */
+    current = 0;
+    if (nav->prefix != NULL && nav->generation == self->hidx->generation) {
+	if (nav->pos < 0)
+	    current = (len == nav->saved_len &&
+		       memcmp(line, nav->saved, len) == 0);
+	else {
+	    text = _history_text(self, nav->path[nav->pos]);
+	    current = (text != NULL && strncmp(text, line, len) == 0 &&
+		       (text[len] == '\0' ||
+			(text[len] == '\n' && text[len+1] == '\0')));
+	}
+    }
+
+    if (!current) {
+	/* not part way through a navigation, which merging would upset */
+	_history_wanted(self);
+	_history_index_sync(self);
+	if (hidx_nav_start(self->hidx, shared, _history_base(self),
+			   line, point) < 0) {
+	    hidx_nav_reset(nav);
+	    PyMem_RawFree(line);
+	    return CC_ERROR;
+	}
+	nav->saved = line;
+	nav->saved_len = len;
+	nav->saved_point = point;
+    }
+    else
+	PyMem_RawFree(line);
+
+    if (older)
+	event = hidx_nav_older(self->hidx, shared, _history_base(self));
+    else if (nav->pos >= 0)
+	event = (--nav->pos >= 0) ? nav->path[nav->pos] : 0;
+    else
+	event = -1;
+
+    if (event < 0)
+	return CC_REFRESH_BEEP;
+
+    /* back past the newest match is the line as it was typed */
+    if (nav->pos < 0) {
+	_replace_line(self, el, nav->saved, nav->saved_len, nav->saved_point);
+	return CC_REFRESH;
+    }
+
+    text = _history_text(self, event);
+    len = strlen(text);
+    if (len > 0 && text[len-1] == '\n')
+	len--;
+    _replace_line(self, el, text, len, len);
+
+    return CC_REFRESH;
+}
+
+/* as the searches, under the GIL Python changes the index with */
+static unsigned char
+_prefix_history(EditLine *el, int older)
+{
+    unsigned char rv;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+
+    gilstate = PyGILState_Ensure();
+#endif
+    rv = _prefix_navigate(el, older);
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+    return rv;
+}
+
+static unsigned char
+el_prefix_prev_history(EditLine *el, int ch)
+{
+    return _prefix_history(el, 1);
+}
+
+static unsigned char
+el_prefix_next_history(EditLine *el, int ch)
+{
+    return _prefix_history(el, 0);
+}
+
+static char *
+_prompt(EditLine *el)
+{
+    int rv;
+    EditLineObject *self = NULL;
+
+    rv = el_get(el, EL_CLIENTDATA, &self);
+
+    /* should raise exception or something */
+    if (rv < 0 || self == NULL) {
+	PyErr_SetString(PyExc_SystemError, "libedit lost clientdata");
+	return NULL;
+    }
+
+    /* use the internal member */
+    return self->prompt;
+}
+
+static char *
+_rprompt(EditLine *el)
+{
+    int rv;
+    EditLineObject *self = NULL;
+
+    rv = el_get(el, EL_CLIENTDATA, &self);
+
+    /* should raise exception or something */
+    if (rv < 0 || self == NULL) {
+	PyErr_SetString(PyExc_SystemError, "libedit lost clientdata");
+	return NULL;
+    }
+
+    /* a history search in progress reports on the right */
+    if (self->search_status != NULL)
+	return self->search_status;
+
+    /* use the internal member */
+    return self->rprompt;
+}
+
+
+/*******************************************************************************
+ *
+ *              EditLine Object Definition
+ *
+ ******************************************************************************/
+
+static void
+_cleanup_editlineobject(EditLineObject *self)
+{
+    /* mop up libedit */
+    if (self->el)
+	el_end(self->el);
+    if (self->tok)
+	tok_end(self->tok);
+    if (self->hist)
+	history_end(self->hist);
+    hidx_free(self->hidx);
+    _history_store_release(self);
+
+    /* tidy up the allocated bits */
+    if (self->name)
+	PyMem_RawFree(self->name);
+    if (self->prompt)
+	PyMem_RawFree(self->prompt);
+    if (self->rprompt)
+	PyMem_RawFree(self->rprompt);
+    if (self->buffer)
+	PyMem_RawFree(self->buffer);
+    if (self->fed)
+	PyMem_RawFree(self->fed);
+    if (self->in_buf)
+	PyMem_RawFree(self->in_buf);
+    if (self->sink)
+	fclose(self->sink);
+    free(self->sink_buf);   /* the C library's, from open_memstream() */
+    if (self->hs_discard)
+	fclose(self->hs_discard);
+    free(self->hs_buf);
+    free(self->isearch_saved);
+    if (self->hs_saved) {
+	int n;
+
+	for (n = 0; self->hs_saved[n] != NULL; n++)
+	    free(self->hs_saved[n]);
+	PyMem_RawFree(self->hs_saved);
+    }
+    
+    /* manage file-handles? */
+    if (self->fin)
+	fclose(self->fin);
+    if (self->fout)
+	fclose(self->fout);
+    if (self->out_buf)
+	PyMem_RawFree(self->out_buf);
+    if (self->ferr)
+	fclose(self->ferr);
+
+    /* release my ownership of the I/O refs */
+    Py_DECREF(self->pyin);
+    Py_DECREF(self->pyout);
+    Py_DECREF(self->pyerr);
+}
+
+static void
+elObj_dealloc(EditLineObject* self)
+{
+    /* free up resources */
+    _cleanup_editlineobject(self);
+    
+    /* nuke myself */
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int
+elObj_init(EditLineObject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *pyfd;
+    int fd_in, fd_out, fd_err, rv;
+    char *name;
+
+    if (!PyArg_ParseTuple(args, "sOOO", &name,
+			  &self->pyin, &self->pyout, &self->pyerr))
+	return -1;
+
+    /* need to ensure I own the refs */
+    Py_INCREF(self->pyin);
+    Py_INCREF(self->pyout);
+    Py_INCREF(self->pyerr);
+
+    /* check that there is fileno() on each stream */
+    pyfd = PyObject_CallMethod(self->pyin, "fileno", NULL);
+    fd_in = (int) PyLong_AsLong(pyfd);
+    self->fin = fdopen(fd_in, "r");
+    pyfd = PyObject_CallMethod(self->pyout, "fileno", NULL);
+    fd_out = (int) PyLong_AsLong(pyfd);
+    self->fout = fdopen(fd_out, "w");
+    /*
+     * A terminal's stream would be line buffered, written a line (or a
+     * little buffer) at a time.  libedit flushes it when it has finished
+     * drawing and waits for a key, so with room for a whole refresh each
+     * goes out in a single write.
+     */
+    self->out_buf = PyMem_RawMalloc(OUTPUT_SIZE);
+    if (self->fout != NULL && self->out_buf != NULL)
+	setvbuf(self->fout, self->out_buf, _IOFBF, OUTPUT_SIZE);
+    pyfd = PyObject_CallMethod(self->pyerr, "fileno", NULL);
+    fd_err = (int) PyLong_AsLong(pyfd);
+    self->ferr = fdopen(fd_err, "w");
+
+    //printf("in: %d  out:%d  err:%d\n", fd_in, fd_out, fd_err);
+
+    /* save the name */
+    self->name = PyMem_RawMalloc(strlen(name)+1);
+    if (self->name == NULL) {
+	PyErr_NoMemory();
+	goto error;
+    }
+    strcpy(self->name, name);
+
+    /* prepare the default prompt */
+    #define MY_INIT_PROMPT "EL> "
+    self->prompt = PyMem_RawMalloc(strlen(MY_INIT_PROMPT)+1);
+    if (self->prompt == NULL) {
+	PyErr_NoMemory();
+	goto error;
+    }
+    strcpy(self->prompt, MY_INIT_PROMPT);
+    self->prompt_esc = '\1';
 
     /* prepare the right-prompt to be empty */
     self->rprompt = PyMem_RawMalloc(2);
     if (self->rprompt == NULL) {
 	PyErr_NoMemory();
-	goto error;
+	goto error;
+    }
+    self->rprompt[0] = '\0';
+    self->rprompt[1] = '\0';
+    self->rprompt_esc = '\1';
+
+    self->_debug = 0;
+    self->signature = 0xDEADBEEFUL;
+
+    /* prepare the scratch pad */
+    self->buffer_size = SCRATCH_SIZE;
+    self->buffer_keep = SCRATCH_KEEP;
+    self->buffer = PyMem_RawMalloc(self->buffer_size);
+    if (self->buffer == NULL) {
+	PyErr_NoMemory();
+	goto error;
+    }
+    
+    /* create the history manager */
+    self->hist = history_init();
+    if (self->hist == NULL) {
+	PyErr_SetString(PyExc_ValueError, "history init failed");
+	goto error;
+    }
+
+    /* setup the history buffer */
+    self->hist_size = 100;
+    rv = history(self->hist, &self->ev, H_SETSIZE, self->hist_size);
+    if (rv < 0) {
+	PyErr_SetString(PyExc_ValueError, "setting history size failed");
+	goto error;
+    }
+    rv = history(self->hist, &self->ev, H_SETUNIQUE, 0x1);
+    if (rv < 0) {
+	PyErr_SetString(PyExc_ValueError, "setting history uniqueness failed");
+	goto error;
+    }
+
+    /* and the index used to search it */
+    self->hidx = PyMem_RawCalloc(1, sizeof(HistIndex));
+    if (self->hidx == NULL) {
+	PyErr_NoMemory();
+	goto error;
+    }
+
+    /* create the tokenizer */
+    self->tok = tok_init(NULL);
+    if (self->tok == NULL) {
+	PyErr_SetString(PyExc_ValueError, "tokenizer init failed");
+	goto error;
+    }
+
+    /* create the libedit instance */
+    self->el = el_init(name,self->fin, self->fout, self->ferr);
+    if (self->el == NULL) {
+	PyErr_SetString(PyExc_ValueError, "libedit init failed");
+	goto error;
+    }
+
+    /* general init ... */
+    el_set(self->el, EL_EDITOR, "emacs");
+    el_set(self->el, EL_SIGNAL, 1);
+
+    el_set(self->el, EL_PROMPT_ESC, _prompt, self->prompt_esc);
+    el_set(self->el, EL_RPROMPT_ESC, _rprompt, self->rprompt_esc);
+
+    el_set(self->el, EL_HIST, history, self->hist);
+    
+    el_set(self->el, EL_ADDFN, "ed-complete", "Complete argument", el_complete);
+    el_set(self->el, EL_BIND, "^I", "ed-complete", NULL);
+
+    el_set(self->el, EL_ADDFN, "ed-search-history",
+	   "Incremental history search", el_search_history);
+    el_set(self->el, EL_ADDFN, "ed-fuzzy-history",
+	   "Ranked fuzzy history search", el_fuzzy_history);
+    el_set(self->el, EL_BIND, "^X^R", "ed-fuzzy-history", NULL);
+    el_set(self->el, EL_ADDFN, "ed-prefix-prev-history",
+	   "Previous history entry starting like the line",
+	   el_prefix_prev_history);
+    el_set(self->el, EL_ADDFN, "ed-prefix-next-history",
+	   "Next history entry starting like the line",
+	   el_prefix_next_history);
+    el_set(self->el, EL_BIND, "\\e[A", "ed-prefix-prev-history", NULL);
+    el_set(self->el, EL_BIND, "\\eOA", "ed-prefix-prev-history", NULL);
+    el_set(self->el, EL_BIND, "\\e[B", "ed-prefix-next-history", NULL);
+    el_set(self->el, EL_BIND, "\\eOB", "ed-prefix-next-history", NULL);
+    el_set(self->el, EL_ADDFN, "ed-bracketed-paste",
+	   "Insert a bracketed paste as it is", el_bracketed_paste);
+    el_set(self->el, EL_BIND, "\\e[200~", "ed-bracketed-paste", NULL);
+    self->paste_mode = 1;
+
+    el_source(self->el, NULL);
+
+    self->begidx = 0;
+    self->endidx = 0;
+
+    /* leave myself a breadcrumb... */
+    el_set(self->el, EL_CLIENTDATA, self);
+
+    /* which the input layer needs to find its buffer */
+    el_set(self->el, EL_GETCFN, _input_getc);
+    
+    return 0;
+
+ error:
+    _cleanup_editlineobject(self);
+    return -1;
+}
+
+static PyMemberDef elObj_members[] = {
+    {
+	"_debug",
+	T_BOOL,
+	offsetof(EditLineObject, _debug),
+	0,
+	"flag for debugging"
+    },
+    {
+	"in_stream",
+	T_OBJECT_EX,
+	offsetof(EditLineObject, pyin),
+	0,
+	"I/O stream for terminal input"
+    },
+    {
+	"out_stream",
+	T_OBJECT_EX,
+	offsetof(EditLineObject, pyout),
+	0,
+	"I/O stream for terminal output"
+    },
+    {
+	"err_stream",
+	T_OBJECT_EX,
+	offsetof(EditLineObject, pyerr),
+	0,
+	"I/O stream for terminal error output"
+    },
+    {NULL}  /* Sentinel */
+};
+
+/* Interrupt handler */
+
+static jmp_buf jbuf;
+
+/* ARGSUSED */
+static void
+onintr(int sig)
+{
+    longjmp(jbuf, 1);
+}
+
+/*
+ * Provides the mechanics of collecting a line from libedit
+ * and managing the various supported features of line-completion
+ * special commands, ...
+ */
+/* let go of a scratch pad a very long line left behind */
+static void
+_scratch_shrink(EditLineObject *self)
+{
+    char *nbuf;
+
+    if (self->buffer_keep == 0 || self->buffer_size <= self->buffer_keep)
+	return;
+
+    nbuf = PyMem_RawMalloc(SCRATCH_SIZE);
+    if (nbuf == NULL)
+	return;
+    PyMem_RawFree(self->buffer);
+    self->buffer = nbuf;
+    self->buffer_size = SCRATCH_SIZE;
+}
+
+/*
+ * Hand a line collected by libedit (already in self->buffer) to the
+ * Python side and remember it.  'line' is the same line as a str, if the
+ * caller has one already.  Returns the line to pass on, RawMalloc'd.
+ * The GIL must be held.
+ */
+static char *
+_accept_line(EditLineObject *self, Py_ssize_t n, PyObject *line)
+{
+    char *p;
+    const char *buf = self->buffer;
+    PyObject *cmd = NULL;
+    PyObject *ncmd = NULL;
+    const char *nbuf = NULL;
+    const char *pp;
+    Py_ssize_t nbuflen = -1;
+    int rv, remember = 0;
+
+    /* run the custom command interface -- push up to Python code*/
+
+    /* create an object of the buf cmd */
+    if (line != NULL) {
+	Py_INCREF(line);
+	cmd = line;
+    }
+    else
+	cmd = Py_BuildValue("s#", self->buffer, n);
+    if (cmd == NULL || cmd == Py_None) {
+	/* hmm. bad string conversion some how... fight forward...*/
+	PyErr_Clear();
+	goto done;
+    }
+
+    /* this should call the overridden one too! */
+    ncmd = call_upcall(self, str_run_command, cmd, NULL);
+
+    /* a response of None indicates the command is consumed */
+    if (ncmd == NULL || ncmd == Py_None) {
+	buf = "\n";    /* truncate it to an "empty" */
+	n = 1;
+	goto done;
+    }
+
+    /* is it just the same command we sent? */
+    if (ncmd == cmd) {
+	remember = 1;
+	goto done;
+    }
+    
+    /* looks like we got something different back... */
+    rv = PyArg_Parse(ncmd, "s#", &nbuf, &nbuflen);
+    if (!rv) {
+	/* hmm. invalid return... cannot assume the command was consumed */
+	/* send the original buf to the parser -- come what may */
+	PyErr_Clear();
+	goto done;
+    }
+
+    /* conversion is successful, move ahead with it */
+    buf = nbuf;
+    n = nbuflen;
+    remember = 1;
+
+    /* create a RawMalloc'd buffer */
+ done:
+    p = PyMem_RawMalloc(n+1);
+    if (p == NULL) {
+	PyErr_NoMemory();
+	goto cleanup;
+    }
+	
+    /* Copy the malloc'ed buffer into a PyMem_Malloc'ed one. */
+    memcpy(p, buf, n);
+    p[n] = '\0';
+
+    /* snoop through the string */
+    pp = p;
+    while (*pp != '\0') {
+	if (isspace(*pp++))
+	    continue;
+	break;
+    }
+
+    /* ignore "whitespace" only lines */
+    if (pp == p+n)
+	remember = 0;
+    
+    /* remember cmds, but ignore "empty" lines */
+    if (remember && strlen(p) > 0)
+	_history_enter(self, p);
+
+ cleanup:
+    /* clean up the python objects */
+    if (cmd != NULL)
+	Py_DECREF(cmd);    /* this one I'm sure of */
+    if (ncmd != NULL && ncmd != cmd)
+	Py_DECREF(ncmd);   /* this one, not entirely */
+
+    _scratch_shrink(self);
+    return p;
+}
+
+static char *
+common_line_interaction(EditLineObject *self)
+{
+    char *p;
+    const wchar_t *wbuf;
+    PyObject *ncmd, *line, *encoded;
+    int n;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+#endif
+
+    /*
+     * Called without the GIL (PyOS_Readline and readline() both let it
+     * go), so it is taken only around the calls into Python.
+     */
+
+    /* let the Python side know a new line is on the way */
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+    ncmd = call_upcall(self, str_line_started, NULL, NULL);
+    if (ncmd == NULL)
+	PyErr_Clear();
+    Py_XDECREF(ncmd);
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+    
+    /* collect the string -- other threads carry on while the user types */
+    _paste_mode(self, 1);
+    _hscroll_begin(self);
+    self->reading = 1;
+    wbuf = el_wgets(self->el, &n);
+    self->reading = 0;
+    _hscroll_end(self, n > 0);
+    _paste_mode(self, 0);
+    fflush(self->fout);
+    self->line_gen++;
+
+    /* the rest deals in Python objects */
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+
+    /* something went wrong ... not exactly sure how to manage this */
+    if (n < 0) {
+	if (self->line_exports > 0) {
+	    /* a callback kept a view of the line, sets the BufferError */
+	    line_will_change(self);
+	}
+	else if (errno == EINTR) {
+	    printf("Snagged by an interrupt s=%d\n", PyErr_CheckSignals());
+	}
+	else {
+	    printf("el_wgets choked on: %s\n", strerror(errno));
+	}
+	el_reset(self->el);
+	if (!PyErr_Occurred())
+	    PyErr_SetFromErrno(PyExc_SystemError);
+	p = NULL;
+    }
+
+    else if (n == 0) {
+	/* appears to be when you get ^D or EOF */
+	p = PyMem_RawMalloc(1);
+        if (p != NULL)
+            *p = '\0';
+    }
+
+    /* valid count returned, but buffer is weird? */
+    else if (wbuf == NULL) {
+	PyErr_SetString(PyExc_SystemError, "el_wgets returned a bad buffer");
+	p = NULL;
+    }
+
+    /* converted to multibyte once, then on to Python */
+    else {
+	line = PyUnicode_FromWideChar(wbuf, n);
+	encoded = (line != NULL) ? encode(line) : NULL;
+	if (encoded == NULL ||
+	    copy_to_buffer(self, PyBytes_AS_STRING(encoded),
+			   PyBytes_GET_SIZE(encoded)) != 0)
+	    p = NULL;   /* routine sets PyErr_ */
+	else
+	    p = _accept_line(self, PyBytes_GET_SIZE(encoded), line);
+	Py_XDECREF(encoded);
+	Py_XDECREF(line);
+    }
+
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+
+    return p;
+}
+
+
+/*******************************************************************************
+ *
+ *              Horizontal Scrolling
+ *
+ * libedit wraps a long line over as many rows as it takes and redraws
+ * them as it changes.  Scrolled sideways the line keeps to one row: what
+ * libedit draws is thrown away and the row is drawn here instead, the
+ * part of the line around the cursor (with '<' and '>' where it runs on)
+ * rather than all of it, whenever the editor is about to wait for input.
+ *
+ ******************************************************************************/
+
+/* where output bound for the screen goes */
+static FILE *
+_output_fp(EditLineObject *self)
+{
+    return (self->sink != NULL) ? self->sink : self->fout;
+}
+
+/*
+ * What a key is bound to, from what bind prints for it: "f" and the
+ * function's name, "s" and a macro's string (printed as bind shows it,
+ * so a '\' or '^' in it cannot be told from an escape) or "u" when it is
+ * unbound.  NULL when there is no memory for it.
+ */
+static char *
+_bind_save(EditLineObject *self, const char *key)
+{
+    FILE *fp, *out = NULL, *err = NULL;
+    char *buf = NULL, *s, *saved;
+    size_t size = 0, len;
+
+    fp = open_memstream(&buf, &size);
+    if (fp == NULL)
+	return NULL;
+    el_get(self->el, EL_GETFP, 1, &out);
+    el_get(self->el, EL_GETFP, 2, &err);
+    el_set(self->el, EL_SETFP, 1, fp);
+    el_set(self->el, EL_SETFP, 2, fp);
+    el_set(self->el, EL_BIND, key, NULL);
+    el_set(self->el, EL_SETFP, 1, out);
+    el_set(self->el, EL_SETFP, 2, err);
+    if (fclose(fp) != 0 || buf == NULL) {
+	free(buf);
+	return NULL;
+    }
+
+    /* "key\t->\tname", or "key   ->  name" for a sequence */
+    s = strstr(buf, "->");
+    if (s == NULL) {
+	free(buf);
+	return strdup("u");
+    }
+    s += 2;
+    s += strspn(s, " \t");
+    s[strcspn(s, "\n")] = '\0';
+    len = strlen(s);
+    if (s[0] == '"' && len >= 2 && s[len - 1] == '"') {
+	s[len - 1] = '\0';
+	s[0] = 's';
+    }
+    else
+	*--s = 'f';   /* over the space or tab before it */
+    saved = strdup(s);
+    free(buf);
+    return saved;
+}
+
+/* bind the key back to what _bind_save() found */
+static void
+_bind_restore(EditLineObject *self, const char *key, const char *saved)
+{
+    if (saved[0] == 'f')
+	el_set(self->el, EL_BIND, key, saved + 1, NULL);
+    else if (saved[0] == 's')
+	el_set(self->el, EL_BIND, "-s", key, saved + 1, NULL);
+    else
+	el_set(self->el, EL_BIND, "-r", key, NULL);
+}
+
+/* cells taken on the screen, control characters show as ^X */
+static int
+_hscroll_width(wchar_t wc)
+{
+    int w;
+
+    if (wc < 0x20 || wc == 0x7f)
+	return 2;
+    w = wcwidth(wc);
+    return (w < 0) ? 1 : w;
+}
+
+/* put the character on the row, as _hscroll_width() counted it */
+static char *
+_hscroll_put(char *p, wchar_t wc)
+{
+    mbstate_t mbs;
+    size_t len;
+
+    if (wc < 0x20 || wc == 0x7f) {
+	*p++ = '^';
+	*p++ = (wc == 0x7f) ? '?' : (char) (wc + '@');
+	return p;
+    }
+    memset(&mbs, 0, sizeof(mbs));
+    len = wcrtomb(p, wc, &mbs);
+    if (len == (size_t) -1 || wcwidth(wc) < 0) {
+	*p++ = '?';
+	return p;
+    }
+    return p + len;
+}
+
+/* the prompt as libedit shows it, returning the cells it takes */
+static char *
+_hscroll_prompt(EditLineObject *self, char *p, int *cells)
+{
+    const char *s = self->search_status ? self->search_status : self->prompt;
+    int literal = 0, w;
+    mbstate_t mbs;
+    size_t len;
+    wchar_t wc;
+
+    *cells = 0;
+    if (s == NULL)
+	return p;
+
+    memset(&mbs, 0, sizeof(mbs));
+    while (*s != '\0') {
+	/* escapes between a pair of prompt_esc take no room */
+	if (*s == self->prompt_esc && !self->search_status) {
+	    literal = !literal;
+	    s++;
+	    continue;
+	}
+	len = mbrtowc(&wc, s, MB_CUR_MAX, &mbs);
+	if (len == (size_t) -1 || len == (size_t) -2 || len == 0) {
+	    memset(&mbs, 0, sizeof(mbs));
+	    len = 1;
+	    wc = L'?';
+	}
+	memcpy(p, s, len);
+	p += len;
+	s += len;
+	if (!literal) {
+	    w = wcwidth(wc);
+	    *cells += (w < 0) ? 0 : w;
+	}
+    }
+    return p;
+}
+
+/* draw the prompt and the part of the line about the cursor */
+static void
+_hscroll_draw(EditLineObject *self)
+{
+    const LineInfoW *lw = el_wline(self->el);
+    const wchar_t *line = lw->buffer;
+    size_t len = lw->lastchar - lw->buffer;
+    size_t cursor = lw->cursor - lw->buffer;
+    size_t i, prompt_len, ce_len = 0;
+    int cols = 0, room, used, cells;
+    FILE *fp = _output_fp(self);
+    const char *ce = NULL;
+    char *row, *p, *end, *at = NULL;
+
+    /* an accepted line ends in its newline, which is not shown */
+    if (len > 0 && line[len - 1] == L'\n')
+	len--;
+    if (cursor > len)
+	cursor = len;
+
+    if (el_get(self->el, EL_GETTC, "co", &cols) != 0 || cols < 8)
+	cols = 80;
+    if (el_get(self->el, EL_GETTC, "ce", &ce) == 0 && ce != NULL)
+	ce_len = strlen(ce);
+
+    /* a prompt and a screen's width of the line, clear, then to the cursor */
+    prompt_len = strlen(self->search_status ? self->search_status
+			: self->prompt ? self->prompt : "");
+    row = PyMem_RawMalloc(2 * (prompt_len + (size_t) cols * MB_CUR_MAX) +
+			  ce_len + cols + 32);
+    if (row == NULL)
+	return;
+
+    p = row;
+    *p++ = '\r';
+    p = _hscroll_prompt(self, p, &cells);
+
+    /* the last column is kept clear, the terminal would wrap there */
+    room = cols - 1 - cells;
+    if (room < 4)
+	room = 4;
+
+    /* the cursor stays in view, clear of the markers */
+    used = (self->hs_offset > 0);
+    for (i = self->hs_offset + used; i < cursor && used <= room - 2; i++)
+	used += _hscroll_width(line[i]);
+    if (self->hs_offset > len || i != cursor || used > room - 2) {
+	/* bring it back, half a row in */
+	used = 0;
+	for (i = cursor; i > 0; i--) {
+	    if (used + _hscroll_width(line[i - 1]) > room / 2)
+		break;
+	    used += _hscroll_width(line[i - 1]);
+	}
+	self->hs_offset = i;
+    }
+
+    /* a '<' in place of the first character when the line runs on */
+    used = 0;
+    i = self->hs_offset;
+    if (i > 0) {
+	*p++ = '<';
+	used = 1;
+	i++;
+    }
+    for (; i < len; i++) {
+	int w = _hscroll_width(line[i]);
+
+	/* and room left for a '>' unless this is the end of it */
+	if (used + w > room - (i + 1 < len))
+	    break;
+	if (i == cursor)
+	    at = p;
+	p = _hscroll_put(p, line[i]);
+	used += w;
+    }
+    if (at == NULL)
+	at = p;
+    if (i < len) {
+	*p++ = '>';
+	used++;
+    }
+
+    /*
+     * Clear what was left of the last drawing, with the terminal's own
+     * sequence (less its padding) or else spaces to the end of the row.
+     * Unless that left it there, the cursor is put back by drawing the
+     * row again up to it.
+     */
+    end = p;
+    if (ce_len > 0) {
+	while (*ce) {
+	    if (ce[0] == '$' && ce[1] == '<' && strchr(ce, '>') != NULL)
+		ce = strchr(ce, '>') + 1;
+	    else
+		*p++ = *ce++;
+	}
+    }
+    else
+	for (; cells + used < cols - 1; used++)
+	    *p++ = ' ';
+    if (at != end || ce_len == 0) {
+	*p++ = '\r';
+	memcpy(p, row + 1, at - (row + 1));
+	p += at - (row + 1);
+    }
+
+    fwrite(row, 1, p - row, fp);
+    fflush(fp);
+    PyMem_RawFree(row);
+}
+
+/* a line is about to be read: libedit's drawing is put aside */
+static void
+_hscroll_begin(EditLineObject *self)
+{
+    self->hs_line = 0;
+    if (!self->hscroll)
+	return;
+    if (self->sink == NULL && !(isatty(fileno(self->fout)) &&
+				isatty(fileno(self->fin))))
+	return;
+
+    if (self->hs_discard == NULL) {
+	self->hs_discard = open_memstream(&self->hs_buf, &self->hs_size);
+	if (self->hs_discard == NULL)
+	    return;
+    }
+    el_set(self->el, EL_SETFP, 1, self->hs_discard);
+    self->hs_offset = 0;
+    self->hs_line = 1;
+}
+
+/* draw the row, if the line is drawn that way, when input is waited for */
+static void
+_hscroll_wait(EditLineObject *self)
+{
+    if (!self->hs_line)
+	return;
+
+    /* nothing of libedit's drawing is kept */
+    fflush(self->hs_discard);
+    fseeko(self->hs_discard, 0, SEEK_SET);
+    _hscroll_draw(self);
+}
+
+/*
+ * The commonest edits are made here without libedit's refresh, which
+ * lays out the whole line to find what changed: the row drawn when
+ * input is next waited for shows them.  Not scrolling, they refresh as
+ * the functions they stand in for.
+ */
+static unsigned char
+_hscroll_done(EditLine *el)
+{
+    EditLineObject *self = NULL;
+
+    el_get(el, EL_CLIENTDATA, &self);
+    return (self != NULL && self->hs_line) ? CC_NORM : CC_REFRESH;
+}
+
+static unsigned char
+el_hscroll_insert(EditLine *el, int ch)
+{
+    wchar_t s[2];
+
+    s[0] = (wchar_t) ch;
+    s[1] = L'\0';
+    if (el_winsertstr(el, s) != 0)
+	return CC_ERROR;
+    return _hscroll_done(el);
+}
+
+static unsigned char
+el_hscroll_delete_prev(EditLine *el, int ch)
+{
+    const LineInfoW *lw = el_wline(el);
+
+    if (lw->cursor == lw->buffer)
+	return CC_ERROR;
+    el_wdeletestr(el, 1);
+    return _hscroll_done(el);
+}
+
+static unsigned char
+el_hscroll_prev(EditLine *el, int ch)
+{
+    const LineInfoW *lw = el_wline(el);
+
+    if (lw->cursor == lw->buffer)
+	return CC_ERROR;
+    el_cursor(el, -1);
+    return _hscroll_done(el);
+}
+
+static unsigned char
+el_hscroll_next(EditLine *el, int ch)
+{
+    const LineInfoW *lw = el_wline(el);
+
+    if (lw->cursor == lw->lastchar)
+	return CC_ERROR;
+    el_cursor(el, 1);
+    return _hscroll_done(el);
+}
+
+static unsigned char
+el_hscroll_beg(EditLine *el, int ch)
+{
+    const LineInfoW *lw = el_wline(el);
+
+    el_cursor(el, -(int) (lw->cursor - lw->buffer));
+    return _hscroll_done(el);
+}
+
+static unsigned char
+el_hscroll_end(EditLine *el, int ch)
+{
+    const LineInfoW *lw = el_wline(el);
+
+    el_cursor(el, (int) (lw->lastchar - lw->cursor));
+    return _hscroll_done(el);
+}
+
+/* the keys taken over, besides the printable characters */
+static const struct {
+    const char *key;
+    const char *name;
+} hscroll_keys[] = {
+    { "^A",     "ed-hscroll-move-to-beg" },
+    { "\\e[H",  "ed-hscroll-move-to-beg" },
+    { "\\eOH",  "ed-hscroll-move-to-beg" },
+    { "\\e[1~", "ed-hscroll-move-to-beg" },
+    { "^E",     "ed-hscroll-move-to-end" },
+    { "\\e[F",  "ed-hscroll-move-to-end" },
+    { "\\eOF",  "ed-hscroll-move-to-end" },
+    { "\\e[4~", "ed-hscroll-move-to-end" },
+    { "^B",     "ed-hscroll-prev-char" },
+    { "\\e[D",  "ed-hscroll-prev-char" },
+    { "\\eOD",  "ed-hscroll-prev-char" },
+    { "^F",     "ed-hscroll-next-char" },
+    { "\\e[C",  "ed-hscroll-next-char" },
+    { "\\eOC",  "ed-hscroll-next-char" },
+    { "^H",     "ed-hscroll-delete-prev-char" },
+    { "^?",     "ed-hscroll-delete-prev-char" },
+    { NULL, NULL }
+};
+
+#define HSCROLL_PRINTABLE  (0x7f - 0x20)
+#define HSCROLL_KEYS  (HSCROLL_PRINTABLE + \
+		       sizeof(hscroll_keys) / sizeof(hscroll_keys[0]) - 1)
+
+/* the n'th key taken over, as bind takes it, and what it is bound to */
+static const char *
+_hscroll_key(int n, char *key, const char **name)
+{
+    int i = 0;
+
+    if (n >= HSCROLL_PRINTABLE) {
+	*name = hscroll_keys[n - HSCROLL_PRINTABLE].name;
+	return hscroll_keys[n - HSCROLL_PRINTABLE].key;
+    }
+
+    /* the printable characters, escaped where bind would parse them */
+    if (n + 0x20 == '^' || n + 0x20 == '\\' || n + 0x20 == '-')
+	key[i++] = '\\';
+    key[i++] = (char) (n + 0x20);
+    key[i] = '\0';
+    *name = "ed-hscroll-insert";
+    return key;
+}
+
+/* bind the keys to the functions above, or back to what they were */
+static int
+_hscroll_bind(EditLineObject *self, int on)
+{
+    const char *name;
+    char key[3];
+    int n;
+
+    if (on && !self->hs_keys) {
+	el_set(self->el, EL_ADDFN, "ed-hscroll-insert",
+	       "Insert a character, scrolled sideways", el_hscroll_insert);
+	el_set(self->el, EL_ADDFN, "ed-hscroll-delete-prev-char",
+	       "Delete the character before the cursor, scrolled sideways",
+	       el_hscroll_delete_prev);
+	el_set(self->el, EL_ADDFN, "ed-hscroll-prev-char",
+	       "Move back a character, scrolled sideways", el_hscroll_prev);
+	el_set(self->el, EL_ADDFN, "ed-hscroll-next-char",
+	       "Move forward a character, scrolled sideways", el_hscroll_next);
+	el_set(self->el, EL_ADDFN, "ed-hscroll-move-to-beg",
+	       "Move to the start of the line, scrolled sideways",
+	       el_hscroll_beg);
+	el_set(self->el, EL_ADDFN, "ed-hscroll-move-to-end",
+	       "Move to the end of the line, scrolled sideways",
+	       el_hscroll_end);
+	self->hs_keys = 1;
+    }
+
+    if (!on) {
+	if (self->hs_saved == NULL)
+	    return 0;
+	for (n = 0; n < HSCROLL_KEYS; n++) {
+	    _bind_restore(self, _hscroll_key(n, key, &name),
+			  self->hs_saved[n]);
+	    free(self->hs_saved[n]);
+	}
+	PyMem_RawFree(self->hs_saved);
+	self->hs_saved = NULL;
+	return 0;
+    }
+
+    /* what the keys were bound to is kept, all of it before any change */
+    self->hs_saved = PyMem_RawCalloc(HSCROLL_KEYS + 1, sizeof(char *));
+    if (self->hs_saved == NULL) {
+	PyErr_NoMemory();
+	return -1;
+    }
+    for (n = 0; n < HSCROLL_KEYS; n++) {
+	self->hs_saved[n] = _bind_save(self, _hscroll_key(n, key, &name));
+	if (self->hs_saved[n] == NULL) {
+	    while (n-- > 0)
+		free(self->hs_saved[n]);
+	    PyMem_RawFree(self->hs_saved);
+	    self->hs_saved = NULL;
+	    PyErr_NoMemory();
+	    return -1;
+	}
+    }
+    for (n = 0; n < HSCROLL_KEYS; n++) {
+	const char *k = _hscroll_key(n, key, &name);
+
+	el_set(self->el, EL_BIND, k, name, NULL);
+    }
+    return 0;
+}
+
+/* the line is done: its last drawing, then on to the next row */
+static void
+_hscroll_end(EditLineObject *self, int newline)
+{
+    if (!self->hs_line)
+	return;
+
+    _hscroll_wait(self);
+    if (newline) {
+	fputs("\n", _output_fp(self));
+	fflush(_output_fp(self));
+    }
+    el_set(self->el, EL_SETFP, 1, _output_fp(self));
+    self->hs_line = 0;
+}
+
+
+/*******************************************************************************
+ *
+ *              Terminal Input
+ *
+ * libedit's own reader takes one byte per read(), so a paste (or anything
+ * typed quickly over a slow link) costs a system call per byte.  Instead
+ * whatever has already arrived is read in one go and libedit is handed it
+ * a character at a time from the buffer.  Only when nothing is waiting is
+ * libedit's reader left to block for the next keystroke, so signals
+ * (SIGWINCH, SIGCONT) are still seen to just as before.  Input which is
+ * not a terminal is simply read as it comes.
+ *
+ * Bytes read beyond the end of a line are kept for the instance's next
+ * one, fed input included.
+ *
+ ******************************************************************************/
+
+#define INPUT_SIZE 16384
+
+/* read what has arrived, or if wait is set block until something has */
+static ssize_t
+_input_fill(EditLineObject *self, int fd, int wait)
+{
+    size_t room;
+    ssize_t n;
+    int avail = 0;
+
+    if (self->in_buf == NULL) {
+	self->in_buf = PyMem_RawMalloc(INPUT_SIZE);
+	if (self->in_buf == NULL)
+	    return -1;
+    }
+
+    /* keep any part of a character at the front */
+    if (self->in_pos > 0) {
+	memmove(self->in_buf, self->in_buf + self->in_pos,
+		self->in_len - self->in_pos);
+	self->in_len -= self->in_pos;
+	self->in_pos = 0;
+    }
+    room = INPUT_SIZE - self->in_len;
+
+    if (!wait) {
+	if (ioctl(fd, FIONREAD, &avail) < 0 || avail <= 0)
+	    return 0;
+	if ((size_t) avail < room)
+	    room = avail;
+    }
+
+    do
+	n = read(fd, self->in_buf + self->in_len, room);
+    while (n < 0 && errno == EINTR);
+
+    if (n > 0)
+	self->in_len += n;
+    return n;
+}
+
+/* libedit's character reader for the terminal */
+static int
+_input_getc(EditLine *el, wchar_t *wc)
+{
+    EditLineObject *self = NULL;
+    mbstate_t mbs;
+    size_t len;
+    ssize_t n;
+    int fd, rv;
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return -1;
+    fd = fileno(self->fin);
+
+    /* typing on would move the line from under a view still held */
+    if (self->line_exports > 0)
+	return -1;
+
+    for (;;) {
+	if (self->in_pos < self->in_len) {
+	    /* ASCII stands for itself in any locale libedit works in */
+	    if ((unsigned char) self->in_buf[self->in_pos] < 0x80) {
+		*wc = (unsigned char) self->in_buf[self->in_pos++];
+		return 1;
+	    }
+
+	    memset(&mbs, 0, sizeof(mbs));
+	    len = mbrtowc(wc, self->in_buf + self->in_pos,
+			  self->in_len - self->in_pos, &mbs);
+	    if (len == (size_t) -1) {
+		/* invalid byte, discard it */
+		self->in_pos++;
+		continue;
+	    }
+	    if (len != (size_t) -2) {
+		self->in_pos += (len == 0) ? 1 : len;
+		return 1;
+	    }
+
+	    /* the rest of the character is on its way */
+	    if (self->in_len - self->in_pos < MB_LEN_MAX &&
+		_input_fill(self, fd, 1) > 0)
+		continue;
+	    self->in_pos = self->in_len;
+	}
+
+	if (_input_fill(self, fd, 0) > 0)
+	    continue;
+
+	/* nothing waiting and no terminal to mind, wait for more */
+	if (!isatty(fd)) {
+	    n = _input_fill(self, fd, 1);
+	    if (n > 0)
+		continue;
+	    *wc = L'\0';
+	    return (n == 0) ? 0 : -1;
+	}
+
+	/* libedit's reader blocks for the next keystroke */
+	_hscroll_wait(self);
+	el_set(el, EL_GETCFN, EL_BUILTIN_GETCFN);
+	rv = el_wgetc(el, wc);
+	el_set(el, EL_GETCFN, _input_getc);
+	return rv;
+    }
+}
+
+/* hand bytes read past the last line over to fed input */
+static int
+_input_to_fed(EditLineObject *self)
+{
+    size_t len = self->in_len - self->in_pos;
+    char *nfed;
+
+    if (len == 0)
+	return 0;
+
+    /* they came before anything still to be fed */
+    nfed = PyMem_RawMalloc(self->fed_len - self->fed_pos + len);
+    if (nfed == NULL) {
+	PyErr_NoMemory();
+	return -1;
+    }
+    memcpy(nfed, self->in_buf + self->in_pos, len);
+    if (self->fed_len > self->fed_pos)
+	memcpy(nfed + len, self->fed + self->fed_pos,
+	       self->fed_len - self->fed_pos);
+
+    PyMem_RawFree(self->fed);
+    self->fed = nfed;
+    self->fed_alloc = self->fed_len = self->fed_len - self->fed_pos + len;
+    self->fed_pos = 0;
+    self->in_pos = self->in_len = 0;
+    return 0;
+}
+
+
+/*******************************************************************************
+ *
+ *              Fed Input
+ *
+ * Instead of blocking in el_wgets() until a line is done, input can be
+ * handed over with feed() as it turns up (from an event loop, say) and
+ * libedit run over it in unbuffered mode, one command per el_wgets().
+ * The EL_GETCFN below reads the fed bytes; when they run out part way
+ * through a command nothing has been done yet, so the bytes of that
+ * command are put back to be read again once more have arrived.
+ *
+ * Without a terminal libedit does no editing at all, so the lines are
+ * simply cut from the fed input.
+ *
+ ******************************************************************************/
+
+#define FED_READING  0
+#define FED_STARVED  1    /* ran out of fed input */
+#define FED_ENDED    2    /* no more input is coming */
+
+/* libedit's character reader while input is being fed */
+static int
+_fed_getc(EditLine *el, wchar_t *wc)
+{
+    EditLineObject *self = NULL;
+    size_t len;
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return -1;
+
+    while (self->fed_pos < self->fed_len) {
+	len = mbrtowc(wc, self->fed + self->fed_pos,
+		      self->fed_len - self->fed_pos, &self->fed_mbs);
+	if (len == (size_t) -2) {
+	    /* the rest of the character is still to come */
+	    memset(&self->fed_mbs, 0, sizeof(self->fed_mbs));
+	    break;
+	}
+	if (len == (size_t) -1) {
+	    /* invalid byte, discard it */
+	    memset(&self->fed_mbs, 0, sizeof(self->fed_mbs));
+	    self->fed_pos++;
+	    continue;
+	}
+	self->fed_pos += (len == 0) ? 1 : len;
+	return 1;
+    }
+
+    if (self->fed_eof) {
+	self->fed_state = FED_ENDED;
+	*wc = L'\0';
+	return 0;
+    }
+
+    _hscroll_wait(self);
+    self->fed_state = FED_STARVED;
+    errno = EAGAIN;
+    return -1;
+}
+
+static void
+_fed_stop(EditLineObject *self)
+{
+    if (!self->fed_active)
+	return;
+
+    /* back to cooked mode and the terminal reader */
+    if (!self->fed_plain) {
+	_hscroll_end(self, 0);
+	el_set(self->el, EL_UNBUFFERED, 0);
+	el_set(self->el, EL_GETCFN, _input_getc);
+	_paste_mode(self, 0);
+    }
+    self->fed_active = 0;
+}
+
+
+/*******************************************************************************
+ *
+ *              Bracketed Paste
+ *
+ * While a line is read the terminal is asked (ESC[?2004h) to wrap pasted
+ * text in ESC[200~ ... ESC[201~.  The opening marker is bound to a widget
+ * which takes everything up to the closing one and inserts it in one go:
+ * one edit and one refresh, with no key bindings run over it, so Tabs do
+ * not complete and newlines do not end the line.
+ *
+ ******************************************************************************/
+
+#define PASTE_END "\033[201~"
+#define PASTE_END_LEN (sizeof(PASTE_END) - 1)
+
+/*
+ * switch bracketing on or off when the output goes to a real terminal,
+ * not to headless output (the keys are understood either way)
+ */
+static void
+_paste_mode(EditLineObject *self, int on)
+{
+    FILE *fp = _output_fp(self);
+
+    if (!self->paste_mode)
+	return;
+    if (self->sink != NULL || !isatty(fileno(self->fout)))
+	return;
+
+    fputs(on ? "\033[?2004h" : "\033[?2004l", fp);
+
+    /* switching on goes out with the prompt */
+    if (!on)
+	fflush(fp);
+}
+
+/* insert the pasted text, newlines as they are typed by the Enter key */
+static unsigned char
+_paste_insert(EditLine *el, wchar_t *text, size_t len)
+{
+    size_t i, n = 0;
+
+    for (i = 0; i < len; i++) {
+	if (text[i] == L'\r') {
+	    if (i + 1 < len && text[i + 1] == L'\n')
+		continue;
+	    text[i] = L'\n';
+	}
+	/* el_winsertstr() stops at a NUL */
+	if (text[i] != L'\0')
+	    text[n++] = text[i];
+    }
+    text[n] = L'\0';
+
+    if (n > 0 && el_winsertstr(el, text) != 0)
+	return CC_ERROR;
+    return CC_REFRESH;
+}
+
+/* a paste in fed input: found in the buffer, rather than read keystroke-wise */
+static unsigned char
+_paste_fed(EditLineObject *self, EditLine *el)
+{
+    const char *start = self->fed + self->fed_pos;
+    size_t avail = self->fed_len - self->fed_pos;
+    const char *end = memmem(start, avail, PASTE_END, PASTE_END_LEN);
+    size_t len, n = 0, used;
+    mbstate_t mbs;
+    wchar_t *text;
+    unsigned char rv;
+
+    if (end == NULL) {
+	/* it runs on beyond what has come so far, try again when it has */
+	if (!self->fed_eof) {
+	    self->fed_state = FED_STARVED;
+	    return CC_NORM;
+	}
+	end = start + avail;
+    }
+
+    len = end - start;
+    text = PyMem_RawMalloc((len + 1) * sizeof(wchar_t));
+    if (text == NULL)
+	return CC_ERROR;
+
+    memset(&mbs, 0, sizeof(mbs));
+    while (start < end) {
+	/* ASCII stands for itself in any locale libedit works in */
+	if ((unsigned char) *start < 0x80) {
+	    text[n++] = (unsigned char) *start++;
+	    continue;
+	}
+	used = mbrtowc(&text[n], start, end - start, &mbs);
+	if (used == (size_t) -1 || used == (size_t) -2) {
+	    /* invalid or cut short, discard the byte */
+	    memset(&mbs, 0, sizeof(mbs));
+	    start++;
+	    continue;
+	}
+	start += (used == 0) ? 1 : used;
+	n++;
     }
-    self->rprompt[0] = '\0';
-    self->rprompt[1] = '\0';
-    self->rprompt_esc = '\1';
 
-    self->_debug = 0;
-    self->signature = 0xDEADBEEFUL;
+    rv = _paste_insert(el, text, n);
+    PyMem_RawFree(text);
 
-    /* prepare the scratch pad */
-    self->buffer_size = 2048;
-    self->buffer = PyMem_RawMalloc(self->buffer_size);
-    if (self->buffer == NULL) {
-	PyErr_NoMemory();
-	goto error;
+    self->fed_pos = end - self->fed;
+    if (self->fed_pos + PASTE_END_LEN <= self->fed_len)
+	self->fed_pos += PASTE_END_LEN;
+    return rv;
+}
+
+/* a paste from the terminal, read up to the closing marker */
+static unsigned char
+_paste_read(EditLine *el)
+{
+    static const wchar_t end[] = L"\033[201~";
+    const size_t end_len = sizeof(end) / sizeof(end[0]) - 1;
+    size_t n = 0, size = 256;
+    wchar_t *text = PyMem_RawMalloc(size * sizeof(wchar_t)), *ntext;
+    unsigned char rv;
+
+    if (text == NULL)
+	return CC_ERROR;
+
+    while (el_wgetc(el, &text[n]) == 1) {
+	n++;
+	if (n >= end_len &&
+	    wmemcmp(text + n - end_len, end, end_len) == 0) {
+	    n -= end_len;
+	    break;
+	}
+	if (n + 1 >= size) {
+	    ntext = PyMem_RawRealloc(text, 2 * size * sizeof(wchar_t));
+	    if (ntext == NULL)
+		break;
+	    text = ntext;
+	    size *= 2;
+	}
     }
-    
-    /* create the history manager */
-    self->hist = history_init();
-    if (self->hist == NULL) {
-	PyErr_SetString(PyExc_ValueError, "history init failed");
-	goto error;
+
+    rv = _paste_insert(el, text, n);
+    PyMem_RawFree(text);
+    return rv;
+}
+
+static unsigned char
+el_bracketed_paste(EditLine *el, int ch)
+{
+    EditLineObject *self = NULL;
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return CC_FATAL;
+
+    if (self->fed_active && !self->fed_plain)
+	return _paste_fed(self, el);
+    return _paste_read(el);
+}
+
+
+/*******************************************************************************
+ *
+ *              Key Functions and Batched Edits
+ *
+ * Python functions are made editor functions (for bind()) through a set
+ * of fixed entry points, libedit passing a function nothing but the key.
+ *
+ * Edits made from Python (insert_text(), delete_text(), redisplay()) in a
+ * batch are drawn once when it closes.  The completer and key functions
+ * run in one of their own, their edits drawn by the refresh libedit does
+ * after them.
+ *
+ ******************************************************************************/
+
+#define KEY_FUNCTIONS 32
+
+/* the slot numbers passed up, made once at import */
+static PyObject *key_slots[KEY_FUNCTIONS];
+
+/* a batch has closed: what the handler returned, with the edits drawn */
+static int
+_batch_close(EditLineObject *self, int rv)
+{
+    if (--self->batch_depth > 0 || !self->batch_dirty)
+	return rv;
+    self->batch_dirty = 0;
+
+    switch (rv) {
+    case CC_NORM:
+    case CC_CURSOR:
+	return CC_REFRESH;
+    case CC_ERROR:
+	return CC_REFRESH_BEEP;
     }
+    return rv;
+}
 
-    /* setup the history buffer */
-    rv = history(self->hist, &self->ev, H_SETSIZE, 100);
-    if (rv < 0) {
-	PyErr_SetString(PyExc_ValueError, "setting history size failed");
-	goto error;
+static unsigned char
+_key_function(EditLine *el, int slot, int ch)
+{
+    EditLineObject *self = NULL;
+    PyObject *r, *key;
+    int rv = CC_ERROR;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+#endif
+
+    el_get(el, EL_CLIENTDATA, &self);
+    if (self == NULL)
+	return CC_FATAL;
+
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+
+    /* keystrokes since Python last saw the line */
+    self->line_gen++;
+    self->batch_depth++;
+
+    key = PyUnicode_FromOrdinal(ch);
+    if (key != NULL)
+	r = call_upcall(self, str_key_function, key_slots[slot], key);
+    else
+	r = NULL;
+    Py_XDECREF(key);
+
+    if (r == Py_None)
+	rv = CC_NORM;
+    else if (r != NULL && PyLong_Check(r))
+	rv = (int) PyLong_AsLong(r);
+    else if (r != NULL)
+	PyErr_SetString(PyExc_TypeError,
+			"a key function returns a CC_ value or None");
+
+    /* a view kept beyond the key function would outlive the line */
+    if (r != NULL && self->line_exports > 0) {
+	rv = CC_ERROR;
+	if (!PyErr_Occurred())
+	    PyErr_SetString(PyExc_BufferError,
+			    "line_view() held beyond the key function");
     }
-    rv = history(self->hist, &self->ev, H_SETUNIQUE, 0x1);
-    if (rv < 0) {
-	PyErr_SetString(PyExc_ValueError, "setting history uniqueness failed");
-	goto error;
+
+    /* there is no caller to raise it to */
+    if (PyErr_Occurred())
+	PyErr_WriteUnraisable((PyObject *) self);
+    Py_XDECREF(r);
+
+    rv = _batch_close(self, rv);
+
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+    return rv;
+}
+
+#define KEY_FUNCTION(n) \
+    static unsigned char _key_function_##n(EditLine *el, int ch) \
+    { return _key_function(el, n, ch); }
+
+KEY_FUNCTION(0)  KEY_FUNCTION(1)  KEY_FUNCTION(2)  KEY_FUNCTION(3)
+KEY_FUNCTION(4)  KEY_FUNCTION(5)  KEY_FUNCTION(6)  KEY_FUNCTION(7)
+KEY_FUNCTION(8)  KEY_FUNCTION(9)  KEY_FUNCTION(10) KEY_FUNCTION(11)
+KEY_FUNCTION(12) KEY_FUNCTION(13) KEY_FUNCTION(14) KEY_FUNCTION(15)
+KEY_FUNCTION(16) KEY_FUNCTION(17) KEY_FUNCTION(18) KEY_FUNCTION(19)
+KEY_FUNCTION(20) KEY_FUNCTION(21) KEY_FUNCTION(22) KEY_FUNCTION(23)
+KEY_FUNCTION(24) KEY_FUNCTION(25) KEY_FUNCTION(26) KEY_FUNCTION(27)
+KEY_FUNCTION(28) KEY_FUNCTION(29) KEY_FUNCTION(30) KEY_FUNCTION(31)
+
+typedef unsigned char (*key_function_t)(EditLine *, int);
+
+static key_function_t key_functions[KEY_FUNCTIONS] = {
+    _key_function_0,  _key_function_1,  _key_function_2,  _key_function_3,
+    _key_function_4,  _key_function_5,  _key_function_6,  _key_function_7,
+    _key_function_8,  _key_function_9,  _key_function_10, _key_function_11,
+    _key_function_12, _key_function_13, _key_function_14, _key_function_15,
+    _key_function_16, _key_function_17, _key_function_18, _key_function_19,
+    _key_function_20, _key_function_21, _key_function_22, _key_function_23,
+    _key_function_24, _key_function_25, _key_function_26, _key_function_27,
+    _key_function_28, _key_function_29, _key_function_30, _key_function_31,
+};
+
+static PyObject *
+add_function(EditLineObject *self, PyObject *args)
+{
+    const char *name, *help;
+    int slot;
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (!PyArg_ParseTuple(args, "ssi:_add_function", &name, &help, &slot))
+	return NULL;
+
+    if (slot < 0 || slot >= KEY_FUNCTIONS) {
+	PyErr_Format(PyExc_ValueError,
+		     "no more than %d key functions", KEY_FUNCTIONS);
+	return NULL;
     }
 
-    /* create the tokenizer */
-    self->tok = tok_init(NULL);
-    if (self->tok == NULL) {
-	PyErr_SetString(PyExc_ValueError, "tokenizer init failed");
-	goto error;
+    if (el_set(self->el, EL_ADDFN, name, help, key_functions[slot]) != 0) {
+	PyErr_SetString(PyExc_ValueError, "adding the function failed");
+	return NULL;
     }
 
-    /* create the libedit instance */
-    self->el = el_init(name,self->fin, self->fout, self->ferr);
-    if (self->el == NULL) {
-	PyErr_SetString(PyExc_ValueError, "libedit init failed");
-	goto error;
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(doc_add_function,
+"_add_function(name, help, slot) -> None\n\
+Add an editor function which calls key function number 'slot'.");
+
+static PyObject *
+batch_begin(EditLineObject *self, PyObject *noarg)
+{
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    self->batch_depth++;
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(doc_batch_begin,
+"_batch_begin() -> None\n\
+Hold back the redisplay of edits until the batch ends.");
+
+static PyObject *
+batch_end(EditLineObject *self, PyObject *noarg)
+{
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (self->batch_depth <= 0) {
+	PyErr_SetString(PyExc_RuntimeError, "no batch of edits is open");
+	return NULL;
     }
 
-    /* general init ... */
-    el_set(self->el, EL_EDITOR, "emacs");
-    el_set(self->el, EL_SIGNAL, 1);
+    /* the outermost, from Python itself: draw the edits now */
+    if (_batch_close(self, CC_NORM) == CC_REFRESH)
+	el_set(self->el, EL_REFRESH);
 
-    el_set(self->el, EL_PROMPT_ESC, _prompt, self->prompt_esc);
-    el_set(self->el, EL_RPROMPT_ESC, _rprompt, self->rprompt_esc);
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(doc_batch_end,
+"_batch_end() -> None\n\
+End a batch of edits, the line is redisplayed once if they changed it.");
 
-    el_set(self->el, EL_HIST, history, self->hist);
-    
-    el_set(self->el, EL_ADDFN, "ed-complete", "Complete argument", el_complete);
-    el_set(self->el, EL_BIND, "^I", "ed-complete", NULL);
+/* add input for the line being fed, an empty one marks the end */
+static PyObject *
+feed(EditLineObject *self, PyObject *data)
+{
+    Py_buffer view;
+    size_t need;
+    char *nfed;
 
-    el_source(self->el, NULL);
+    if (_check_reader(self) < 0)
+	return NULL;
 
-    self->begidx = PyLong_FromLong(0L);
-    self->endidx = PyLong_FromLong(0L);
+    if (PyObject_GetBuffer(data, &view, PyBUF_SIMPLE) < 0)
+	return NULL;
 
-    /* leave myself a breadcrumb... */
-    el_set(self->el, EL_CLIENTDATA, self);
-    
-    return 0;
+    if (view.len == 0)
+	self->fed_eof = 1;
 
- error:
-    _cleanup_editlineobject(self);
-    return -1;
+    /* drop what has been read before making room */
+    if (self->fed_pos > 0) {
+	memmove(self->fed, self->fed + self->fed_pos,
+		self->fed_len - self->fed_pos);
+	self->fed_len -= self->fed_pos;
+	self->fed_pos = 0;
+    }
+
+    need = self->fed_len + view.len;
+    if (need > self->fed_alloc) {
+	size_t nalloc = self->fed_alloc ? self->fed_alloc : 256;
+	while (nalloc < need)
+	    nalloc *= 2;
+	nfed = PyMem_RawRealloc(self->fed, nalloc);
+	if (nfed == NULL) {
+	    PyBuffer_Release(&view);
+	    return PyErr_NoMemory();
+	}
+	self->fed = nfed;
+	self->fed_alloc = nalloc;
+    }
+
+    memcpy(self->fed + self->fed_len, view.buf, view.len);
+    self->fed_len += view.len;
+    PyBuffer_Release(&view);
+
+    Py_RETURN_NONE;
 }
+PyDoc_STRVAR(doc_feed,
+"feed(data) -> None\n\
+Hand over input bytes for the line being fed, b'' marks the end of input.");
 
-static PyMemberDef elObj_members[] = {
-    {
-	"_debug",
-	T_BOOL,
-	offsetof(EditLineObject, _debug),
-	0,
-	"flag for debugging"
-    },
-    {
-	"in_stream",
-	T_OBJECT_EX,
-	offsetof(EditLineObject, pyin),
-	0,
-	"I/O stream for terminal input"
-    },
-    {
-	"out_stream",
-	T_OBJECT_EX,
-	offsetof(EditLineObject, pyout),
-	0,
-	"I/O stream for terminal output"
-    },
-    {
-	"err_stream",
-	T_OBJECT_EX,
-	offsetof(EditLineObject, pyerr),
-	0,
-	"I/O stream for terminal error output"
-    },
-    {NULL}  /* Sentinel */
-};
+/* start a line read from fed input: the prompt goes out straight away */
+static PyObject *
+feed_start(EditLineObject *self, PyObject *noarg)
+{
+    if (_check_reader(self) < 0)
+	return NULL;
 
-/* Interrupt handler */
+    if (line_will_change(self) < 0)
+	return NULL;
 
-static jmp_buf jbuf;
+    if (!self->fed_active) {
+	if (_input_to_fed(self) < 0)
+	    return NULL;
+	self->fed_plain = !(isatty(fileno(self->fout)) &&
+			    isatty(fileno(self->fin)));
+	if (!self->fed_plain) {
+	    _paste_mode(self, 1);
+	    _hscroll_begin(self);
+	    el_set(self->el, EL_GETCFN, _fed_getc);
+	    el_set(self->el, EL_UNBUFFERED, 1);
+	}
+	self->fed_active = 1;
+    }
 
-/* ARGSUSED */
-static void
-onintr(int sig)
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(doc_feed_start,
+"_feed_start() -> None\n\
+Begin collecting a line from fed input and show the prompt.");
+
+static PyObject *
+feed_stop(EditLineObject *self, PyObject *noarg)
 {
-    longjmp(jbuf, 1);
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    _fed_stop(self);
+    Py_RETURN_NONE;
 }
+PyDoc_STRVAR(doc_feed_stop,
+"_feed_stop() -> None\n\
+Abandon the line being collected from fed input.");
 
 /*
- * Provides the mechanics of collecting a line from libedit
- * and managing the various supported features of line-completion
- * special commands, ...
+ * Run libedit over the input fed so far.  Returns the finished line as
+ * readline() would, '' at the end of input, or None while it needs more.
  */
-static char *
-common_line_interaction(EditLineObject *self)
+static PyObject *
+_feed_line(EditLineObject *self)
 {
-    char *p;
     const char *buf;
-    PyObject *cmd = NULL;
-    PyObject *ncmd = NULL;
-    PyObject *method_name = NULL;
-    int n, rv, remember = 0;
-    HistEvent ev;
-    
-    /* collect the string */
-    buf = el_gets(self->el, &n);
-    
-    /* something went wrong ... not exactly sure how to manage this */
-    if (n < 0) {
-	if (errno == EINTR) {
-	    printf("Snagged by an interrupt s=%d\n", PyErr_CheckSignals());
+    const wchar_t *wbuf;
+    char *p;
+    size_t mark;
+    int n;
+    PyObject *line, *encoded;
+
+    if (!self->fed_active) {
+	PyErr_SetString(PyExc_RuntimeError, "no line is being fed");
+	return NULL;
+    }
+
+    if (self->fed_plain) {
+	const char *start = self->fed + self->fed_pos;
+	const char *eol = memchr(start, '\n', self->fed_len - self->fed_pos);
+
+	if (eol != NULL)
+	    n = (int) (eol + 1 - start);
+	else if (self->fed_eof)
+	    n = (int) (self->fed_len - self->fed_pos);
+	else
+	    Py_RETURN_NONE;
+
+	_fed_stop(self);
+	if (n == 0)
+	    return PyUnicode_FromString("");
+	self->fed_pos += n;
+	buf = start;
+    }
+
+    /*
+     * el_wgets() as each command would otherwise have the whole line
+     * converted to multibyte, it is only converted once it is done
+     */
+    else for (;;) {
+	/* the completer may have kept a view of the line */
+	if (line_will_change(self) < 0)
+	    return NULL;
+
+	mark = self->fed_pos;
+	self->fed_state = FED_READING;
+	self->reading = 1;
+	wbuf = el_wgets(self->el, &n);
+	self->reading = 0;
+
+	/* out of input, what the command read so far goes again later */
+	if (self->fed_state == FED_STARVED) {
+	    self->fed_pos = mark;
+	    if (PyErr_Occurred())
+		return NULL;
+	    Py_RETURN_NONE;
 	}
-	else {
-	    printf("el_gets choked on: %s\n", strerror(errno));
+
+	/* end of input, or ^D on an empty line */
+	if (self->fed_state == FED_ENDED || (n == 1 && wbuf[0] == L'\004')) {
+	    _fed_stop(self);
+	    return PyUnicode_FromString("");
 	}
-	el_reset(self->el);
-	return (char *) PyErr_SetFromErrno(PyExc_SystemError);
-    }
 
-    if (n == 0) {
-	/* appears to be when you get ^D or EOF */
-	p = PyMem_RawMalloc(1);
-        if (p != NULL)
-            *p = '\0';
-        return p;
+	/* ed-newline leaves the newline on the line */
+	if (n > 0 && wbuf != NULL && wbuf[n-1] == L'\n') {
+	    _hscroll_end(self, 1);
+	    _fed_stop(self);
+	    line = PyUnicode_FromWideChar(wbuf, n);
+	    if (line == NULL)
+		return NULL;
+	    encoded = encode(line);
+	    if (encoded == NULL ||
+		copy_to_buffer(self, PyBytes_AS_STRING(encoded),
+			       PyBytes_GET_SIZE(encoded)) != 0)
+		p = NULL;
+	    else
+		p = _accept_line(self, PyBytes_GET_SIZE(encoded), line);
+	    Py_XDECREF(encoded);
+	    Py_DECREF(line);
+	    goto accepted;
+	}
     }
 
-    /* valid count returned, but buffer is weird? */
-    if (buf == NULL) {
-	PyErr_SetString(PyExc_SystemError, "el_gets returned a bad buffer");
+    _fed_stop(self);
+    if (copy_to_buffer(self, buf, n) != 0)
 	return NULL;
-    }
+    p = _accept_line(self, n, NULL);
 
-    /* copy the data and null-terminate it */
-    rv = copy_to_buffer(self, buf, n);
-    if (rv != 0)
-	return NULL;   /* routine sets PyErr_ */
-    
-    /* run the custom command interface -- push up to Python code*/
-#ifdef WITH_THREAD
-    PyGILState_STATE gilstate = PyGILState_Ensure();
-#endif
+ accepted:
+    if (p == NULL)
+	return NULL;
 
-    /* create an object of the buf cmd */
-    cmd = Py_BuildValue("s#", self->buffer, n);
-    if (cmd == NULL || cmd == Py_None) {
-	/* hmm. bad string conversion some how... fight forward...*/
-	goto done;
-    }
+    line = decode(p);
+    PyMem_RawFree(p);
+    return line;
+}
+static PyObject *
+feed_line(EditLineObject *self, PyObject *noarg)
+{
+    PyObject *line;
 
-    /* create the method name as a python str */
-    method_name = Py_BuildValue("s", "_run_command");
+    if (_start_reading(self) < 0)
+	return NULL;
+    line = _feed_line(self);
+    self->reader = 0;
+    return line;
+}
+PyDoc_STRVAR(doc_feed_line,
+"_feed_line() -> String\n\
+Edit with the input fed so far: the finished line, '' at the end of input\n\
+or None while more input is needed.");
 
-    /* this should call the overridden one too! */
-    ncmd = PyObject_CallMethodObjArgs((PyObject*)self, method_name, cmd, NULL);
 
-    /* its useful life is over */
-    Py_DECREF(method_name);
+/* send libedit's output (and errors) to memory instead of the terminal */
+static PyObject *
+headless(EditLineObject *self, PyObject *args)
+{
+    const char *term = NULL;
+    FILE *fp;
 
-#ifdef WITH_THREAD
-    PyGILState_Release(gilstate);
-#endif
+    if (!PyArg_ParseTuple(args, "|z:_headless", &term))
+	return NULL;
 
-    /* a response of None indicates the command is consumed */
-    if (ncmd == NULL || ncmd == Py_None) {
-	buf = "\n";    /* truncate it to an "empty" */
-	n = 1;
-	goto done;
+    if (self->sink == NULL) {
+	fp = open_memstream(&self->sink_buf, &self->sink_size);
+	if (fp == NULL)
+	    return PyErr_SetFromErrno(PyExc_OSError);
+	self->sink = fp;
+	el_set(self->el, EL_SETFP, 1, fp);
+	el_set(self->el, EL_SETFP, 2, fp);
     }
 
-    /* is it just the same command we sent? */
-    if (ncmd == cmd) {
-	remember = 1;
-	goto done;
-    }
-    
-    const char *nbuf = NULL;
-    int nbuflen = -1;
+    /* a known terminal type makes the output the same everywhere */
+    if (term != NULL)
+	el_set(self->el, EL_TERMINAL, term);
 
-    /* looks like we got something different back... */
-    rv = PyArg_Parse(ncmd, "s#", &nbuf, &nbuflen);
-    if (rv < 0) {
-	/* hmm. invalid return... cannot assume the command was consumed */
-	/* send the original buf to the parser -- come what may */
-	goto done;
-    }
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(doc_headless,
+"_headless([term]) -> None\n\
+Collect the output in memory (see take_output()) rather than writing it.");
 
-    /* conversion is successful, move ahead with it */
-    buf = nbuf;
-    n = nbuflen;
-    remember = 1;
+static PyObject *
+take_output(EditLineObject *self, PyObject *noarg)
+{
+    PyObject *out;
+    off_t len;
+
+    if (self->sink == NULL)
+	return PyBytes_FromStringAndSize(NULL, 0);
+
+    /* only ever appended to since the last rewind */
+    fflush(self->sink);
+    len = ftello(self->sink);
+    if (len < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+
+    out = PyBytes_FromStringAndSize(self->sink_buf, (Py_ssize_t) len);
+    if (out != NULL)
+	fseeko(self->sink, 0, SEEK_SET);
+    return out;
+}
+PyDoc_STRVAR(doc_take_output,
+"take_output() -> bytes\n\
+The output of a headless instance since the last call.");
 
-    /* create a RawMalloc'd buffer */
- done:
-    p = PyMem_RawMalloc(n+1);
-    if (p == NULL) {
-	PyErr_NoMemory();
+static PyObject *
+write_output(EditLineObject *self, PyObject *text)
+{
+    PyObject *en_text = encode(text);
+    FILE *fp;
+
+    if (en_text == NULL)
 	return NULL;
-    }
-	
-    /* Copy the malloc'ed buffer into a PyMem_Malloc'ed one. */
-    strncpy(p, buf, n);
-    p[n] = '\0';
 
-    /* snoop through the string */
-    const char *pp = p;
-    while (*pp != '\0') {
-	if (isspace(*pp++))
-	    continue;
-	break;
-    }
+    fp = _output_fp(self);
+    fwrite(PyBytes_AS_STRING(en_text), 1, PyBytes_GET_SIZE(en_text), fp);
+    Py_DECREF(en_text);
 
-    /* ignore "whitespace" only lines */
-    if (pp == p+n)
-	remember = 0;
-    
-    /* remember cmds, but ignore "empty" lines */
-    if (remember && strlen(p) > 0)
-	history(self->hist, &ev, H_ENTER, p);
+    /* while a line is read it goes out with libedit's next refresh */
+    if (!self->reading)
+	fflush(fp);
 
-    /* clean up the python objects */
-    if (cmd != NULL)
-	Py_DECREF(cmd);    /* this one I'm sure of */
-    if (ncmd != NULL && ncmd != cmd)
-	Py_DECREF(ncmd);   /* this one, not entirely */
-    
-    return p;
+    Py_RETURN_NONE;
 }
+PyDoc_STRVAR(doc_write_output,
+"_write_output(text) -> None\n\
+Write to where libedit's own output goes, in turn with it.");
 
 
 /*
@@ -607,8 +4047,12 @@ static char *
 call_editline(FILE *sys_stdin, FILE *sys_stdout, const char *prompt)
 {
     char *p;
+    int busy;
     PyOS_sighandler_t old_inthandler;
     EditLineObject *el_gi = editline_module_state->global_instance;
+#ifdef WITH_THREAD
+    PyGILState_STATE gilstate;
+#endif
 
     /* init missing... */
     if (el_gi == NULL) {
@@ -616,10 +4060,22 @@ call_editline(FILE *sys_stdin, FILE *sys_stdout, const char *prompt)
 	return NULL;
     }
 
+    /* called without the GIL, which the check needs */
+#ifdef WITH_THREAD
+    gilstate = PyGILState_Ensure();
+#endif
+    busy = _start_reading(el_gi);
+#ifdef WITH_THREAD
+    PyGILState_Release(gilstate);
+#endif
+    if (busy < 0)
+	return NULL;
+
     /* don't do the allocation unless it is different... */
     if (strncmp(prompt, el_gi->prompt, strlen(prompt)) != 0) {
 	p = PyMem_RawMalloc(strlen(prompt)+1);
 	if (p == NULL) {
+	    el_gi->reader = 0;
 	    PyErr_NoMemory();
 	    return NULL;
 	}
@@ -640,11 +4096,20 @@ call_editline(FILE *sys_stdin, FILE *sys_stdout, const char *prompt)
         sigrelse(SIGINT);
 #endif
         PyOS_setsig(SIGINT, old_inthandler);
+
+	/* common_line_interaction() was left in el_wgets(), tidy up */
+	el_gi->reading = 0;
+	el_gi->reader = 0;
+	_hscroll_end(el_gi, 0);
+	_paste_mode(el_gi, 0);
+	fflush(el_gi->fout);
         return NULL;
     }
 
     /* interact with the user */
-    return common_line_interaction(el_gi);
+    p = common_line_interaction(el_gi);
+    el_gi->reader = 0;
+    return p;
 }
 
 
@@ -664,15 +4129,28 @@ Handle reducing the options at the python level, not C.");
 static PyObject *
 readline(EditLineObject *self, PyObject *noarg)
 {
-    const char *buf;
+    char *buf;
+    PyObject *line;
+
+    if (line_will_change(self) < 0 || _start_reading(self) < 0)
+	return NULL;
 
-    /* do the interaction */
+    /* do the interaction, other threads run while it waits on the user */
+    Py_BEGIN_ALLOW_THREADS
     buf = common_line_interaction(self);
-    if (! buf)
+    Py_END_ALLOW_THREADS
+    self->reader = 0;
+
+    if (! buf) {
+	if (PyErr_Occurred())
+	    return NULL;
 	Py_RETURN_NONE;
+    }
 
     /* pass back what we got */
-    return decode(buf);
+    line = decode(buf);
+    PyMem_RawFree(buf);
+    return line;
 }
 PyDoc_STRVAR(doc_readline,
 "readline() -> String\n\
@@ -681,18 +4159,28 @@ Collect a string from libedit.");
 
 /* pass on command to bind */
 static PyObject *
-bind(EditLineObject *self, PyObject *keystring, PyObject *cmd)
+bind(EditLineObject *self, PyObject *args)
 {
     int rv;
-    PyObject *en_key = encode(keystring);
-    PyObject *en_cmd = encode(cmd);
+    PyObject *keystring, *cmd, *en_key, *en_cmd;
     pel_note(__FUNCTION__);
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (!PyArg_ParseTuple(args, "UU:bind", &keystring, &cmd))
+	return NULL;
+
+    en_key = encode(keystring);
+    en_cmd = encode(cmd);
     if (en_key == NULL || en_cmd == NULL) {
+	Py_XDECREF(en_key);
+	Py_XDECREF(en_cmd);
         return NULL;
     }
     
     rv = el_set(self->el, EL_BIND,
-	   PyBytes_AS_STRING(en_key), PyBytes_AS_STRING(en_cmd));
+	   PyBytes_AS_STRING(en_key), PyBytes_AS_STRING(en_cmd), NULL);
 
     Py_DECREF(en_key);
     Py_DECREF(en_cmd);
@@ -700,8 +4188,8 @@ bind(EditLineObject *self, PyObject *keystring, PyObject *cmd)
     return PyLong_FromLong((long)rv);
 }
 PyDoc_STRVAR(doc_bind,
-"bind(string) -> Int\n\
-Execute the init line provided in the string argument.");
+"bind(key, command) -> Int\n\
+Bind the key sequence to an editor command, 0 on success.");
 
 #if 0
 /* emulate the functionality at the python level... */
@@ -721,33 +4209,136 @@ Translate readline init line provided in the string argument.");
 static PyObject *
 get_line_buffer(EditLineObject *self, PyObject *noarg)
 {
-    const LineInfo *linfo;
+    const LineInfoW *linfo;
 
-    linfo = el_line(self->el); 
+    if (_check_reader(self) < 0)
+	return NULL;
 
-    /* use the temporary store */
-	copy_to_buffer(self, linfo->buffer, (linfo->lastchar - linfo->buffer));
+    linfo = el_wline(self->el);
 
-    /* convert to 'str' */
-    return decode(self->buffer);
+    /* libedit's wide line converts to 'str' as it is */
+    return PyUnicode_FromWideChar(linfo->buffer,
+				  linfo->lastchar - linfo->buffer);
 }
 
 PyDoc_STRVAR(doc_get_line_buffer,
 "get_line_buffer() -> string\n\
 return the current contents of the line buffer.");
 
+/*
+ * The line as libedit holds it, one wchar_t per character, lent out as a
+ * read-only buffer without copying.  libedit may move it as it edits, so
+ * it is not allowed to edit while a view is held (line_will_change()).
+ */
+#if SIZEOF_WCHAR_T == 4
+#define LINE_VIEW_FORMAT "I"
+#else
+#define LINE_VIEW_FORMAT "H"
+#endif
+
+static int
+elObj_getbuffer(EditLineObject *self, Py_buffer *view, int flags)
+{
+    const LineInfoW *linfo;
+
+    if ((flags & PyBUF_WRITABLE) == PyBUF_WRITABLE) {
+	PyErr_SetString(PyExc_BufferError, "the line is read-only");
+	view->obj = NULL;
+	return -1;
+    }
+
+    linfo = el_wline(self->el);
+    self->line_shape = linfo->lastchar - linfo->buffer;
+
+    view->buf = (void *) linfo->buffer;
+    view->obj = (PyObject *) self;
+    Py_INCREF(self);
+    view->len = self->line_shape * sizeof(wchar_t);
+    view->readonly = 1;
+    view->itemsize = sizeof(wchar_t);
+    view->format = NULL;
+    if ((flags & PyBUF_FORMAT) == PyBUF_FORMAT)
+	view->format = LINE_VIEW_FORMAT;
+    view->ndim = 1;
+    view->shape = NULL;
+    if ((flags & PyBUF_ND) == PyBUF_ND)
+	view->shape = &self->line_shape;
+    view->strides = NULL;
+    if ((flags & PyBUF_STRIDES) == PyBUF_STRIDES)
+	view->strides = &view->itemsize;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+
+    self->line_exports++;
+    return 0;
+}
+
+static void
+elObj_releasebuffer(EditLineObject *self, Py_buffer *view)
+{
+    self->line_exports--;
+}
+
+static PyBufferProcs elObj_as_buffer = {
+    (getbufferproc) elObj_getbuffer,
+    (releasebufferproc) elObj_releasebuffer
+};
+
+static PyObject *
+line_view(EditLineObject *self, PyObject *noarg)
+{
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    return PyMemoryView_FromObject((PyObject *) self);
+}
+
+PyDoc_STRVAR(doc_line_view,
+"line_view() -> memoryview\n\
+A read-only view of the line buffer (the character codes) without copying\n\
+it.  Editing the line is refused while the view is held: release it, or\n\
+use it in a with statement.  readline() stops with a BufferError when a\n\
+completer or key function returns still holding a view.");
+
+static PyObject *
+elObj_line_cursor_getter(EditLineObject *self, void *closure)
+{
+    const LineInfoW *linfo;
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    linfo = el_wline(self->el);
+    return PyLong_FromSsize_t(linfo->cursor - linfo->buffer);
+}
+
+static PyObject *
+elObj_line_generation_getter(EditLineObject *self, void *closure)
+{
+    return PyLong_FromUnsignedLong(self->line_gen);
+}
+
 /* Exported function to insert text into the line buffer */
 
 static PyObject *
 insert_text(EditLineObject *self, PyObject *string)
 {
-    PyObject *encoded = encode(string);
+    wchar_t *text;
     pel_note(__FUNCTION__);
-    if (encoded == NULL) {
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (line_will_change(self) < 0)
+	return NULL;
+    text = PyUnicode_AsWideCharString(string, NULL);
+    if (text == NULL) {
         return NULL;
     }
-    el_insertstr(self->el, PyBytes_AS_STRING(encoded));
-    Py_DECREF(encoded);
+    el_winsertstr(self->el, text);
+    PyMem_Free(text);
+    if (self->batch_depth > 0)
+	self->batch_dirty = 1;
     Py_RETURN_NONE;
 }
 
@@ -758,18 +4349,21 @@ Insert text into the line buffer at the cursor position.");
 static PyObject *
 delete_text(EditLineObject *self, PyObject *pycount)
 {
-    const LineInfo *linfo;
+    const LineInfoW *linfo;
     int cur_line_len;
     int count;
     pel_note(__FUNCTION__);
 
+    if (_check_reader(self) < 0)
+	return NULL;
+
     /* convert the value */
     count = PyLong_AsLong(pycount);
     if (count < 0)
 	Py_RETURN_NONE;
 
-    /* get the current line itself */
-    linfo = el_line(self->el);
+    /* get the current line itself, in characters */
+    linfo = el_wline(self->el);
     cur_line_len = linfo->lastchar - linfo->buffer;
 
     /* value is bogus as it is out of range */
@@ -777,7 +4371,11 @@ delete_text(EditLineObject *self, PyObject *pycount)
 	Py_RETURN_NONE;
 
     /* rub out the data */
-    el_deletestr(self->el, count);
+    if (line_will_change(self) < 0)
+	return NULL;
+    el_wdeletestr(self->el, count);
+    if (self->batch_depth > 0)
+	self->batch_dirty = 1;
 
     /* done */
     Py_RETURN_NONE;
@@ -793,6 +4391,15 @@ Deletes 'count' characters before the cursor position.");
 static PyObject *
 redisplay(EditLineObject *self, PyObject *noarg)
 {
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    /* once, when the batch is done */
+    if (self->batch_depth > 0) {
+	self->batch_dirty = 1;
+	Py_RETURN_NONE;
+    }
+
     el_set(self->el, EL_REFRESH);
     Py_RETURN_NONE;
 }
@@ -800,7 +4407,7 @@ redisplay(EditLineObject *self, PyObject *noarg)
 PyDoc_STRVAR(doc_redisplay,
 "redisplay() -> None\n\
 Change what's displayed on the screen to reflect the current\n\
-contents of the line buffer.");
+contents of the line buffer (once, at the end of a batch).");
 
 
 
@@ -811,7 +4418,10 @@ static PyObject *
 read_init_file(EditLineObject *self, PyObject *args)
 {
     PyObject *filename_obj = Py_None, *filename_bytes;
-    
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
     if (!PyArg_ParseTuple(args, "|O:read_init_file", &filename_obj))
         return NULL;
     
@@ -844,6 +4454,9 @@ read_history_file(EditLineObject *self, PyObject *args)
     PyObject *filename_obj = Py_None, *filename_bytes;
     HistEvent ev;
 
+    if (_check_reader(self) < 0)
+	return NULL;
+
     if (!PyArg_ParseTuple(args, "|O:read_history_file", &filename_obj))
         return NULL;
 
@@ -856,6 +4469,8 @@ read_history_file(EditLineObject *self, PyObject *args)
     rv = history(self->hist, &ev, H_LOAD, PyBytes_AsString(filename_bytes));
     Py_DECREF(filename_bytes);
 
+    _history_reindex(self);
+
     return PyLong_FromLong((long)rv);
 }
 
@@ -875,6 +4490,9 @@ write_history_file(EditLineObject *self, PyObject *args)
     HistEvent ev;
     char *filename;
 
+    if (_check_reader(self) < 0)
+	return NULL;
+
     if (!PyArg_ParseTuple(args, "|O:write_history_file", &filename_obj))
         return NULL;
     if (filename_obj == Py_None)
@@ -900,14 +4518,16 @@ static PyObject *
 add_history_entry(EditLineObject *self, PyObject *cmd)
 {
     int rv;
-    PyObject *en_cmd = encode(cmd);
-    HistEvent ev;
-    
+    PyObject *en_cmd;
+
+    if (_check_reader(self) < 0)
+	return NULL;
+    en_cmd = encode(cmd);
     if (en_cmd == NULL) {
         return NULL;
     }
 
-    rv = history(self->hist, &ev, H_ENTER, PyBytes_AS_STRING(en_cmd));
+    rv = _history_enter(self, PyBytes_AS_STRING(en_cmd));
 
     Py_DECREF(en_cmd);
 
@@ -917,6 +4537,46 @@ PyDoc_STRVAR(doc_add_history_entry,
 "add_history_entry(cmd_str) -> Int\n\
 Add a history entry directly.");
 
+static PyObject *
+add_history_entries(EditLineObject *self, PyObject *entries)
+{
+    int rv;
+    long count = 0;
+    PyObject *iter, *item, *en_cmd;
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    iter = PyObject_GetIter(entries);
+    if (iter == NULL)
+	return NULL;
+
+    /* one trip through the C layer for the whole lot */
+    while ((item = PyIter_Next(iter)) != NULL) {
+	en_cmd = encode(item);
+	Py_DECREF(item);
+	if (en_cmd == NULL)
+	    break;
+
+	rv = _history_enter(self, PyBytes_AS_STRING(en_cmd));
+	Py_DECREF(en_cmd);
+	if (rv < 0) {
+	    PyErr_SetString(PyExc_ValueError, "history entry failed");
+	    break;
+	}
+	count++;
+    }
+    Py_DECREF(iter);
+
+    if (PyErr_Occurred())
+	return NULL;
+
+    return PyLong_FromLong(count);
+}
+PyDoc_STRVAR(doc_add_history_entries,
+"add_history_entries(iterable) -> Int\n\
+Add many history entries (oldest first) in one call.");
+
 /* Exported function to get current length of history */
 
 static PyObject *
@@ -925,9 +4585,14 @@ get_current_history_length(EditLineObject *self, PyObject *noarg)
     HistEvent ev;
     int events;
 
+    if (_check_reader(self) < 0)
+	return NULL;
+
     events = history(self->hist, &ev, H_GETSIZE);
-    
-    return PyLong_FromLong((long)events);
+    if (events < 0)
+	return PyLong_FromLong((long)events);
+
+    return PyLong_FromLong((long)ev.num);
 }
 
 PyDoc_STRVAR(doc_get_current_history_length,
@@ -935,6 +4600,133 @@ PyDoc_STRVAR(doc_get_current_history_length,
 return the current (not the maximum) length of history.");
 
 
+static PyObject *
+search_history(EditLineObject *self, PyObject *args)
+{
+    PyObject *pattern_obj, *en_pattern, *list, *item, *text;
+    const char *str;
+    int limit = 0, total, count, i;
+    int *found;
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (!PyArg_ParseTuple(args, "U|i:history_search", &pattern_obj, &limit))
+	return NULL;
+
+    en_pattern = encode(pattern_obj);
+    if (en_pattern == NULL)
+	return NULL;
+
+    _history_index_sync(self);
+    total = self->hidx->live;
+    if (self->store != NULL)
+	total += self->store->hidx->live;
+    if (limit <= 0 || limit > total)
+	limit = total;
+
+    found = PyMem_RawMalloc((limit + 1) * sizeof(int));
+    if (found == NULL) {
+	Py_DECREF(en_pattern);
+	return PyErr_NoMemory();
+    }
+
+    count = _history_search(self, PyBytes_AS_STRING(en_pattern), INT_MAX,
+			    found, limit);
+    Py_DECREF(en_pattern);
+
+    list = PyList_New(count);
+    for (i = 0; list != NULL && i < count; i++) {
+	str = _history_text(self, found[i]);
+	text = decode(str);
+	item = (text == NULL) ? NULL : Py_BuildValue("(iN)", found[i], text);
+	if (item == NULL)
+	    Py_CLEAR(list);
+	else
+	    PyList_SET_ITEM(list, i, item);
+    }
+
+    PyMem_RawFree(found);
+    return list;
+}
+PyDoc_STRVAR(doc_search_history,
+"history_search(pattern[, limit]) -> list\n\
+Find history entries containing 'pattern' (newest first) as a list of\n\
+(event number, entry) tuples.  A limit of 0 returns every match.");
+
+static PyObject *
+event_history(EditLineObject *self, PyObject *args)
+{
+    const char *str;
+    HistEvent ev;
+    int event, base = _history_base(self);
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (!PyArg_ParseTuple(args, "i:history_event", &event))
+	return NULL;
+
+    /* the index holds the entries by event number */
+    _history_index_sync(self);
+    str = _history_text(self, event);
+    if (str != NULL)
+	return Py_BuildValue("(iN)", event, decode(str));
+
+    /* it may have given up on the entries, ask libedit to walk them */
+    if (event > base && self->hidx->live == 0 &&
+	history(self->hist, &ev, H_LAST) >= 0 &&
+	history(self->hist, &ev, H_PREV_EVENT, event - base) >= 0)
+	return Py_BuildValue("(iN)", event, decode(ev.str));
+
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(doc_event_history,
+"history_event(event) -> tuple\n\
+Look up a history entry by event number as an (event number, entry)\n\
+tuple, or None if there is no such event.");
+
+static PyObject *
+fuzzy_history(EditLineObject *self, PyObject *args)
+{
+    PyObject *pattern_obj, *en_pattern, *list, *item, *text;
+    HistRanked top[FUZZY_TOP];
+    int limit = 10, count, i;
+
+    if (_check_reader(self) < 0)
+	return NULL;
+
+    if (!PyArg_ParseTuple(args, "U|i:history_fuzzy", &pattern_obj, &limit))
+	return NULL;
+
+    en_pattern = encode(pattern_obj);
+    if (en_pattern == NULL)
+	return NULL;
+
+    _history_index_sync(self);
+    count = _history_fuzzy(self, PyBytes_AS_STRING(en_pattern), top, limit);
+    Py_DECREF(en_pattern);
+    if (count < 0)
+	return PyErr_NoMemory();
+
+    list = PyList_New(count);
+    for (i = 0; list != NULL && i < count; i++) {
+	text = decode(_history_text(self, top[i].event));
+	item = (text == NULL) ? NULL : Py_BuildValue("(iN)", top[i].event, text);
+	if (item == NULL)
+	    Py_CLEAR(list);
+	else
+	    PyList_SET_ITEM(list, i, item);
+    }
+
+    return list;
+}
+PyDoc_STRVAR(doc_fuzzy_history,
+"history_fuzzy(pattern[, limit]) -> list\n\
+Rank the history entries holding the characters of 'pattern' in order,\n\
+by match quality, frequency and age.  Returns up to 'limit' (at most 64)\n\
+distinct (event number, entry) tuples, best first.");
+
 static PyObject *
 _histevent_to_pyobject(HistEvent *ev)
 {
@@ -1004,6 +4796,9 @@ do_history(EditLineObject *self, PyObject *args)
     HistEvent ev;
     const char *tag = NULL;
 
+    if (_check_reader(self) < 0)
+	return NULL;
+
     /* use the cmd value to extract the other args */
     if (!PyArg_ParseTuple(args, "i|i", &cmd, &int_arg)) {
 	PyErr_SetString(PyExc_TypeError, "Cannot decode the command value.");
@@ -1015,6 +4810,7 @@ do_history(EditLineObject *self, PyObject *args)
     switch (cmd) {
 	case H_CLEAR:
 	    rv = history(self->hist, &ev, H_CLEAR);
+	    hidx_clear(self->hidx);
 	    break;
 	
 	case H_GETSIZE:
@@ -1024,11 +4820,23 @@ do_history(EditLineObject *self, PyObject *args)
 	    break;
 	    
 	case H_SETSIZE:
-	    if (!PyArg_ParseTuple(args, "ii", &cmd, hval)) {
+	    if (!PyArg_ParseTuple(args, "ii", &cmd, &hval)) {
 		PyErr_SetString(PyExc_TypeError, "Cannot extract size.");
 		return NULL;
 	    }
 	    rv = history(self->hist, &self->ev, H_SETSIZE, hval);
+	    if (rv >= 0) {
+		self->hist_size = hval;
+		_history_index_sync(self);
+	    }
+	    break;
+
+	case H_DEL:
+	    if (int_arg == -1) {
+		PyErr_SetString(PyExc_TypeError, "H_DEL argument is invalid.");
+		return NULL;
+	    }
+	    rv = _history_delete(self, int_arg);
 	    break;
 
 	case H_SET:
@@ -1107,8 +4915,7 @@ PyDoc_STRVAR(doc_do_history,
 static PyObject *
 get_begidx(EditLineObject *self, PyObject *noarg)
 {
-    Py_INCREF(self->begidx);
-    return self->begidx;
+    return PyLong_FromLong(self->begidx);
 }
 
 PyDoc_STRVAR(doc_get_begidx,
@@ -1121,8 +4928,7 @@ get the beginning index of the completion scope");
 static PyObject *
 get_endidx(EditLineObject *self, PyObject *noarg)
 {
-    Py_INCREF(self->endidx);
-    return self->endidx;
+    return PyLong_FromLong(self->endidx);
 }
 
 PyDoc_STRVAR(doc_get_endidx,
@@ -1135,8 +4941,11 @@ gettc(EditLineObject *self, PyObject *op_string)
     int rv = -1;
     int value = -1;
     const char * op_cstr;
-    PyObject *op_encoded = encode(op_string);
+    PyObject *op_encoded;
 
+    if (_check_reader(self) < 0)
+	return NULL;
+    op_encoded = encode(op_string);
     if (op_encoded == NULL) {
         return NULL;
     }
@@ -1178,16 +4987,58 @@ display internal C stuff");
 
 static PyMethodDef elObj_methods[] = {
     {
-	"gettc",
-	(PyCFunction) gettc,
-	METH_O,
-	doc_gettc
+	"gettc",
+	(PyCFunction) gettc,
+	METH_O,
+	doc_gettc
+    },
+    {
+	"readline",
+	(PyCFunction) readline,
+	METH_NOARGS,
+	doc_readline
+    },
+    {
+	"feed",
+	(PyCFunction) feed,
+	METH_O,
+	doc_feed
+    },
+    {
+	"_feed_start",
+	(PyCFunction) feed_start,
+	METH_NOARGS,
+	doc_feed_start
+    },
+    {
+	"_feed_line",
+	(PyCFunction) feed_line,
+	METH_NOARGS,
+	doc_feed_line
+    },
+    {
+	"_feed_stop",
+	(PyCFunction) feed_stop,
+	METH_NOARGS,
+	doc_feed_stop
+    },
+    {
+	"_headless",
+	(PyCFunction) headless,
+	METH_VARARGS,
+	doc_headless
     },
     {
-	"readline",
-	(PyCFunction) readline,
+	"take_output",
+	(PyCFunction) take_output,
 	METH_NOARGS,
-	doc_readline
+	doc_take_output
+    },
+    {
+	"_write_output",
+	(PyCFunction) write_output,
+	METH_O,
+	doc_write_output
     },
     {
 	"_completer",
@@ -1198,7 +5049,7 @@ static PyMethodDef elObj_methods[] = {
     {
 	"bind",
 	(PyCFunction)bind,
-	METH_O,
+	METH_VARARGS,
 	doc_bind
     },
 #if 0
@@ -1215,6 +5066,12 @@ static PyMethodDef elObj_methods[] = {
 	METH_NOARGS,
 	doc_get_line_buffer
     },
+    {
+	"line_view",
+	(PyCFunction) line_view,
+	METH_NOARGS,
+	doc_line_view
+    },
     {
 	"insert_text",
 	(PyCFunction) insert_text,
@@ -1233,6 +5090,24 @@ static PyMethodDef elObj_methods[] = {
 	METH_NOARGS,
 	doc_redisplay
     },
+    {
+	"_batch_begin",
+	(PyCFunction) batch_begin,
+	METH_NOARGS,
+	doc_batch_begin
+    },
+    {
+	"_batch_end",
+	(PyCFunction) batch_end,
+	METH_NOARGS,
+	doc_batch_end
+    },
+    {
+	"_add_function",
+	(PyCFunction) add_function,
+	METH_VARARGS,
+	doc_add_function
+    },
     {
 	"read_init_file",
 	(PyCFunction) read_init_file,
@@ -1257,12 +5132,36 @@ static PyMethodDef elObj_methods[] = {
 	METH_O,
 	doc_add_history_entry
     },
+    {
+	"add_history_entries",
+	(PyCFunction) add_history_entries,
+	METH_O,
+	doc_add_history_entries
+    },
     {
 	"get_current_history_length",
 	(PyCFunction) get_current_history_length,
 	METH_NOARGS,
 	doc_get_current_history_length
     },
+    {
+	"history_search",
+	(PyCFunction) search_history,
+	METH_VARARGS,
+	doc_search_history
+    },
+    {
+	"history_event",
+	(PyCFunction) event_history,
+	METH_VARARGS,
+	doc_event_history
+    },
+    {
+	"history_fuzzy",
+	(PyCFunction) fuzzy_history,
+	METH_VARARGS,
+	doc_fuzzy_history
+    },
     {
 	"history",
 	(PyCFunction) do_history,
@@ -1291,146 +5190,416 @@ static PyMethodDef elObj_methods[] = {
 };
 
 static PyObject*
-elObj_prompt_getter(EditLineObject *self, void* closure)
+elObj_prompt_getter(EditLineObject *self, void* closure)
+{
+    return decode(self->prompt);
+}
+
+static int
+elObj_prompt_setter(EditLineObject *self, PyObject *value, void *closure)
+{
+    int rv = 0;
+    int n;
+    char *new_prompt;
+    const char *encoded_c;
+    PyObject *encoded;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError, "Cannot delete the prompt attribute");
+        return -1;
+    }
+
+    if (! PyUnicode_Check(value)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "The prompt attribute value must be a string");
+        return -1;
+    }
+
+    /* it is stored as a C string */
+    encoded = encode(value);
+    if (encoded == NULL) {
+        PyErr_SetString(PyExc_ValueError,
+                        "The prompt attribute could not be encoded");
+        return -1;
+    }
+
+    /* get it as a c-string */
+    encoded_c = PyBytes_AS_STRING(encoded);
+    n = strlen(encoded_c);
+
+    /* create a RawMalloc'd buffer */
+    new_prompt = PyMem_RawMalloc(n+1);
+    if (new_prompt == NULL) {
+	Py_DECREF(encoded);
+	PyErr_NoMemory();
+	return -1;
+    }
+
+    /* Copy the malloc'ed buffer into a PyMem_Malloc'ed one. */
+    strncpy(new_prompt, encoded_c, n);
+    new_prompt[n] = '\0';
+
+    /* release the previous one if it was assigned */
+    if (self->prompt)
+	PyMem_RawFree(self->prompt);
+
+    /* make this the active one */
+    self->prompt = new_prompt;
+
+    /*
+     * REFs:  only manage 'enc' to ensure it gets removed.  We don't 'own'
+     *        any of the others, so we just borrow the ref.
+     */
+    Py_DECREF(encoded);
+
+    /* done */
+    return rv;
+}
+
+#if 0
+static PyObject*
+elObj_prompt_esc_getter(EditLineObject *self, void* closure)
+{
+    return decode(self->prompt_esc);
+}
+#endif
+
+
+static PyObject*
+elObj_rprompt_getter(EditLineObject *self, void* closure)
+{
+    return decode(self->rprompt);
+}
+
+static int
+elObj_rprompt_setter(EditLineObject *self, PyObject *value, void *closure)
+{
+    int rv = 0;
+    int n;
+    char *new_rprompt;
+    const char *encoded_c;
+    PyObject *encoded;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError, "Cannot delete the rprompt attribute");
+        return -1;
+    }
+
+    if (! PyUnicode_Check(value)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "The rprompt attribute value must be a string");
+        return -1;
+    }
+
+    /* it is stored as a C string */
+    encoded = encode(value);
+    if (encoded == NULL) {
+        PyErr_SetString(PyExc_ValueError,
+                        "The rprompt attribute could not be encoded");
+        return -1;
+    }
+
+    /* get it as a c-string */
+    encoded_c = PyBytes_AS_STRING(encoded);
+    n = strlen(encoded_c);
+
+    /* create a RawMalloc'd buffer */
+    new_rprompt = PyMem_RawMalloc(n+1);
+    if (new_rprompt == NULL) {
+	Py_DECREF(encoded);
+	PyErr_NoMemory();
+	return -1;
+    }
+
+    /* Copy the malloc'ed buffer into a PyMem_Malloc'ed one. */
+    strncpy(new_rprompt, encoded_c, n);
+    new_rprompt[n] = '\0';
+
+    /* release the previous one if it was assigned */
+    if (self->rprompt)
+	PyMem_RawFree(self->rprompt);
+
+    /* make this the active one */
+    self->rprompt = new_rprompt;
+
+    /*
+     * REFs:  only manage 'enc' to ensure it gets removed.  We don't 'own'
+     *        any of the others, so we just borrow the ref.
+     */
+    Py_DECREF(encoded);
+
+    /* done */
+    return rv;
+}
+
+static PyObject*
+elObj_history_size_getter(EditLineObject *self, void* closure)
+{
+    return PyLong_FromLong((long)self->hist_size);
+}
+
+static int
+elObj_history_size_setter(EditLineObject *self, PyObject *value, void *closure)
+{
+    long size;
+    HistEvent ev;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError,
+			"Cannot delete the history_size attribute");
+        return -1;
+    }
+
+    size = PyLong_AsLong(value);
+    if (size == -1 && PyErr_Occurred())
+	return -1;
+
+    if (size < 0 || size > INT_MAX) {
+        PyErr_SetString(PyExc_ValueError,
+                        "The history_size attribute is out of range");
+        return -1;
+    }
+
+    if (history(self->hist, &ev, H_SETSIZE, (int)size) < 0) {
+        PyErr_SetString(PyExc_ValueError, "setting history size failed");
+        return -1;
+    }
+    self->hist_size = (int)size;
+    _history_index_sync(self);
+
+    return 0;
+}
+
+static PyObject*
+elObj_bracketed_paste_getter(EditLineObject *self, void* closure)
+{
+    return PyBool_FromLong((long)self->paste_mode);
+}
+
+static int
+elObj_bracketed_paste_setter(EditLineObject *self, PyObject *value,
+			     void *closure)
+{
+    int on;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError,
+			"Cannot delete the bracketed_paste attribute");
+        return -1;
+    }
+
+    on = PyObject_IsTrue(value);
+    if (on < 0)
+	return -1;
+
+    self->paste_mode = on;
+    return 0;
+}
+
+static PyObject*
+elObj_incremental_search_getter(EditLineObject *self, void* closure)
+{
+    return PyBool_FromLong((long)self->isearch);
+}
+
+static int
+elObj_incremental_search_setter(EditLineObject *self, PyObject *value,
+				void *closure)
+{
+    int on;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError,
+			"Cannot delete the incremental_search attribute");
+        return -1;
+    }
+
+    on = PyObject_IsTrue(value);
+    if (on < 0)
+	return -1;
+
+    if (on && !self->isearch) {
+	self->isearch_saved = _bind_save(self, "^R");
+	if (self->isearch_saved == NULL) {
+	    PyErr_NoMemory();
+	    return -1;
+	}
+	el_set(self->el, EL_BIND, "^R", "ed-search-history", NULL);
+    }
+    else if (!on && self->isearch) {
+	/* unless ^R was bound to something else since */
+	char *now = _bind_save(self, "^R");
+
+	if (now == NULL) {
+	    PyErr_NoMemory();
+	    return -1;
+	}
+	if (strcmp(now, "fed-search-history") == 0)
+	    _bind_restore(self, "^R", self->isearch_saved);
+	free(now);
+	free(self->isearch_saved);
+	self->isearch_saved = NULL;
+    }
+    self->isearch = on;
+    return 0;
+}
+
+static PyObject*
+elObj_horizontal_scroll_getter(EditLineObject *self, void* closure)
 {
-    return decode(self->prompt);
+    return PyBool_FromLong((long)self->hscroll);
 }
 
 static int
-elObj_prompt_setter(EditLineObject *self, PyObject *value, void *closure)
+elObj_horizontal_scroll_setter(EditLineObject *self, PyObject *value,
+			       void *closure)
 {
-    int rv = 0;
-    int n;
-    char *new_prompt;
-    const char *encoded_c;
-    PyObject *encoded;
-    
-    if (value == NULL) {
-        PyErr_SetString(PyExc_TypeError, "Cannot delete the prompt attribute");
-        return -1;
-    }
+    int on;
 
-    if (! PyUnicode_Check(value)) {
-        PyErr_SetString(PyExc_TypeError,
-                        "The prompt attribute value must be a string");
-        return -1;
-    }
+    if (_check_reader(self) < 0)
+	return -1;
 
-    /* it is stored as a C string */
-    encoded = encode(value);
-    if (encoded == NULL) {
-        PyErr_SetString(PyExc_ValueError,
-                        "The prompt attribute could not be encoded");
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError,
+			"Cannot delete the horizontal_scroll attribute");
         return -1;
     }
 
-    /* get it as a c-string */
-    encoded_c = PyBytes_AS_STRING(encoded);
-    n = strlen(encoded_c);
+    on = PyObject_IsTrue(value);
+    if (on < 0)
+	return -1;
 
-    /* create a RawMalloc'd buffer */
-    new_prompt = PyMem_RawMalloc(n+1);
-    if (new_prompt == NULL) {
-	Py_DECREF(encoded);
-	PyErr_NoMemory();
+    /* the line being read carries on as it was drawn */
+    if (on != self->hscroll && _hscroll_bind(self, on) < 0)
 	return -1;
-    }
+    self->hscroll = on;
+    return 0;
+}
 
-    /* Copy the malloc'ed buffer into a PyMem_Malloc'ed one. */
-    strncpy(new_prompt, encoded_c, n);
-    new_prompt[n] = '\0';
+static PyObject*
+elObj_scratch_keep_getter(EditLineObject *self, void* closure)
+{
+    return PyLong_FromSize_t(self->buffer_keep);
+}
 
-    /* release the previous one if it was assigned */
-    if (self->prompt)
-	PyMem_RawFree(self->prompt);
+static int
+elObj_scratch_keep_setter(EditLineObject *self, PyObject *value,
+			  void *closure)
+{
+    size_t keep;
 
-    /* make this the active one */
-    self->prompt = new_prompt;
+    if (_check_reader(self) < 0)
+	return -1;
 
-    /*
-     * REFs:  only manage 'enc' to ensure it gets removed.  We don't 'own'
-     *        any of the others, so we just borrow the ref.
-     */
-    Py_DECREF(encoded);
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError,
+			"Cannot delete the scratch_keep attribute");
+        return -1;
+    }
 
-    /* done */
-    return rv;
-}
+    keep = PyLong_AsSize_t(value);
+    if (keep == (size_t) -1 && PyErr_Occurred())
+	return -1;
 
-#if 0
-static PyObject*
-elObj_prompt_esc_getter(EditLineObject *self, void* closure)
-{
-    return decode(self->prompt_esc);
+    self->buffer_keep = keep;
+    return 0;
 }
-#endif
-
 
 static PyObject*
-elObj_rprompt_getter(EditLineObject *self, void* closure)
+elObj_history_dedupe_getter(EditLineObject *self, void* closure)
 {
-    return decode(self->rprompt);
+    return PyBool_FromLong((long)self->hist_dedupe);
 }
 
 static int
-elObj_rprompt_setter(EditLineObject *self, PyObject *value, void *closure)
+elObj_history_dedupe_setter(EditLineObject *self, PyObject *value,
+			    void *closure)
 {
-    int rv = 0;
-    int n;
-    char *new_rprompt;
-    const char *encoded_c;
-    PyObject *encoded;
-    
+    int dedupe;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
     if (value == NULL) {
-        PyErr_SetString(PyExc_TypeError, "Cannot delete the rprompt attribute");
+        PyErr_SetString(PyExc_TypeError,
+			"Cannot delete the history_dedupe attribute");
         return -1;
     }
 
-    if (! PyUnicode_Check(value)) {
+    dedupe = PyObject_IsTrue(value);
+    if (dedupe < 0)
+	return -1;
+
+    /* whatever piled up so far goes as well */
+    if (dedupe && !self->hist_dedupe)
+	_history_dedupe_all(self);
+    self->hist_dedupe = dedupe;
+
+    return 0;
+}
+
+static PyObject *
+elObj_history_store_getter(EditLineObject *self, void* closure)
+{
+    if (self->store == NULL)
+	Py_RETURN_NONE;
+
+    Py_INCREF(self->store);
+    return (PyObject *) self->store;
+}
+
+static int
+elObj_history_store_setter(EditLineObject *self, PyObject *value,
+			   void *closure)
+{
+    HistCandidates *cand;
+
+    if (_check_reader(self) < 0)
+	return -1;
+
+    if (value == NULL) {
         PyErr_SetString(PyExc_TypeError,
-                        "The rprompt attribute value must be a string");
+			"Cannot delete the history_store attribute");
         return -1;
     }
 
-    /* it is stored as a C string */
-    encoded = encode(value);
-    if (encoded == NULL) {
-        PyErr_SetString(PyExc_ValueError,
-                        "The rprompt attribute could not be encoded");
+    if (value != Py_None && !PyObject_TypeCheck(value, &HistoryStoreType)) {
+        PyErr_SetString(PyExc_TypeError,
+			"history_store must be a HistoryStore or None");
         return -1;
     }
 
-    /* get it as a c-string */
-    encoded_c = PyBytes_AS_STRING(encoded);
-    n = strlen(encoded_c);
+    /* the event numbers move, so does anything which held on to them */
+    hidx_nav_reset(&self->hidx->nav);
+    _history_store_release(self);
+    if (value == Py_None)
+	return 0;
 
-    /* create a RawMalloc'd buffer */
-    new_rprompt = PyMem_RawMalloc(n+1);
-    if (new_rprompt == NULL) {
-	Py_DECREF(encoded);
+    cand = PyMem_RawCalloc(1, sizeof(HistCandidates));
+    if (cand == NULL) {
 	PyErr_NoMemory();
 	return -1;
     }
+    self->store_fuzzy = cand;
+    Py_INCREF(value);
+    self->store = (HistoryStoreObject *) value;
 
-    /* Copy the malloc'ed buffer into a PyMem_Malloc'ed one. */
-    strncpy(new_rprompt, encoded_c, n);
-    new_rprompt[n] = '\0';
-
-    /* release the previous one if it was assigned */
-    if (self->rprompt)
-	PyMem_RawFree(self->rprompt);
-
-    /* make this the active one */
-    self->rprompt = new_rprompt;
-
-    /*
-     * REFs:  only manage 'enc' to ensure it gets removed.  We don't 'own'
-     *        any of the others, so we just borrow the ref.
-     */
-    Py_DECREF(encoded);
-
-    /* done */
-    return rv;
+    return 0;
 }
 
 #define HISTORY_GETSET_GETTER_MACRO(tag)	\
@@ -1470,9 +5639,66 @@ HISTORY_FN_MACRO(H_SAVE)
 HISTORY_FN_MACRO(H_SETUNIQUE)
 HISTORY_FN_MACRO(H_GETUNIQUE)
 HISTORY_FN_MACRO(H_DEL)
+HISTORY_FN_MACRO(H_CLEAR)
 
 
 static PyGetSetDef EditLineType_getseters[] = {
+    {
+	"bracketed_paste",
+	(getter)elObj_bracketed_paste_getter,
+	(setter)elObj_bracketed_paste_setter,
+	"Have a terminal mark pastes, which go in whole (default True)",
+	NULL
+    },
+    {
+	"incremental_search",
+	(getter)elObj_incremental_search_getter,
+	(setter)elObj_incremental_search_setter,
+	"^R searches the history through its index (default False)",
+	NULL
+    },
+    {
+	"horizontal_scroll",
+	(getter)elObj_horizontal_scroll_getter,
+	(setter)elObj_horizontal_scroll_setter,
+	"Keep the line to one row, scrolling it sideways (default False)",
+	NULL
+    },
+    {
+	"scratch_keep",
+	(getter)elObj_scratch_keep_getter,
+	(setter)elObj_scratch_keep_setter,
+	"Bytes of line buffer kept after a longer line, 0 keeps it all",
+	NULL
+    },
+    {
+	"line_cursor",
+	(getter)elObj_line_cursor_getter,
+	NULL,
+	"Offset of the cursor in the line, in characters",
+	NULL
+    },
+    {
+	"line_generation",
+	(getter)elObj_line_generation_getter,
+	NULL,
+	"Changes whenever the line may have changed, see line_view()",
+	NULL
+    },
+    {
+	"begidx",
+	(getter)get_begidx,
+	NULL,
+	"Beginning index of the tab-completion scope",
+	NULL
+    },
+    {
+	"endidx",
+	(getter)get_endidx,
+	NULL,
+	"Ending index of the tab-completion scope",
+	NULL
+    },
     {
 	"prompt",
 	(getter)elObj_prompt_getter,
@@ -1487,6 +5713,27 @@ static PyGetSetDef EditLineType_getseters[] = {
 	"Configure the right-side prompt string",
 	NULL
     },
+    {
+	"history_size",
+	(getter)elObj_history_size_getter,
+	(setter)elObj_history_size_setter,
+	"Maximum number of entries held in the history",
+	NULL
+    },
+    {
+	"history_dedupe",
+	(getter)elObj_history_dedupe_getter,
+	(setter)elObj_history_dedupe_setter,
+	"Keep one copy of each command, re-entering one moves it to the newest",
+	NULL
+    },
+    {
+	"history_store",
+	(getter)elObj_history_store_getter,
+	(setter)elObj_history_store_setter,
+	"Shared HistoryStore whose entries come ahead of this session's",
+	NULL
+    },
     
     HISTORY_GETSET_GETTER_MACRO(H_SETSIZE),
     HISTORY_GETSET_GETTER_MACRO(H_GETSIZE),
@@ -1508,6 +5755,7 @@ static PyGetSetDef EditLineType_getseters[] = {
     HISTORY_GETSET_GETTER_MACRO(H_SETUNIQUE),
     HISTORY_GETSET_GETTER_MACRO(H_GETUNIQUE),
     HISTORY_GETSET_GETTER_MACRO(H_DEL),
+    HISTORY_GETSET_GETTER_MACRO(H_CLEAR),
     
     {NULL, NULL, NULL, NULL, NULL}  /* Sentinel */
 };
@@ -1531,7 +5779,7 @@ static PyTypeObject EditLineType = {
     0,                         /* tp_str */
     0,                         /* tp_getattro */
     0,                         /* tp_setattro */
-    0,                         /* tp_as_buffer */
+    &elObj_as_buffer,          /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,        /* tp_flags */
     "EditLineBase objects",    /* tp_doc */
     0,                         /* tp_traverse */
@@ -1555,6 +5803,129 @@ static PyTypeObject EditLineType = {
 };
 
 
+/*******************************************************************************
+ *
+ *              HistoryStore Object Definition
+ *
+ ******************************************************************************/
+
+static PyObject *
+store_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    HistoryStoreObject *self;
+    PyObject *entries, *iter, *item, *en_cmd;
+    int rv;
+
+    if (!PyArg_ParseTuple(args, "O:HistoryStore", &entries))
+	return NULL;
+
+    iter = PyObject_GetIter(entries);
+    if (iter == NULL)
+	return NULL;
+
+    self = (HistoryStoreObject *) type->tp_alloc(type, 0);
+    if (self == NULL) {
+	Py_DECREF(iter);
+	return NULL;
+    }
+
+    self->hidx = PyMem_RawCalloc(1, sizeof(HistIndex));
+    if (self->hidx == NULL)
+	PyErr_NoMemory();
+
+    while (self->hidx != NULL && (item = PyIter_Next(iter)) != NULL) {
+	en_cmd = encode(item);
+	Py_DECREF(item);
+	if (en_cmd == NULL)
+	    break;
+
+	rv = hidx_add(self->hidx, self->size + 1, PyBytes_AS_STRING(en_cmd));
+	Py_DECREF(en_cmd);
+	if (rv < 0) {
+	    PyErr_NoMemory();
+	    break;
+	}
+	self->size++;
+    }
+    Py_DECREF(iter);
+
+    /* sorted up front, the sessions sharing it only ever read it */
+    if (!PyErr_Occurred() && hidx_prefix_build(self->hidx) < 0)
+	PyErr_NoMemory();
+
+    if (PyErr_Occurred()) {
+	Py_DECREF(self);
+	return NULL;
+    }
+
+    return (PyObject *) self;
+}
+
+static void
+store_dealloc(HistoryStoreObject *self)
+{
+    hidx_free(self->hidx);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static Py_ssize_t
+store_length(HistoryStoreObject *self)
+{
+    return self->size;
+}
+
+static PySequenceMethods store_as_sequence = {
+    (lenfunc)store_length,     /* sq_length */
+};
+
+PyDoc_STRVAR(doc_store,
+"HistoryStore(entries)\n\n\
+History entries (oldest first) indexed once and shared by any number of\n\
+EditLine instances through their history_store attribute.");
+
+static PyTypeObject HistoryStoreType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "editline.HistoryStore",   /* tp_name */
+    sizeof(HistoryStoreObject), /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)store_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    &store_as_sequence,        /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    doc_store,                 /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    0,                         /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    PyType_GenericAlloc,       /* tp_alloc */
+    store_new,                 /* tp_new */
+    PyObject_Del,              /* tp_free */
+};
+
+
 /*******************************************************************************
  *
  *                 Module Definitions
@@ -1669,9 +6040,31 @@ PyInit__editline(void)
 {
     PyObject *m;
     char buf[32];
+    int i;
 
     if (PyType_Ready(&EditLineType) < 0)
         return NULL;
+    if (PyType_Ready(&HistoryStoreType) < 0)
+        return NULL;
+
+    /* Python has set LC_CTYPE from the environment by now */
+    detect_locale_encoding();
+
+    /* looked up on every Tab and every line */
+    str_completer = PyUnicode_InternFromString("_completer");
+    str_run_command = PyUnicode_InternFromString("_run_command");
+    str_line_started = PyUnicode_InternFromString("_line_started");
+    str_key_function = PyUnicode_InternFromString("_key_function");
+    str_merge_history = PyUnicode_InternFromString("_merge_deferred_history");
+    if (str_completer == NULL || str_run_command == NULL ||
+	str_line_started == NULL || str_key_function == NULL ||
+	str_merge_history == NULL)
+        return NULL;
+    for (i = 0; i < KEY_FUNCTIONS; i++) {
+	key_slots[i] = PyLong_FromLong(i);
+	if (key_slots[i] == NULL)
+	    return NULL;
+    }
     
     m = PyModule_Create(&el_module);
     if (m == NULL)
@@ -1704,6 +6097,8 @@ PyInit__editline(void)
     /* initialize the type */
     Py_INCREF(&EditLineType);
     PyModule_AddObject(m, "EditLineBase", (PyObject *)&EditLineType);
+    Py_INCREF(&HistoryStoreType);
+    PyModule_AddObject(m, "HistoryStore", (PyObject *)&HistoryStoreType);
 
     /* done */
     return m;